@@ -33,9 +33,14 @@
 # https://stackoverflow.com/questions/1112618/import-python-package-from-local-directory-into-interpreter
 # https://stackoverflow.com/questions/14500183/in-python-can-i-call-the-main-of-an-imported-module
 from pathlib import Path
+import os
 import sys
 module_dir = Path(__file__).resolve().parent
 sys.path.append(str(module_dir))
+if "_ARGCOMPLETE" in os.environ:
+    # Answer tab-completion requests from the cached index instead of loading all of cheribuild (exits if successful)
+    from pycheribuild.completionindex import complete_from_index
+    complete_from_index()
 # noinspection PyPep8
 from pycheribuild.__main__ import main  # "__main__" case
 
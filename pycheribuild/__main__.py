@@ -42,12 +42,10 @@ from .config.defaultconfig import CheribuildAction, DefaultCheriConfig
 # We can't do from .configloader import ConfigLoader here because that will only update the local copy!
 # https://stackoverflow.com/questions/3536620/how-to-change-a-module-variable-from-another-module
 from .config.loader import JsonAndCommandLineConfigLoader, JsonAndCommandLineConfigOption
-# make sure all projects are loaded so that target_manager gets populated
-# noinspection PyUnresolvedReferences
-from .projects import *  # noqa: F401,F403
-# noinspection PyUnresolvedReferences
-from .projects.cross import *  # noqa: F401,F403
+from .buildcache import BuildArtifactCache
+from .buildlogs import print_build_log_errors
 from .projects.project import SimpleProject
+from .targetindex import TargetIndex
 from .targets import target_manager
 from .processutils import commandline_to_str, get_program_version, print_command, run_command
 from .utils import (AnsiColour, OSInfo, coloured, fatal_error, have_working_internet_connection, init_global_config,
@@ -112,6 +110,25 @@ def check_macos_big_sur(config: DefaultCheriConfig):
                 pretend=os.getenv("CHERIBUILD_BIG_SUR_NON_FATAL"))
 
 
+def load_targets(config_loader: JsonAndCommandLineConfigLoader) -> bool:
+    """
+    Populate target_manager. Unless the options for all targets are needed (--help), this uses the target index to
+    only import the project modules and register their command line options once the targets are actually used.
+    :return: True if targets are loaded lazily
+    """
+    index = TargetIndex()
+    load_lazily = not any(arg in ("-h", "--help", "--help-all", "--help-hidden") for arg in sys.argv[1:])
+    targets = index.load() if load_lazily else None
+    if targets is None:
+        # make sure all projects are loaded so that target_manager gets populated
+        targets = target_manager.load_all_targets()
+        index.save(targets)
+    if load_lazily:
+        target_manager.enable_lazy_loading(targets)
+        config_loader.register_deferred_options = target_manager.load_targets_for_options
+    return load_lazily
+
+
 def real_main():
     # avoid weird errors with macos terminal:
     ensure_fd_is_blocking(sys.stdin.fileno())
@@ -119,6 +136,8 @@ def real_main():
     ensure_fd_is_blocking(sys.stderr.fileno())
 
     config_loader = JsonAndCommandLineConfigLoader()
+    SimpleProject._config_loader = config_loader
+    targets_loaded_lazily = load_targets(config_loader)
     # Don't suggest deprecated names when tab-completing
     if config_loader.is_completing_arguments:
         all_target_names = list(sorted(target_manager.non_deprecated_target_names))
@@ -127,8 +146,8 @@ def real_main():
     run_everything_target = "__run_everything__"
     # Register all command line options
     cheri_config = DefaultCheriConfig(config_loader, all_target_names + [run_everything_target])
-    SimpleProject._config_loader = config_loader
-    target_manager.register_command_line_options()
+    if not targets_loaded_lazily:
+        target_manager.register_command_line_options()
     # load them from JSON/cmd line
     cheri_config.load()
     init_global_config(cheri_config)
@@ -154,9 +173,31 @@ def real_main():
         print("There are", len(names), "available targets:\n ", "\n  ".join(names))
         sys.exit()
     elif CheribuildAction.DUMP_CONFIGURATION in cheri_config.action:
+        target_manager.load_targets_for_options(None)
         print(cheri_config.get_options_json())
         sys.exit()
+    elif CheribuildAction.BUILD_CACHE_INFO in cheri_config.action or \
+            CheribuildAction.BUILD_CACHE_PRUNE in cheri_config.action:
+        if cheri_config.build_cache_dir is None:
+            fatal_error("--build-cache-dir must be set to inspect or prune the artifact cache", pretend=False)
+        cache = BuildArtifactCache(cheri_config.build_cache_dir, cheri_config.build_cache_max_size * 1024 * 1024 * 1024,
+                                   pretend=cheri_config.pretend)
+        if CheribuildAction.BUILD_CACHE_PRUNE in cheri_config.action:
+            removed = cache.evict()
+            status_update("Removed", len(removed), "entries from", cheri_config.build_cache_dir)
+        cache.print_entries()
+        sys.exit()
+    elif cheri_config.show_log_errors:
+        if cheri_config.show_log_errors not in target_manager.target_names:
+            fatal_error("Unknown target", cheri_config.show_log_errors, pretend=False)
+        target = target_manager.get_target(cheri_config.show_log_errors, None, cheri_config, caller="--show-log-errors")
+        project = target.get_or_create_project(None, cheri_config)
+        build_dir = getattr(project, "build_dir", None)
+        if build_dir is None:
+            fatal_error("Target", target.name, "does not write any build logs", pretend=False)
+        sys.exit(1 if print_build_log_errors(build_dir) else 0)
     elif cheri_config.get_config_option:
+        target_manager.load_targets_for_options([cheri_config.get_config_option])
         if cheri_config.get_config_option not in config_loader.options:
             fatal_error("Unknown config key", cheri_config.get_config_option)
         option = config_loader.options[cheri_config.get_config_option]
@@ -0,0 +1,237 @@
+# -
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import typing
+from collections import namedtuple
+from pathlib import Path
+
+from .processutils import print_command, run_command
+from .utils import ConfigBase, fatal_error, status_update
+
+__all__ = ["ReproducibleTarWriter", "archive_compression", "detect_archive_compression",  # no-combine
+           "extract_archive", "ARCHIVE_COMPRESSION_SUFFIXES"]  # no-combine
+
+_Compression = namedtuple("_Compression", ["program", "magic", "compress_args", "decompress_args"])
+# Compression is done by an external program since all of them (except gzip) can use multiple threads. The output of
+# zstd and xz does not depend on the number of threads so the archives are still reproducible.
+_COMPRESSIONS = {
+    "zstd": _Compression("zstd", b"\x28\xb5\x2f\xfd", ["-q", "-c", "-10", "-T{threads}"], ["-q", "-d", "-c"]),
+    "xz": _Compression("xz", b"\xfd7zXZ\x00", ["-c", "-T{threads}"], ["-d", "-c", "-T{threads}"]),
+    "gzip": _Compression("gzip", b"\x1f\x8b", ["-n", "-c"], ["-d", "-c"]),
+    }
+ARCHIVE_COMPRESSION_SUFFIXES = {"zstd": (".tar.zst", ".tzst"), "xz": (".tar.xz", ".txz"), "gzip": (".tar.gz", ".tgz")}
+
+
+def archive_compression(name: str) -> str:
+    """Returns the compression to use for an archive based on the file name (defaults to xz)"""
+    for compression, suffixes in ARCHIVE_COMPRESSION_SUFFIXES.items():
+        if name.endswith(suffixes):
+            return compression
+    return "xz"
+
+
+def detect_archive_compression(archive: Path) -> "typing.Optional[str]":
+    """Returns the compression used for archive based on the magic bytes or None if it is not known"""
+    with archive.open("rb") as f:
+        header = f.read(6)
+    for name, compression in _COMPRESSIONS.items():
+        if header.startswith(compression.magic):
+            return name
+    return None
+
+
+def _compression_command(compression: str, threads: int, *, decompress: bool) -> "typing.Optional[typing.List[str]]":
+    info = _COMPRESSIONS[compression]
+    program = info.program
+    args = info.decompress_args if decompress else info.compress_args
+    if compression == "gzip" and shutil.which("pigz"):
+        return ["pigz", "-p", str(threads)] + args
+    if not shutil.which(program):
+        return None
+    return [program] + [arg.format(threads=threads) for arg in args]
+
+
+class ReproducibleTarWriter(object):
+    """
+    Writes a compressed tar archive that only depends on the contents of the files that were added: all entries are
+    owned by uid/gid 0 (without user and group names), have the same modification time ($SOURCE_DATE_EPOCH or 0)
+    and directories are added in sorted order. The output file is only created once the archive is complete.
+    """
+
+    def __init__(self, output: Path, *, threads: int = 1, compression: str = None, mtime: int = None):
+        self.output = output
+        self.compression = archive_compression(output.name) if compression is None else compression
+        self.threads = max(1, threads)
+        self.mtime = int(os.getenv("SOURCE_DATE_EPOCH", "0")) if mtime is None else mtime
+        self._tmp_path = output.with_name(output.name + ".tmp")
+        self._added_dirs = set()  # type: typing.Set[str]
+        self._hardlinks = dict()  # type: typing.Dict[typing.Tuple[int, int], str]
+        self._tar = None  # type: typing.Optional[tarfile.TarFile]
+        self._proc = None  # type: typing.Optional[subprocess.Popen]
+        self._output_file = None  # type: typing.Optional[typing.IO]
+
+    def __enter__(self) -> "ReproducibleTarWriter":
+        cmd = _compression_command(self.compression, self.threads, decompress=False)
+        if cmd is None:
+            fatal_error("Cannot create", self.output, "since the", _COMPRESSIONS[self.compression].program,
+                        "program is not installed")
+        self._output_file = self._tmp_path.open("wb")
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self._output_file)
+        # The GNU format is needed for long path names and (unlike PAX) does not add any extra timestamps
+        self._tar = tarfile.open(fileobj=self._proc.stdin, mode="w|", format=tarfile.GNU_FORMAT)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self._tar.close()
+        finally:
+            self._proc.stdin.close()
+            returncode = self._proc.wait()
+            self._output_file.close()
+        if exc_type is not None or returncode != 0:
+            self._tmp_path.unlink()
+            if exc_type is None:
+                raise subprocess.CalledProcessError(returncode, self._proc.args)
+            return False
+        os.replace(str(self._tmp_path), str(self.output))
+        return False
+
+    def _tarinfo(self, arcname: str, entry_type: bytes, mode: int) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(arcname)
+        info.type = entry_type
+        info.mode = stat.S_IMODE(mode)
+        info.mtime = self.mtime
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+        return info
+
+    def _add_parent_dirs(self, arcname: str):
+        parent = os.path.dirname(arcname)
+        if parent and parent not in self._added_dirs:
+            self.add_directory(parent)
+
+    def add_directory(self, arcname: str, mode: int = 0o755):
+        if arcname in self._added_dirs:
+            return
+        self._add_parent_dirs(arcname)
+        self._added_dirs.add(arcname)
+        self._tar.addfile(self._tarinfo(arcname, tarfile.DIRTYPE, mode))
+
+    def add_symlink(self, arcname: str, target: str):
+        self._add_parent_dirs(arcname)
+        info = self._tarinfo(arcname, tarfile.SYMTYPE, 0o755)
+        info.linkname = target
+        self._tar.addfile(info)
+
+    def add_file(self, arcname: str, source: Path, *, mode: int = None, copy_to: Path = None):
+        """
+        Adds the regular file source as arcname. If copy_to is set, the contents are also written to that path while
+        the file is being added (this avoids reading the file twice when populating a directory and an archive).
+        """
+        self._add_parent_dirs(arcname)
+        with source.open("rb") as f:
+            st = os.fstat(f.fileno())
+            info = self._tarinfo(arcname, tarfile.REGTYPE, st.st_mode if mode is None else mode)
+            info.size = st.st_size
+            if copy_to is None:
+                self._tar.addfile(info, f)
+                return
+            with copy_to.open("wb") as copy:
+                self._tar.addfile(info, _TeeReader(f, copy))
+            os.chmod(str(copy_to), info.mode)
+
+    def add_path(self, arcname: str, path: Path, st: os.stat_result = None):
+        """Adds a file, symlink or directory (without its contents). Hard links are preserved."""
+        if st is None:
+            st = os.lstat(str(path))
+        if stat.S_ISDIR(st.st_mode):
+            self.add_directory(arcname, st.st_mode)
+        elif stat.S_ISLNK(st.st_mode):
+            self.add_symlink(arcname, os.readlink(str(path)))
+        elif stat.S_ISREG(st.st_mode):
+            if st.st_nlink > 1:
+                previous = self._hardlinks.get((st.st_dev, st.st_ino))
+                if previous is not None:
+                    self._add_parent_dirs(arcname)
+                    info = self._tarinfo(arcname, tarfile.LNKTYPE, st.st_mode)
+                    info.linkname = previous
+                    self._tar.addfile(info)
+                    return
+                self._hardlinks[(st.st_dev, st.st_ino)] = arcname
+            self.add_file(arcname, path, mode=st.st_mode)
+        else:
+            status_update("Not adding", path, "to", self.output, "since it is not a regular file")
+
+    def add_tree(self, directory: Path, arcname: str = "."):
+        """Adds directory and all files below it (in sorted order)"""
+        self.add_directory(arcname, os.lstat(str(directory)).st_mode)
+        for entry in sorted(os.scandir(str(directory)), key=lambda e: e.name):
+            entry_arcname = arcname + "/" + entry.name
+            st = entry.stat(follow_symlinks=False)
+            if stat.S_ISDIR(st.st_mode):
+                self.add_tree(Path(entry.path), entry_arcname)
+            else:
+                self.add_path(entry_arcname, Path(entry.path), st)
+
+
+class _TeeReader(object):
+    def __init__(self, source: "typing.BinaryIO", copy: "typing.BinaryIO"):
+        self._source = source
+        self._copy = copy
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._source.read(size)
+        self._copy.write(data)
+        return data
+
+
+def extract_archive(archive: Path, output_dir: Path, *, extra_args: list = None, threads: int = 1, cwd: Path = None,
+                    config: ConfigBase):
+    """
+    Extracts archive into output_dir. The compression is detected from the file contents and the archive is
+    decompressed by a separate (multi-threaded if possible) process instead of relying on the tar implementation.
+    """
+    tar_cmd = ["tar", "xf", "-", "-C", output_dir] + (extra_args or [])
+    kwargs = {"cwd": cwd} if cwd is not None else {}
+    compression = detect_archive_compression(archive) if archive.exists() else None
+    decompress_cmd = _compression_command(compression, threads, decompress=True) if compression else None
+    if decompress_cmd is None:
+        # Let tar figure out the format
+        run_command(["tar", "xf", archive, "-C", output_dir] + (extra_args or []), config=config, **kwargs)
+        return
+    print_command(decompress_cmd + [archive], config=config, end=" | ")
+    if config.pretend:
+        run_command(tar_cmd, config=config, **kwargs)  # only prints the command
+        return
+    with archive.open("rb") as f:
+        with subprocess.Popen(decompress_cmd, stdin=f, stdout=subprocess.PIPE) as decompress:
+            run_command(tar_cmd, stdin=decompress.stdout, config=config, **kwargs)
+    if decompress.returncode != 0:
+        raise subprocess.CalledProcessError(decompress.returncode, decompress_cmd + [str(archive)])
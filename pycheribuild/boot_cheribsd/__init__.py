@@ -35,8 +35,14 @@
 #
 import argparse
 import atexit
+import collections
+import contextlib
 import datetime
+import fcntl
+import hashlib
+import json
 import os
+import queue
 import random
 import re
 import shlex
@@ -44,7 +50,8 @@ import shutil
 import socket
 import subprocess
 import sys
-import tempfile
+import tarfile
+import threading
 import time
 import traceback
 import typing
@@ -54,7 +61,7 @@ from pycheribuild.colour import AnsiColour, coloured
 from ..config.compilation_targets import CompilationTargets, CrossCompileTarget
 from ..processutils import commandline_to_str, keep_terminal_sane
 from ..qemu_utils import QemuOptions, riscv_bios_arguments
-from ..utils import find_free_port
+from ..utils import find_free_port, SocketAndPort
 
 _cheribuild_root = Path(__file__).parent.parent.parent
 _pexpect_dir = _cheribuild_root / "3rdparty/pexpect"
@@ -108,7 +115,14 @@ MESSAGE_PREFIX = ""
 QEMU_LOGFILE = None  # type: typing.Optional[Path]
 # To keep the port available until we start QEMU
 _SSH_SOCKET_PLACEHOLDER = None  # type: typing.Optional[socket.socket]
+_SSH_SOCKET_PLACEHOLDER_LOCK = threading.Lock()
 MAX_SMBFS_RETRY = 3
+# When new console output arrives only this many bytes of the previously searched output are searched again, so any
+# match must be shorter than this. Without this limit pexpect re-scans the whole (multi-megabyte) buffer for every
+# regex on each read.
+CONSOLE_SEARCH_OVERLAP = 8192
+QEMU_MONITOR_PROMPT = "(qemu) "
+BOOT_SNAPSHOT_TAG = "cheribuild-boot"
 
 
 class PretendSpawn(pexpect.spawn):
@@ -204,25 +218,85 @@ else:
     MixinBase = object
 
 
+class ConsoleSearcher(object):
+    """
+    Drop-in replacement for the pexpect searcher_re class that only searches the newly received console output and the
+    last CONSOLE_SEARCH_OVERLAP bytes before it instead of the whole buffer.
+    Note: The patterns are deliberately searched one after the other rather than as a single alternation, since that
+    would prevent the re module from using its fast literal prefix scan and is about 20 times slower for our patterns.
+    """
+    # pexpect.Expecter only keeps this many bytes of the already searched output in its search buffer
+    longest_string = CONSOLE_SEARCH_OVERLAP
+
+    def __init__(self, patterns: list):
+        self.eof_index = -1
+        self.timeout_index = -1
+        self.start = self.end = -1
+        self.match = None
+        self._searches = []  # type: typing.List[typing.Tuple[int, typing.Pattern]]
+        for index, p in enumerate(patterns):
+            if p is pexpect.EOF:
+                self.eof_index = index
+            elif p is pexpect.TIMEOUT:
+                self.timeout_index = index
+            else:
+                self._searches.append((index, p))
+
+    def __str__(self):
+        lines = ["ConsoleSearcher:"] + ["    {}: {!r}".format(i, p.pattern) for i, p in self._searches]
+        if self.eof_index >= 0:
+            lines.append("    {}: EOF".format(self.eof_index))
+        if self.timeout_index >= 0:
+            lines.append("    {}: TIMEOUT".format(self.timeout_index))
+        return "\n".join(lines)
+
+    def search(self, buffer, freshlen: int, searchwindowsize=None) -> int:
+        searchstart = max(0, len(buffer) - freshlen - CONSOLE_SEARCH_OVERLAP)
+        if searchwindowsize is not None:
+            searchstart = max(searchstart, len(buffer) - searchwindowsize)
+        best_match = best_index = None
+        for index, regex in self._searches:
+            match = regex.search(buffer, searchstart)
+            # Same result as pexpect: the earliest match wins and the first pattern if several match at that offset
+            if match is not None and (best_match is None or match.start() < best_match.start()):
+                best_match, best_index = match, index
+        if best_match is None:
+            return -1
+        self.match = best_match
+        self.start = best_match.start()
+        self.end = best_match.end()
+        return best_index
+
+
 class CheriBSDSpawnMixin(MixinBase):
     EXIT_ON_KERNEL_PANIC = True
 
     def expect_exact_ignore_panic(self, patterns, *, timeout: int):
-        return super().expect_exact(patterns, timeout=timeout)
+        return self._expect_console_exact(patterns, timeout=timeout)
 
     def expect(self, patterns: "typing.List[typing.Union[str, typing.Pattern]]", timeout=-1, pretend_result=None,
                timeout_fatal=True, timeout_msg="timeout", **kwargs):
         assert isinstance(patterns, list), "expected list and not " + str(patterns)
         info("Expecting regex ", coloured(AnsiColour.blue, str(patterns)))
         return self._expect_and_handle_panic_impl(patterns, timeout_msg, timeout_fatal=timeout_fatal,
-                                                  timeout=timeout, expect_fn=super().expect, **kwargs)
+                                                  timeout=timeout, expect_fn=self._expect_console, **kwargs)
 
     def expect_exact(self, pattern_list: typing.List[typing.Union[str, typing.Pattern]], timeout=-1,
                      pretend_result=None, timeout_fatal=True, timeout_msg="timeout", **kwargs):
         assert isinstance(pattern_list, list), "expected list and not " + str(pattern_list)
         info("Expecting literal ", coloured(AnsiColour.blue, str(pattern_list)))
         return self._expect_and_handle_panic_impl(pattern_list, timeout_msg, timeout_fatal=timeout_fatal,
-                                                  timeout=timeout, expect_fn=super().expect_exact, **kwargs)
+                                                  timeout=timeout, expect_fn=self._expect_console_exact, **kwargs)
+
+    def _expect_console_exact(self, patterns: list, **kwargs):
+        return self._expect_console([re.compile(re.escape(self._coerce_expect_string(p)))
+                                     if isinstance(p, self.allowed_string_types) else p for p in patterns], **kwargs)
+
+    def _expect_console(self, patterns: list, *, timeout=-1, searchwindowsize=-1):
+        searcher = ConsoleSearcher(self.compile_pattern_list(patterns))
+        if timeout == -1:
+            timeout = self.timeout
+        return pexpect.Expecter(self, searcher, searchwindowsize).expect_loop(timeout)
 
     def expect_prompt(self, timeout=-1, timeout_msg="timeout", timeout_fatal=True, **kwargs):
         return self.expect_exact([PEXPECT_PROMPT], timeout=timeout, timeout_msg=timeout_msg,
@@ -263,6 +337,8 @@ class QemuCheriBSDInstance(CheriBSDInstance):
     EXIT_ON_KERNEL_PANIC = True
     smb_dirs = None  # type: typing.List[SmbMount]
     flush_interval = None
+    # Set if the guest uses the disk image directly (see guest_transfer_record_file())
+    transfer_record_file = None  # type: typing.Optional[Path]
 
     def __init__(self, qemu_config: QemuOptions, *args, ssh_port: typing.Optional[int],
                  ssh_pubkey: typing.Optional[Path], **kwargs):
@@ -297,8 +373,7 @@ class QemuCheriBSDInstance(CheriBSDInstance):
                        "-o", "ControlPersist=600"]
         return result
 
-    def run_command_via_ssh(self, command: typing.List[str], *, stdout=None, stderr=None, check=True, verbose=False,
-                            use_controlmaster=False, **kwargs) -> subprocess.CompletedProcess:
+    def ssh_command(self, command: typing.List[str], *, verbose=False, use_controlmaster=False) -> typing.List[str]:
         assert self.ssh_port is not None
         ssh_command = ["ssh", "{user}@{host}".format(user=self.ssh_user, host="localhost"),
                        "-p", str(self.ssh_port),
@@ -308,6 +383,11 @@ class QemuCheriBSDInstance(CheriBSDInstance):
         ssh_command.extend(self._ssh_options(use_controlmaster=use_controlmaster))
         ssh_command.append("--")
         ssh_command.extend(command)
+        return ssh_command
+
+    def run_command_via_ssh(self, command: typing.List[str], *, stdout=None, stderr=None, check=True, verbose=False,
+                            use_controlmaster=False, **kwargs) -> subprocess.CompletedProcess:
+        ssh_command = self.ssh_command(command, verbose=verbose, use_controlmaster=use_controlmaster)
         print_cmd(ssh_command, **kwargs)
         return subprocess.run(ssh_command, stdout=stdout, stderr=stderr, check=check, **kwargs)
 
@@ -681,7 +761,13 @@ def start_dhclient(qemu: CheriBSDSpawnMixin, network_iface: str):
 def boot_cheribsd(qemu_options: QemuOptions, qemu_command: typing.Optional[Path], kernel_image: Path,
                   disk_image: typing.Optional[Path], ssh_port: typing.Optional[int],
                   ssh_pubkey: typing.Optional[Path], *, smb_dirs: typing.List[SmbMount] = None, kernel_init_only=False,
-                  trap_on_unrepresentable=False, skip_ssh_setup=False, bios_path: Path = None) -> QemuCheriBSDInstance:
+                  trap_on_unrepresentable=False, skip_ssh_setup=False, bios_path: Path = None,
+                  boot_snapshot_dir: Path = None, keep_disk_image_copy=False, qemu_logfile: Path = None,
+                  ssh_port_placeholder: socket.socket = None) -> QemuCheriBSDInstance:
+    """
+    :param ssh_port_placeholder: a socket bound to ssh_port that is closed just before QEMU is started. If this is
+    None, the global placeholder created by main() is used instead.
+    """
     user_network_args = ""
     if smb_dirs is None:
         smb_dirs = []
@@ -702,39 +788,196 @@ def boot_cheribsd(qemu_options: QemuOptions, qemu_command: typing.Optional[Path]
         bios_args = riscv_bios_arguments(qemu_options.xtarget, None)
     else:
         bios_args = []
-    qemu_args = qemu_options.get_commandline(qemu_command=qemu_command, kernel_file=kernel_image, disk_image=disk_image,
-                                             bios_args=bios_args, user_network_args=user_network_args,
-                                             add_network_device=True,
-                                             trap_on_unrepresentable=trap_on_unrepresentable,  # For debugging
-                                             add_virtio_rng=True  # faster entropy gathering
-                                             )
     kernel_commandline = []
     if kernel_init_only:
         kernel_commandline.append("init_path=/sbin/startup-benchmark.sh")
     if skip_ssh_setup:
         kernel_commandline.append("cheribuild.skip_sshd=1")
         kernel_commandline.append("cheribuild.skip_entropy=1")
-    if kernel_commandline:
-        qemu_args.append("-append")
-        qemu_args.append(" ".join(kernel_commandline))
-    success("Starting QEMU: ", " ".join(qemu_args))
+
+    def get_qemu_args(image: typing.Optional[Path], image_format="raw", network_args=user_network_args):
+        result = qemu_options.get_commandline(qemu_command=qemu_command, kernel_file=kernel_image, disk_image=image,
+                                              disk_image_format=image_format, bios_args=bios_args,
+                                              user_network_args=network_args, add_network_device=True,
+                                              trap_on_unrepresentable=trap_on_unrepresentable,  # For debugging
+                                              add_virtio_rng=True  # faster entropy gathering
+                                              )
+        if kernel_commandline:
+            result.append("-append")
+            result.append(" ".join(kernel_commandline))
+        return result
+
+    def start_qemu(qemu_args: typing.List[str], logfile_mode="w") -> QemuCheriBSDInstance:
+        success("Starting QEMU: ", " ".join(qemu_args))
+        nonlocal ssh_port_placeholder
+        if ssh_port_placeholder is not None:
+            ssh_port_placeholder.close()
+            ssh_port_placeholder = None
+        else:
+            global _SSH_SOCKET_PLACEHOLDER
+            with _SSH_SOCKET_PLACEHOLDER_LOCK:
+                if _SSH_SOCKET_PLACEHOLDER is not None:
+                    _SSH_SOCKET_PLACEHOLDER.close()
+                    _SSH_SOCKET_PLACEHOLDER = None
+        qemu_cls = QemuCheriBSDInstance
+        if PRETEND:
+            qemu_cls = FakeQemuSpawn
+        child = qemu_cls(qemu_options, qemu_args[0], qemu_args[1:], ssh_port=ssh_port, ssh_pubkey=ssh_pubkey,
+                         encoding="utf-8", echo=False, timeout=60)
+        # child.logfile=sys.stdout.buffer
+        child.smb_dirs = smb_dirs
+        logfile = qemu_logfile if qemu_logfile is not None else QEMU_LOGFILE
+        if logfile:
+            child.logfile = logfile.open(logfile_mode)
+        else:
+            child.logfile_read = sys.stdout
+        return child
+
+    network_iface = qemu_options.network_interface_name()
+    disk_image_format = "raw"
+    if boot_snapshot_dir is not None and disk_image is not None and not kernel_init_only:
+        if PRETEND:
+            info("Not using a boot snapshot in pretend mode")
+        else:
+            # The SSH port forwarding is part of the host-side QEMU configuration and not included in the snapshot.
+            key = boot_snapshot_key(get_qemu_args(Path("boot-snapshot.qcow2"), "qcow2",
+                                                  network_args=user_network_args.partition(",hostfwd=")[0]),
+                                    kernel_image=kernel_image, disk_image=disk_image)
+            child = _boot_from_snapshot(boot_snapshot_dir, key, disk_image=disk_image, get_qemu_args=get_qemu_args,
+                                        start_qemu=start_qemu, network_iface=network_iface,
+                                        keep_disk_image_copy=keep_disk_image_copy)
+            if child is not None:
+                return child
+            info("Falling back to a normal boot without a snapshot")
+            # The disk image is shared with other jobs, so boot from a private overlay instead of modifying it.
+            overlay = _private_disk_image_path(disk_image, keep_disk_image_copy)
+            run_host_command([_qemu_img_binary(get_qemu_args(None)[0]), "create", "-q", "-f", "qcow2", "-F", "raw",
+                              "-b", str(disk_image.absolute()), str(overlay)])
+            disk_image, disk_image_format = overlay, "qcow2"
     qemu_starttime = datetime.datetime.now()
-    global _SSH_SOCKET_PLACEHOLDER
-    if _SSH_SOCKET_PLACEHOLDER is not None:
-        _SSH_SOCKET_PLACEHOLDER.close()
-    qemu_cls = QemuCheriBSDInstance
-    if PRETEND:
-        qemu_cls = FakeQemuSpawn
-    child = qemu_cls(qemu_options, qemu_args[0], qemu_args[1:], ssh_port=ssh_port, ssh_pubkey=ssh_pubkey,
-                     encoding="utf-8", echo=False, timeout=60)
-    # child.logfile=sys.stdout.buffer
-    child.smb_dirs = smb_dirs
-    if QEMU_LOGFILE:
-        child.logfile = QEMU_LOGFILE.open("w")
-    else:
-        child.logfile_read = sys.stdout
-    boot_and_login(child, starttime=qemu_starttime, kernel_init_only=kernel_init_only,
-                   network_iface=qemu_options.network_interface_name())
+    child = start_qemu(get_qemu_args(disk_image, disk_image_format))
+    boot_and_login(child, starttime=qemu_starttime, kernel_init_only=kernel_init_only, network_iface=network_iface)
+    return child
+
+
+def _hash_file(path: Path, hasher) -> None:
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(chunk)
+
+
+def boot_snapshot_key(qemu_args: typing.List[str], *, kernel_image: Path, disk_image: Path) -> str:
+    """
+    Returns a key that identifies a QEMU boot snapshot. It changes whenever the kernel, the disk image, the QEMU binary
+    or any of the QEMU command line flags change since a snapshot can only be restored by the exact same configuration.
+    """
+    hasher = hashlib.sha256()
+    for arg in qemu_args:
+        hasher.update(arg.encode("utf-8") + b"\0")
+    qemu_binary = shutil.which(qemu_args[0])
+    # Hashing the contents of the (multi-GB) disk image would take longer than the boot, so use the size and mtime.
+    # The snapshot refers to the disk image as the qcow2 backing file so the path must not change either.
+    for path in (qemu_binary, kernel_image.absolute(), disk_image.absolute()):
+        if path is not None:
+            st = os.stat(str(path))
+            hasher.update("{}:{}:{}\0".format(path, st.st_size, st.st_mtime_ns).encode("utf-8"))
+    return hasher.hexdigest()[:32]
+
+
+def _private_disk_image_path(disk_image: Path, keep: bool) -> Path:
+    result = disk_image.with_suffix(".img.runtests." + datetime.datetime.now().strftime("%Y%m%d%H%M%S") + ".pid" +
+                                    str(os.getpid()) + ".qcow2")
+    if not keep:
+        atexit.register(run_host_command, ["rm", "-fv", str(result)])
+    return result
+
+
+def _qemu_img_binary(qemu_command: str) -> str:
+    # Prefer the qemu-img that was built together with the QEMU binary
+    candidate = Path(shutil.which(qemu_command) or qemu_command).parent / "qemu-img"
+    if candidate.is_file():
+        return str(candidate)
+    result = shutil.which("qemu-img")
+    if result is None:
+        failure("Cannot find qemu-img, which is needed for --boot-snapshot-dir", exit=True)
+    return result
+
+
+def _save_boot_snapshot(child: QemuCheriBSDInstance) -> bool:
+    success("===> Saving boot snapshot")
+    # Switch from the serial console to the QEMU monitor (-nographic multiplexes both on stdio)
+    child.send("\x01c")
+    child.expect_exact_ignore_panic([QEMU_MONITOR_PROMPT], timeout=60)
+    child.sendline("savevm " + BOOT_SNAPSHOT_TAG)
+    child.expect_exact_ignore_panic([QEMU_MONITOR_PROMPT], timeout=15 * 60)
+    saved = "Error" not in child.before
+    if not saved:
+        failure("Could not save boot snapshot: ", child.before.strip(), exit=False)
+    child.sendline("quit")
+    child.expect_exact_ignore_panic([pexpect.EOF], timeout=60)
+    return saved
+
+
+def _boot_from_snapshot(snapshot_dir: Path, key: str, *, disk_image: Path, get_qemu_args, start_qemu,
+                        network_iface: typing.Optional[str],
+                        keep_disk_image_copy: bool) -> typing.Optional[QemuCheriBSDInstance]:
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    snapshot = snapshot_dir / (key + ".qcow2")
+    snapshot_info = snapshot_dir / (key + ".json")
+    unsupported_marker = snapshot_dir / (key + ".unsupported")
+    logfile_mode = "w"
+    with (snapshot_dir / (key + ".lock")).open("w") as lock:
+        # Only one of the jobs that run in parallel (e.g. the libc++ test shards) should create the snapshot, the
+        # other ones wait here and then restore the new snapshot.
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        if unsupported_marker.exists():
+            info("Saving a boot snapshot previously failed for this configuration (", unsupported_marker, ")")
+            return None
+        if not snapshot.exists():
+            info("No boot snapshot for this kernel and disk image found in ", snapshot_dir, ", booting normally")
+            tmp_snapshot = snapshot.with_suffix(".qcow2.tmp")
+            # The snapshot disk is a qcow2 overlay that stores the changes made to the disk image during boot and the
+            # saved VM state.
+            run_host_command([_qemu_img_binary(get_qemu_args(None)[0]), "create", "-q", "-f", "qcow2", "-F", "raw",
+                              "-b", str(disk_image.absolute()), str(tmp_snapshot)])
+            cold_boot_starttime = datetime.datetime.now()
+            child = start_qemu(get_qemu_args(tmp_snapshot, "qcow2"))
+            boot_and_login(child, starttime=cold_boot_starttime, network_iface=network_iface)
+            cold_boot_time = datetime.datetime.now() - cold_boot_starttime
+            if not _save_boot_snapshot(child):
+                unsupported_marker.touch()
+                tmp_snapshot.unlink()
+                return None
+            os.rename(str(tmp_snapshot), str(snapshot))
+            logfile_mode = "a"  # keep the output of the cold boot in the QEMU log
+            snapshot_info.write_text(json.dumps({"disk_image": str(disk_image.absolute()),
+                                                 "cold_boot_seconds": cold_boot_time.total_seconds()}))
+            success("===> Saved boot snapshot ", snapshot, " (cold boot took ", cold_boot_time, ")")
+    # The guest writes to the disk, so every run needs a private copy of the snapshot
+    restore_starttime = datetime.datetime.now()
+    disk_copy = _private_disk_image_path(disk_image, keep_disk_image_copy)
+    shutil.copyfile(str(snapshot), str(disk_copy))
+    child = start_qemu(get_qemu_args(disk_copy, "qcow2") + ["-loadvm", BOOT_SNAPSHOT_TAG], logfile_mode=logfile_mode)
+    # The restored guest is sitting at the shell prompt, so we just need a new prompt to continue.
+    child.sendline("")
+    try:
+        restored = child.expect_exact_ignore_panic([PEXPECT_PROMPT, pexpect.EOF], timeout=5 * 60) == 0
+    except pexpect.TIMEOUT:
+        restored = False
+    if not restored:
+        failure("Could not restore boot snapshot ", snapshot, ", deleting it", exit=False)
+        child.terminate(force=True)
+        snapshot.unlink()
+        return None
+    # The guest clock stopped when the snapshot was saved
+    child.run("date -u " + datetime.datetime.utcnow().strftime("%Y%m%d%H%M.%S"))
+    restore_time = datetime.datetime.now() - restore_starttime
+    try:
+        cold_boot_time = datetime.timedelta(seconds=json.loads(snapshot_info.read_text())["cold_boot_seconds"])
+        success("===> Restored boot snapshot in ", restore_time, " (cold boot took ", cold_boot_time, ", ",
+                "{:.1f}x faster)".format(cold_boot_time.total_seconds() / max(restore_time.total_seconds(), 0.001)))
+    except (OSError, ValueError, KeyError):
+        success("===> Restored boot snapshot in ", restore_time)
     return child
 
 
@@ -826,6 +1069,147 @@ def boot_and_login(child: CheriBSDSpawnMixin, *, starttime, kernel_init_only=Fal
     return
 
 
+# Archives smaller than this are always copied using a single stream
+PARALLEL_TRANSFER_MIN_SIZE = 16 * 1024 * 1024
+
+
+def guest_transfer_record_file(disk_image: Path) -> Path:
+    """
+    Returns the host file that records the archives and files that have been copied to a guest that uses disk_image
+    directly. Guests that boot from a per-run copy of the disk image or from a boot snapshot start from a clean disk
+    every time, so there is nothing to record for them.
+    """
+    return disk_image.with_name(disk_image.name + ".cheribuild-transfers.json")
+
+
+class GuestFileTransfer(object):
+    """
+    Copies test archives and files to the guest by streaming them into tar/cat processes running over SSH (no temporary
+    files on the host). All transfers share one ControlMaster connection, large archives can be split into multiple
+    parallel tar streams, and transfers that have already been done for the current disk image are skipped.
+    """
+
+    def __init__(self, qemu: QemuCheriBSDInstance, *, streams: int = 1):
+        self.qemu = qemu
+        self.streams = max(streams, 1)
+        # Maps the content hash of each transfer to a path from that transfer that has to exist in the guest for the
+        # record to be valid (it could have been extracted to a tmpfs).
+        self.records = dict()  # type: typing.Dict[str, str]
+        self.record_file = qemu.transfer_record_file
+        if self.record_file is not None and self.record_file.exists():
+            try:
+                self.records = json.loads(self.record_file.read_text(encoding="utf-8"))
+            except (OSError, ValueError) as e:
+                failure("Could not read guest transfer records from ", self.record_file, ": ", e, exit=False)
+        # This also starts the ControlMaster connection that is reused by all transfers:
+        check_records = "for f in {}; do [ -e \"$f\" ] && echo \"$f\"; done; true".format(
+            " ".join(shlex.quote(p) for p in sorted(set(self.records.values()))) or "/nonexistent")
+        if PRETEND:
+            print_cmd(self._ssh(check_records))
+            self.records = dict()
+        else:
+            result = self.qemu.run_command_via_ssh([check_records], stdout=subprocess.PIPE, use_controlmaster=True)
+            existing = set(result.stdout.decode("utf-8").splitlines())
+            self.records = {k: v for k, v in self.records.items() if v in existing}
+
+    def _ssh(self, remote_command: str) -> typing.List[str]:
+        return self.qemu.ssh_command([remote_command], use_controlmaster=True)
+
+    @staticmethod
+    def _content_hash(path: Path, target: str) -> str:
+        hasher = hashlib.sha256(target.encode("utf-8"))
+        _hash_file(path, hasher)
+        return hasher.hexdigest()
+
+    def _record_transfer(self, content_hash: str, existing_path: str):
+        self.records[content_hash] = existing_path
+        if self.record_file is not None and not PRETEND:
+            self.record_file.write_text(json.dumps(self.records, indent=2), encoding="utf-8")
+
+    def copy_archive(self, archive: Path, target_dir: str = "/"):
+        content_hash = self._content_hash(archive, target_dir)
+        if content_hash in self.records:
+            info("Not copying ", archive, " to the guest since it has already been extracted to ", target_dir)
+            return
+        starttime = time.time()
+        size = archive.stat().st_size
+        streams = self.streams if size >= PARALLEL_TRANSFER_MIN_SIZE else 1
+        extract_command = self._ssh("mkdir -p {dir} && tar xf - -C {dir}".format(dir=shlex.quote(target_dir)))
+        if streams == 1:
+            self._run_pipeline(["xz", "-dc", str(archive)], extract_command)
+        else:
+            self._copy_archive_in_parallel(archive, extract_command, streams)
+        # Use the first file from the archive to check whether the record is still valid
+        with tarfile.open(str(archive), mode="r|*") as tar:
+            first_file = next((member.name for member in tar if member.isfile()), ".")
+        self._record_transfer(content_hash, os.path.normpath(os.path.join(target_dir, first_file)))
+        success("Extracted ", archive, " (", round(size / 1024 / 1024, 1), " MiB) in the guest using ", streams,
+                " stream(s) in ", round(time.time() - starttime, 1), " seconds")
+
+    def copy_file(self, path: Path, target_path: str):
+        content_hash = self._content_hash(path, target_path)
+        if content_hash in self.records:
+            info("Not copying ", path, " to the guest since ", target_path, " is up-to-date")
+            return
+        quoted_target = shlex.quote(target_path)
+        command = self._ssh("mkdir -p {} && cat > {} && chmod {:o} {}".format(
+            shlex.quote(os.path.dirname(target_path)), quoted_target, path.stat().st_mode & 0o7777, quoted_target))
+        print_cmd(command)
+        if not PRETEND:
+            with path.open("rb") as f:
+                subprocess.check_call(command, stdin=f)
+        self._record_transfer(content_hash, target_path)
+
+    @staticmethod
+    def _run_pipeline(producer_cmd: typing.List[str], consumer_cmd: typing.List[str]):
+        print_cmd(producer_cmd + ["|"] + consumer_cmd)
+        if PRETEND:
+            return
+        producer = subprocess.Popen(producer_cmd, stdout=subprocess.PIPE)
+        consumer = subprocess.Popen(consumer_cmd, stdin=producer.stdout)
+        producer.stdout.close()  # ensure that the producer gets SIGPIPE if ssh exits early
+        consumer_status = consumer.wait()
+        producer_status = producer.wait()
+        if producer_status != 0:
+            raise subprocess.CalledProcessError(producer_status, producer_cmd)
+        if consumer_status != 0:
+            raise subprocess.CalledProcessError(consumer_status, consumer_cmd)
+
+    @staticmethod
+    def _copy_archive_in_parallel(archive: Path, extract_command: typing.List[str], streams: int):
+        info("Splitting ", archive, " into ", streams, " parallel streams")
+        for _ in range(streams):
+            print_cmd(extract_command)
+        if PRETEND:
+            return
+        processes = []  # type: typing.List[subprocess.Popen]
+        try:
+            for _ in range(streams):
+                processes.append(subprocess.Popen(extract_command, stdin=subprocess.PIPE))
+            outputs = [tarfile.open(fileobj=p.stdin, mode="w|", format=tarfile.PAX_FORMAT) for p in processes]
+            bytes_written = [0] * streams
+            member_streams = dict()  # type: typing.Dict[str, int]
+            with tarfile.open(str(archive), mode="r|*") as tar:
+                for member in tar:
+                    if member.islnk() and member.linkname in member_streams:
+                        # A hard link must be extracted by the same tar process as the file it links to
+                        index = member_streams[member.linkname]
+                    else:
+                        index = bytes_written.index(min(bytes_written))
+                    member_streams[member.name] = index
+                    outputs[index].addfile(member, tar.extractfile(member) if member.isfile() else None)
+                    bytes_written[index] += member.size + tarfile.BLOCKSIZE
+            for output in outputs:
+                output.close()
+        finally:
+            for p in processes:
+                p.stdin.close()
+                p.wait()
+        for p in processes:
+            if p.returncode != 0:
+                raise subprocess.CalledProcessError(p.returncode, extract_command)
+
+
 def _do_test_setup(qemu: QemuCheriBSDInstance, args: argparse.Namespace, test_archives: list,
                    test_ld_preload_files: list,
                    test_setup_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace], None]" = None):
@@ -850,26 +1234,14 @@ def _do_test_setup(qemu: QemuCheriBSDInstance, args: argparse.Namespace, test_ar
     qemu.run("df -ih")
     info("\nWill transfer the following archives: ", test_archives)
 
-    def do_scp(src, dst="/"):
-        # CVE-2018-20685 -> Can no longer use '.' See
-        # https://superuser.com/questions/1403473/scp-error-unexpected-filename
-        scp_cmd = ["scp", "-B", "-r", "-P", str(qemu.ssh_port), "-o", "StrictHostKeyChecking=no",
-                   "-o", "UserKnownHostsFile=/dev/null",
-                   "-i", str(qemu.ssh_private_key), str(src), "root@localhost:" + dst]
-        # use script for a fake tty to get progress output from scp
-        if sys.platform.startswith("linux"):
-            scp_cmd = ["script", "--quiet", "--return", "--command", " ".join(scp_cmd), "/dev/null"]
-        run_host_command(scp_cmd, cwd=str(src))
-
+    transfer = None
+    if not smb_dirs and (test_archives or test_ld_preload_files):
+        transfer = GuestFileTransfer(qemu, streams=args.transfer_streams)
     for archive in test_archives:
         if smb_dirs:
             run_host_command(["tar", "xJf", str(archive), "-C", str(smb_dirs[0].hostdir)])
         else:
-            # Extract to temporary directory and scp over
-            with tempfile.TemporaryDirectory(dir=os.getcwd(), prefix="test_files_") as tmp:
-                run_host_command(["tar", "xJf", str(archive), "-C", tmp])
-                run_host_command(["ls", "-la"], cwd=tmp)
-                do_scp(tmp)
+            transfer.copy_archive(Path(archive))
     ld_preload_target_paths = []
     for lib in test_ld_preload_files:
         assert isinstance(lib, Path)
@@ -878,8 +1250,7 @@ def _do_test_setup(qemu: QemuCheriBSDInstance, args: argparse.Namespace, test_ar
             run_host_command(["cp", "-v", str(lib.absolute()), str(smb_dirs[0].hostdir) + "/preload"])
             ld_preload_target_paths.append(str(Path(smb_dirs[0].in_target, "preload", lib.name)))
         else:
-            qemu.run("mkdir -p /tmp/preload")
-            do_scp(str(lib), "/tmp/preload/" + lib.name)
+            transfer.copy_file(lib, "/tmp/preload/" + lib.name)
             ld_preload_target_paths.append(str(Path("/tmp/preload", lib.name)))
 
     for index, d in enumerate(smb_dirs):
@@ -904,7 +1275,7 @@ def _do_test_setup(qemu: QemuCheriBSDInstance, args: argparse.Namespace, test_ar
 
     if test_archives:
         time.sleep(5)  # wait 5 seconds to make sure the disks have synced
-    # See how much space we have after running scp
+    # See how much space we have after copying the test files
     qemu.run("df -h")
     # ensure that /tmp is world-writable
     qemu.run("chmod 777 /tmp")
@@ -922,6 +1293,179 @@ def _do_test_setup(qemu: QemuCheriBSDInstance, args: argparse.Namespace, test_ar
         success("Additional test enviroment setup took ", datetime.datetime.now() - setup_tests_starttime)
 
 
+class GuestPool(object):
+    """
+    A set of CheriBSD guests that are booted (and set up for running tests) in parallel by one process. Instead of a
+    fixed split of the tests between the guests, each guest takes the next work item from a shared queue as soon as it
+    is idle, so a few slow tests no longer determine the total run time. run() is used for test suites that are driven
+    from this process (e.g. kyua and cheribsdtest) and serve_leases() hands out idle guests to external executors (for
+    lit). Test suites that consist of a single script running inside the guest (Juliet, BODiagSuite) still use one
+    guest since there is nothing to distribute.
+    """
+
+    def __init__(self, guests: "typing.List[QemuCheriBSDInstance]"):
+        assert guests, "Need at least one guest"
+        self.guests = guests
+        self._idle = queue.Queue()  # indices of the guests that are not leased
+        for i in range(len(guests)):
+            self._idle.put(i)
+
+    def __len__(self):
+        return len(self.guests)
+
+    @classmethod
+    def boot(cls, size: int, boot_guest: "typing.Callable[[int], QemuCheriBSDInstance]") -> "GuestPool":
+        """Calls boot_guest(index) for each of the guests in parallel and returns a pool of those that booted"""
+        guests = [None] * size  # type: typing.List[typing.Optional[QemuCheriBSDInstance]]
+        starttime = datetime.datetime.now()
+
+        def boot_one(index: int):
+            # noinspection PyBroadException
+            try:
+                guests[index] = boot_guest(index)
+                success("Guest ", index, " ready after ", datetime.datetime.now() - starttime)
+            except BaseException:  # failure() raises SystemExit
+                failure("Guest ", index, " failed to boot:\n", traceback.format_exc(), exit=False)
+
+        threads = [threading.Thread(target=boot_one, args=(i,), name="boot-guest-" + str(i)) for i in range(size)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        booted = [g for g in guests if g is not None]
+        if not booted:
+            failure("None of the ", size, " guests could be booted", exit=True)
+        success("Booted ", len(booted), " of ", size, " guests in ", datetime.datetime.now() - starttime)
+        return cls(booted)
+
+    def run(self, work_items: list, run_item: "typing.Callable[[QemuCheriBSDInstance, typing.Any], typing.Any]"):
+        """
+        Calls run_item(guest, item) for every work item on the next idle guest and returns the results in the order of
+        work_items. If a guest dies while running an item, the item is put back in the queue for the other guests and
+        its result is None if no guest is left to run it.
+        """
+        results = [None] * len(work_items)
+        pending = collections.deque(enumerate(work_items))
+        unfinished = [len(work_items)]
+        cond = threading.Condition()
+        busy_time = [datetime.timedelta()] * len(self.guests)
+        num_items = [0] * len(self.guests)
+        starttime = datetime.datetime.now()
+
+        def worker(guest_index: int):
+            guest = self.guests[guest_index]
+            while True:
+                with cond:
+                    # Wait while the remaining items are running on other guests since they might be requeued
+                    cond.wait_for(lambda: pending or not unfinished[0])
+                    if not pending:
+                        return
+                    index, item = pending.popleft()
+                item_start = datetime.datetime.now()
+                # noinspection PyBroadException
+                try:
+                    result = run_item(guest, item)
+                except BaseException:  # failure() raises SystemExit
+                    failure("Guest ", guest_index, " failed to run ", item, ":\n", traceback.format_exc(), exit=False)
+                    if not guest.isalive():
+                        failure("Guest ", guest_index, " died, running ", item, " on another guest", exit=False)
+                        with cond:
+                            pending.appendleft((index, item))
+                            cond.notify_all()
+                        return
+                    result = None
+                busy_time[guest_index] += datetime.datetime.now() - item_start
+                num_items[guest_index] += 1
+                with cond:
+                    results[index] = result
+                    unfinished[0] -= 1
+                    cond.notify_all()
+
+        threads = [threading.Thread(target=worker, args=(i,), name="guest-" + str(i))
+                   for i, guest in enumerate(self.guests) if guest.isalive()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if pending:
+            failure("No guest left to run ", len(pending), " of ", len(work_items), " work items", exit=False)
+        total_time = (datetime.datetime.now() - starttime).total_seconds() or 1
+        for i in range(len(self.guests)):
+            if num_items[i]:
+                info("Guest ", i, " ran ", num_items[i], " work items and was busy ",
+                     round(100 * busy_time[i].total_seconds() / total_time), "% of the time")
+        return results
+
+    @contextlib.contextmanager
+    def lease(self):
+        """Blocks until one of the guests is idle and yields its index. The guest is idle again afterwards."""
+        index = self._idle.get()
+        if index is None:
+            self._idle.put(None)  # wake up the other waiters as well
+            raise RuntimeError("All guests have died")
+        try:
+            yield index
+        finally:
+            if self.guests[index].isalive():
+                self._idle.put(index)
+            else:
+                failure("Guest ", index, " died, no longer using it", exit=False)
+                if not any(g.isalive() for g in self.guests):
+                    self._idle.put(None)
+
+    @contextlib.contextmanager
+    def serve_leases(self, socket_path: Path, guest_command: "typing.Callable[[int], typing.List[str]]"):
+        """
+        Listens on the UNIX socket socket_path while the context is active. For each client (see
+        test-scripts/guest_pool_executor.py) this waits for an idle guest and sends guest_command(index) as a JSON line.
+        The guest is leased until the client closes the connection (i.e. exits or is killed), so clients block instead
+        of polling for a free guest.
+        """
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(str(socket_path))
+        server.listen(64)
+
+        def handle(conn: socket.socket):
+            with conn:
+                try:
+                    with self.lease() as index:
+                        conn.sendall(json.dumps(guest_command(index)).encode("utf-8") + b"\n")
+                        while conn.recv(4096):
+                            pass
+                except (OSError, RuntimeError):
+                    pass  # client went away or no guests left, closing the connection tells it to fail
+
+        def accept_loop():
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except OSError:
+                    return  # socket was closed
+                threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+        accept_thread = threading.Thread(target=accept_loop, name="guest-pool-server", daemon=True)
+        accept_thread.start()
+        try:
+            yield
+        finally:
+            # shutdown() wakes up the thread blocked in accept()
+            try:
+                server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            server.close()
+            accept_thread.join(timeout=10)
+            try:
+                socket_path.unlink()
+            except OSError:
+                pass
+
+    def shutdown(self):
+        for guest in self.guests:
+            if guest.isalive():
+                guest.terminate(force=True)
+
+
 def runtests(qemu: QemuCheriBSDInstance, args: argparse.Namespace, test_archives: list, test_ld_preload_files: list,
              test_setup_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace], None]" = None,
              test_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace], bool]" = None) -> bool:
@@ -1002,9 +1546,15 @@ def get_argument_parser() -> argparse.ArgumentParser:
     parser.add_argument("--no-keep-compressed-images", action="store_false", dest="keep_compressed_images")
     parser.add_argument("--make-disk-image-copy", default=True, action="store_true",
                         help="Make a copy of the disk image before running tests")
-    parser.add_argument("--no-make-disk-image-copy", action="store_false", dest="disk_image_copy")
+    parser.add_argument("--no-make-disk-image-copy", action="store_false", dest="make_disk_image_copy")
     parser.add_argument("--keep-disk-image-copy", default=False, action="store_true",
                         help="Keep the copy of the disk image (if a copy was made)")
+    parser.add_argument("--guest-pool", type=int, default=1, metavar="N",
+                        help="Boot N guests and distribute the tests between them (only used by test scripts that "
+                             "support it, others boot one guest)")
+    parser.add_argument("--boot-snapshot-dir", type=Path, default=None, metavar="DIR",
+                        help="Save a QEMU snapshot after the first boot has reached the shell prompt in DIR and "
+                             "restore it instead of booting for subsequent runs with the same kernel and disk image")
     parser.add_argument("--trap-on-unrepresentable", action="store_true",
                         help="CHERI trap on unrepresentable caps instead of detagging")
     parser.add_argument("--ssh-key", default=default_ssh_key())
@@ -1020,6 +1570,8 @@ def get_argument_parser() -> argparse.ArgumentParser:
                         dest="smb_mount_directories", type=parse_smb_mount, default=[])
     parser.add_argument("--test-archive", "-t", action="append", nargs=1)
     parser.add_argument("--test-command", "-c")
+    parser.add_argument("--transfer-streams", type=int, default=4, metavar="N",
+                        help="Number of parallel SSH streams used to copy large test archives to the guest")
     parser.add_argument('--test-ld-preload', action="append", nargs=1, metavar='LIB',
                         help="Copy LIB to the guest andLD_PRELOAD it before running tests")
     parser.add_argument('--test-ld-preload-variable', type=str, default=None,
@@ -1049,7 +1601,8 @@ def get_argument_parser() -> argparse.ArgumentParser:
 def _main(test_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace], bool]" = None,
           test_setup_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace], None]" = None,
           argparse_setup_callback: "typing.Callable[[argparse.ArgumentParser], None]" = None,
-          argparse_adjust_args_callback: "typing.Callable[[argparse.Namespace], None]" = None):
+          argparse_adjust_args_callback: "typing.Callable[[argparse.Namespace], None]" = None,
+          pool_test_function: "typing.Callable[[GuestPool, argparse.Namespace], bool]" = None):
     parser = get_argument_parser()
     if argparse_setup_callback:
         argparse_setup_callback(parser)
@@ -1162,24 +1715,32 @@ def _main(test_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace]
         diskimg = maybe_decompress(Path(args.disk_image), force_decompression, keep_archive=keep_compressed_images,
                                    args=args, what="disk image")
 
-    # Allow running multiple jobs in parallel by making a copy of the disk image
-    if diskimg is not None and args.make_disk_image_copy:
-        assert isinstance(diskimg, Path)
-        str(os.getpid())
-        new_img = diskimg.with_suffix(
-            ".img.runtests." + datetime.datetime.now().strftime("%Y%m%d%H%M%S") + ".pid" + str(os.getpid()))
-        assert not new_img.exists()
-        run_host_command(["cp", "-fv", str(diskimg), str(new_img)])
-        if not args.keep_disk_image_copy:
-            atexit.register(run_host_command, ["rm", "-fv", str(new_img)])
-        diskimg = new_img
+    # Allow running multiple jobs in parallel by making a copy of the disk image (not needed for boot snapshots since
+    # those use a private qcow2 overlay for each job).
+    use_boot_snapshot = args.boot_snapshot_dir is not None and not args.test_kernel_init_only
+    if args.guest_pool > 1 and pool_test_function is not None and not args.test_kernel_init_only:
+        if args.interact:
+            failure("Cannot use --interact with --guest-pool", exit=True)
+        tests_okay = _run_tests_in_guest_pool(args, qemu_options, kernel, diskimg, use_boot_snapshot=use_boot_snapshot,
+                                              test_archives=test_archives, test_ld_preload_files=test_ld_preload_files,
+                                              test_setup_function=test_setup_function,
+                                              pool_test_function=pool_test_function)
+        _finish(starttime, tests_okay)
+        return
+    transfer_record_file = None
+    if diskimg is not None and args.make_disk_image_copy and not use_boot_snapshot:
+        diskimg = _make_disk_image_copy(diskimg, keep=args.keep_disk_image_copy)
+    elif diskimg is not None and not use_boot_snapshot:
+        transfer_record_file = guest_transfer_record_file(diskimg)
 
     boot_starttime = datetime.datetime.now()
     qemu = boot_cheribsd(qemu_options, qemu_command=args.qemu_cmd, kernel_image=kernel, disk_image=diskimg,
                          ssh_port=args.ssh_port, ssh_pubkey=Path(args.ssh_key), smb_dirs=args.smb_mount_directories,
                          kernel_init_only=args.test_kernel_init_only,
                          trap_on_unrepresentable=args.trap_on_unrepresentable, skip_ssh_setup=args.skip_ssh_setup,
-                         bios_path=args.bios)
+                         bios_path=args.bios, boot_snapshot_dir=args.boot_snapshot_dir if use_boot_snapshot else None,
+                         keep_disk_image_copy=args.keep_disk_image_copy)
+    qemu.transfer_record_file = transfer_record_file
     success("Booting CheriBSD took: ", datetime.datetime.now() - boot_starttime)
 
     tests_okay = True
@@ -1219,6 +1780,10 @@ def _main(test_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace]
             except KeyboardInterrupt:
                 continue
 
+    _finish(starttime, tests_okay)
+
+
+def _finish(starttime: datetime.datetime, tests_okay: bool):
     success("===> DONE")
     info("Total execution time: ", datetime.datetime.now() - starttime)
     if not tests_okay:
@@ -1226,15 +1791,86 @@ def _main(test_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace]
         sys.exit(2)  # different exit code for test failures
 
 
+def _make_disk_image_copy(diskimg: Path, *, keep: bool, suffix="") -> Path:
+    assert isinstance(diskimg, Path)
+    new_img = diskimg.with_suffix(
+        ".img.runtests." + datetime.datetime.now().strftime("%Y%m%d%H%M%S") + ".pid" + str(os.getpid()) + suffix)
+    assert not new_img.exists()
+    run_host_command(["cp", "-fv", str(diskimg), str(new_img)])
+    if not keep:
+        atexit.register(run_host_command, ["rm", "-fv", str(new_img)])
+    return new_img
+
+
+def _run_tests_in_guest_pool(args: argparse.Namespace, qemu_options: QemuOptions, kernel: Path,
+                             diskimg: typing.Optional[Path], *, use_boot_snapshot: bool, test_archives: list,
+                             test_ld_preload_files: list,
+                             test_setup_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace], None]",
+                             pool_test_function: "typing.Callable[[GuestPool, argparse.Namespace], bool]") -> bool:
+    # Reserve the SSH ports for all guests before booting them concurrently. Every socket stays bound until just
+    # before QEMU is started by the boot thread of that guest, so the guests (and other jobs) can't pick the same port.
+    global _SSH_SOCKET_PLACEHOLDER
+    with _SSH_SOCKET_PLACEHOLDER_LOCK:
+        ssh_ports = [SocketAndPort(_SSH_SOCKET_PLACEHOLDER, args.ssh_port)]
+        _SSH_SOCKET_PLACEHOLDER = None
+    ssh_ports.extend(find_free_port() for _ in range(1, args.guest_pool))
+
+    def boot_guest(index: int) -> QemuCheriBSDInstance:
+        ssh_port = ssh_ports[index]
+        guest_disk = diskimg
+        if diskimg is not None and not use_boot_snapshot:
+            guest_disk = _make_disk_image_copy(diskimg, keep=args.keep_disk_image_copy, suffix=".guest" + str(index))
+        if QEMU_LOGFILE:
+            logfile = QEMU_LOGFILE.with_name(QEMU_LOGFILE.stem + "-guest" + str(index) + QEMU_LOGFILE.suffix)
+        else:
+            logfile = Path(getattr(args, "build_dir", None) or os.getcwd(), "qemu-guest-" + str(index) + ".log")
+        info("Writing the output of guest ", index, " to ", logfile)
+        guest = boot_cheribsd(qemu_options, qemu_command=args.qemu_cmd, kernel_image=kernel, disk_image=guest_disk,
+                              ssh_port=ssh_port.port, ssh_pubkey=Path(args.ssh_key),
+                              smb_dirs=args.smb_mount_directories, trap_on_unrepresentable=args.trap_on_unrepresentable,
+                              skip_ssh_setup=args.skip_ssh_setup, bios_path=args.bios,
+                              boot_snapshot_dir=args.boot_snapshot_dir if use_boot_snapshot else None,
+                              keep_disk_image_copy=args.keep_disk_image_copy, qemu_logfile=logfile,
+                              ssh_port_placeholder=ssh_port.socket)
+        guest.EXIT_ON_KERNEL_PANIC = False  # don't exit from a worker thread
+        if not args.skip_ssh_setup:
+            setup_ssh_for_root_login(guest)
+        # Files on the shared SMB directories only need to be extracted once
+        archives = test_archives if index == 0 or not guest.smb_dirs else []
+        _do_test_setup(guest, args, archives, test_ld_preload_files, test_setup_function)
+        return guest
+
+    success("===> Booting ", args.guest_pool, " guests")
+    pool = GuestPool.boot(args.guest_pool, boot_guest)
+    try:
+        if args.test_environment_only:
+            success("Test environment set up. Skipping tests due to --test-environment-only")
+            return True
+        run_tests_starttime = datetime.datetime.now()
+        result = pool_test_function(pool, args)
+        info("Running tests on ", len(pool), " guests took: ", datetime.datetime.now() - run_tests_starttime)
+        return result
+    except KeyboardInterrupt:
+        failure("Got CTRL+C while running tests", exit=False)
+        return False
+    except Exception:
+        failure("FAILED to run tests!!\n", exit=False)
+        traceback.print_exc(file=sys.stderr)
+        return False
+    finally:
+        pool.shutdown()
+
+
 def main(test_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace], bool]" = None,
          test_setup_function: "typing.Callable[[CheriBSDInstance, argparse.Namespace], None]" = None,
          argparse_setup_callback: "typing.Callable[[argparse.ArgumentParser], None]" = None,
-         argparse_adjust_args_callback: "typing.Callable[[argparse.Namespace], None]" = None):
+         argparse_adjust_args_callback: "typing.Callable[[argparse.Namespace], None]" = None,
+         pool_test_function: "typing.Callable[[GuestPool, argparse.Namespace], bool]" = None):
     # Some programs (such as QEMU) can mess up the TTY state if they don't exit cleanly
     with keep_terminal_sane():
         _main(test_function=test_function, test_setup_function=test_setup_function,
               argparse_setup_callback=argparse_setup_callback,
-              argparse_adjust_args_callback=argparse_adjust_args_callback)
+              argparse_adjust_args_callback=argparse_adjust_args_callback, pool_test_function=pool_test_function)
 
 
 if __name__ == "__main__":
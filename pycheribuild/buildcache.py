@@ -0,0 +1,270 @@
+# -
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import datetime
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import typing
+from pathlib import Path
+
+from .utils import status_update, warning_message
+
+__all__ = ["BuildArtifactCache", "ArtifactCacheEntry", "InstallTreeSnapshot"]  # no-combine
+
+
+class InstallTreeSnapshot(object):
+    """
+    Records (size, mtime) of all files below a set of install roots so that we can determine which files were added or
+    modified by the install step.
+    """
+
+    def __init__(self, roots: "typing.List[Path]"):
+        self.roots = roots
+        self._state = [self._scan(root) for root in roots]
+
+    @staticmethod
+    def _scan(root: Path) -> "typing.Dict[str, typing.Tuple[int, int]]":
+        result = dict()
+        if not root.is_dir():
+            return result
+        root_str = str(root)
+        for dirpath, dirnames, filenames in os.walk(root_str):
+            relpath = os.path.relpath(dirpath, root_str)
+            # Only newly created directories matter (modification times change whenever a file is added)
+            for name in dirnames:
+                result[os.path.normpath(os.path.join(relpath, name))] = (-1, 0)
+            for name in filenames:
+                try:
+                    st = os.lstat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                result[os.path.normpath(os.path.join(relpath, name))] = (st.st_size, st.st_mtime_ns)
+        return result
+
+    def changed_files(self) -> "typing.List[typing.List[str]]":
+        """:return: for each root the sorted list of paths that were added or modified since the snapshot was taken"""
+        result = []
+        for old_state, root in zip(self._state, self.roots):
+            new_state = self._scan(root)
+            result.append(sorted(k for k, v in new_state.items() if old_state.get(k) != v))
+        return result
+
+
+def _check_relative_path(path: str, member: tarfile.TarInfo) -> None:
+    path = os.path.normpath(path)
+    if os.path.isabs(path) or path == os.path.pardir or path.startswith(os.path.pardir + os.path.sep):
+        raise ValueError("archive member " + repr(member.name) + " refers to a path outside the install root")
+
+
+def _check_archive_members(members: "typing.List[tarfile.TarInfo]") -> None:
+    """Ensure that the archive only contains files/directories/links below the install root."""
+    for member in members:
+        _check_relative_path(member.name, member)
+        if member.islnk():
+            _check_relative_path(member.linkname, member)
+        elif member.issym():
+            # Absolute symlinks are resolved relative to the sysroot/rootfs, relative ones must not escape from it
+            if not os.path.isabs(member.linkname):
+                _check_relative_path(os.path.join(os.path.dirname(member.name), member.linkname), member)
+        elif not member.isfile() and not member.isdir():
+            raise ValueError("archive member " + repr(member.name) + " has an unsupported file type")
+
+
+def _extract_archive(tar: tarfile.TarFile, root: Path) -> None:
+    real_root = os.path.realpath(str(root))
+    for member in tar.getmembers():
+        dest = os.path.join(real_root, os.path.normpath(member.name))
+        # Never write through a symlink (either an existing one or one that was created by a previous member)
+        parent = os.path.realpath(os.path.dirname(dest))
+        if parent != real_root and not parent.startswith(real_root + os.path.sep):
+            raise ValueError("archive member " + repr(member.name) + " would be extracted outside " + real_root)
+        if not member.isdir() and os.path.islink(dest):
+            os.unlink(dest)
+        if hasattr(tarfile, "fully_trusted_filter"):
+            # The members have already been validated, so don't let the default filter reject absolute symlinks
+            tar.extract(member, real_root, filter="fully_trusted")
+        else:
+            tar.extract(member, real_root)
+
+
+class ArtifactCacheEntry(object):
+    def __init__(self, path: Path, metadata: dict):
+        self.path = path
+        self.metadata = metadata
+
+    @property
+    def key(self) -> str:
+        return self.path.name
+
+    @property
+    def size(self) -> int:
+        return self.metadata.get("size", 0)
+
+    @property
+    def last_used(self) -> float:
+        try:
+            return (self.path / BuildArtifactCache.metadata_name).stat().st_mtime
+        except OSError:
+            return 0
+
+    def __repr__(self):
+        return "<ArtifactCacheEntry " + self.key + " (" + self.metadata.get("target", "?") + ")>"
+
+
+class BuildArtifactCache(object):
+    """
+    A directory-based cache (that can be shared e.g. via NFS) for the files installed by a project.
+    Entries are keyed on a hash of everything that affects the build output (see Project.artifact_cache_key()) and
+    contain one tarball for each install root with the files that were added or modified by the install step.
+    The least recently used entries are removed once the total size exceeds max_size.
+    """
+    metadata_name = "entry.json"
+
+    def __init__(self, cache_dir: Path, max_size: int, *, pretend=False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.pretend = pretend
+
+    def _entry_dir(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / key
+
+    def lookup(self, key: str) -> "typing.Optional[ArtifactCacheEntry]":
+        entry_dir = self._entry_dir(key)
+        try:
+            with (entry_dir / self.metadata_name).open("r", encoding="utf-8") as f:
+                return ArtifactCacheEntry(entry_dir, json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    def restore(self, key: str, install_roots: "typing.List[Path]") -> bool:
+        entry = self.lookup(key)
+        if entry is None:
+            return False
+        if len(entry.metadata.get("roots", [])) != len(install_roots):
+            warning_message("Ignoring artifact cache entry", entry.path, "since the number of install roots differs")
+            return False
+        status_update("Restoring", entry.metadata.get("num_files", "?"), "files from artifact cache entry",
+                      entry.path)
+        if self.pretend:
+            return True
+        archives = []
+        try:
+            for i, root in enumerate(install_roots):
+                archive = entry.path / ("root" + str(i) + ".tar")
+                if archive.exists():
+                    with tarfile.open(str(archive), "r") as tar:
+                        _check_archive_members(tar.getmembers())
+                    archives.append((archive, root))
+            for archive, root in archives:
+                os.makedirs(str(root), exist_ok=True)
+                with tarfile.open(str(archive), "r") as tar:
+                    _extract_archive(tar, root)
+        except (OSError, tarfile.TarError, ValueError) as e:
+            warning_message("Could not restore artifact cache entry", entry.path, e)
+            return False
+        # Update the modification time of the metadata file to track the last use for the LRU eviction
+        os.utime(str(entry.path / self.metadata_name))
+        return True
+
+    def store(self, key: str, install_roots: "typing.List[Path]", files_per_root: "typing.List[typing.List[str]]",
+              metadata: dict) -> None:
+        if self.pretend:
+            return
+        os.makedirs(str(self.cache_dir), exist_ok=True)
+        # Write the entry to a temporary directory first and then rename it so that concurrent users of the cache
+        # never see a partially written entry.
+        tmpdir = Path(tempfile.mkdtemp(prefix=".tmp-" + key + "-", dir=str(self.cache_dir)))
+        try:
+            size = 0
+            for i, (root, files) in enumerate(zip(install_roots, files_per_root)):
+                if not files:
+                    continue
+                archive = tmpdir / ("root" + str(i) + ".tar")
+                with tarfile.open(str(archive), "w") as tar:
+                    for f in files:
+                        tar.add(str(root / f), arcname=f, recursive=False)
+                size += archive.stat().st_size
+            metadata = dict(metadata, size=size, num_files=sum(len(x) for x in files_per_root),
+                            roots=[str(r) for r in install_roots], created=time.time())
+            with (tmpdir / self.metadata_name).open("w", encoding="utf-8") as f:
+                json.dump(metadata, f, indent=2)
+            entry_dir = self._entry_dir(key)
+            os.makedirs(str(entry_dir.parent), exist_ok=True)
+            # Entries with the same key have the same contents, so if another cheribuild process (possibly on a
+            # different machine sharing the cache) already added this key we can keep the existing entry.
+            if entry_dir.exists():
+                status_update("Artifact cache entry", key, "already exists, not replacing it")
+                return
+            try:
+                os.rename(str(tmpdir), str(entry_dir))
+            except OSError as e:
+                warning_message("Could not add artifact cache entry ", key, " (probably added concurrently by "
+                                "another build): ", e, sep="")
+                return
+            status_update("Added", metadata["num_files"], "files (", size // 1024, "KiB) to artifact cache as", key)
+        finally:
+            if tmpdir.exists():
+                shutil.rmtree(str(tmpdir), ignore_errors=True)
+        self.evict()
+
+    def entries(self) -> "typing.List[ArtifactCacheEntry]":
+        """:return: all cache entries, sorted from most recently used to least recently used"""
+        result = []
+        if not self.cache_dir.is_dir():
+            return result
+        for metadata_file in self.cache_dir.glob("*/*/" + self.metadata_name):
+            entry = self.lookup(metadata_file.parent.name)
+            if entry is not None:
+                result.append(entry)
+        return sorted(result, key=lambda e: e.last_used, reverse=True)
+
+    def evict(self, max_size: int = None) -> "typing.List[ArtifactCacheEntry]":
+        """Remove the least recently used entries until the total size is below max_size"""
+        if max_size is None:
+            max_size = self.max_size
+        total = 0
+        removed = []
+        for entry in self.entries():
+            total += entry.size
+            if total > max_size:
+                removed.append(entry)
+        for entry in removed:
+            status_update("Evicting artifact cache entry", entry.key, "for", entry.metadata.get("target"))
+            if not self.pretend:
+                shutil.rmtree(str(entry.path), ignore_errors=True)
+        return removed
+
+    def print_entries(self) -> None:
+        entries = self.entries()
+        total = sum(e.size for e in entries)
+        print("Artifact cache", self.cache_dir, "contains", len(entries), "entries using", total // (1024 * 1024),
+              "MiB (limit:", self.max_size // (1024 * 1024), "MiB)")
+        for entry in entries:
+            last_used = datetime.datetime.fromtimestamp(entry.last_used).strftime("%Y-%m-%d %H:%M:%S")
+            print("  ", entry.key[:16], entry.metadata.get("target", "?"), entry.metadata.get("revision", "?")[:12],
+                  str(entry.size // 1024) + " KiB", "last used", last_used)
@@ -0,0 +1,246 @@
+# -
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import json
+import lzma
+import queue
+import re
+import shutil
+import subprocess
+import threading
+import typing
+from pathlib import Path
+
+from .colour import AnsiColour, coloured
+from .utils import status_update, warning_message
+
+__all__ = ["BuildLogWriter", "rotate_build_logs", "print_build_log_errors", "LOG_COMPRESSION_SUFFIXES"]  # no-combine
+
+LOG_COMPRESSION_SUFFIXES = {"none": "", "xz": ".xz", "zstd": ".zst"}
+_INDEX_SUFFIX = ".errors.json"
+_ROTATED_SUFFIXES = tuple(LOG_COMPRESSION_SUFFIXES.values()) + (_INDEX_SUFFIX,)
+_MAX_INDEX_ENTRIES = 1000
+_MAX_INDEXED_LINE_LENGTH = 500
+_ERROR_OR_WARNING_REGEX = re.compile(
+    br"(?P<error>\berror:|\*\*\* |\bFAILED: |\bCMake Error\b|\bTraceback \(most recent call last\))|"
+    br"(?P<warning>\bwarning:|\bCMake Warning\b)")
+
+
+class _ZstdProcessCompressor(object):
+    """Fallback for when the zstandard module is not installed: pipe the log through the zstd program"""
+
+    def __init__(self, output: "typing.IO"):
+        self._proc = subprocess.Popen(["zstd", "-q", "-c"], stdin=subprocess.PIPE, stdout=output)
+
+    def compress(self, data: bytes) -> bytes:
+        self._proc.stdin.write(data)
+        return b""
+
+    def flush(self) -> bytes:
+        self._proc.stdin.close()
+        if self._proc.wait() != 0:
+            warning_message("zstd exited with status", self._proc.returncode, "while compressing the build log")
+        return b""
+
+
+def _create_compressor(compression: str, output: "typing.IO"):
+    if compression == "xz":
+        return lzma.LZMACompressor()
+    assert compression == "zstd", "Invalid compression " + compression
+    try:
+        # noinspection PyUnresolvedReferences
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    except ImportError:
+        if not shutil.which("zstd"):
+            raise ValueError("--log-compression=zstd requires the zstandard python module or the zstd program")
+        return _ZstdProcessCompressor(output)
+
+
+class BuildLogWriter(object):
+    """
+    A write-only file object for build logs that optionally compresses the output and records the (uncompressed) offset
+    and line number of all errors and warnings in a small JSON index next to the log. The index allows
+    --show-log-errors to display failures without having to decompress and search the whole log.
+    Compression happens in a separate thread so that it does not delay reading the build output.
+    """
+
+    def __init__(self, logfile: Path, *, compression: str = "none", append: bool = False):
+        self.path = logfile.with_name(logfile.name + LOG_COMPRESSION_SUFFIXES[compression])
+        self.name = str(self.path)
+        self.index_path = logfile.with_name(logfile.name + _INDEX_SUFFIX)
+        self._offset = 0
+        self._line = 1
+        self._entries = []  # type: typing.List[dict]
+        self._counts = {"error": 0, "warning": 0}
+        if append:
+            self._load_index()
+        self._file = self.path.open("ab" if append else "wb")
+        self._compressor = None
+        self._queue = None  # type: typing.Optional[queue.Queue]
+        self._thread = None  # type: typing.Optional[threading.Thread]
+        self._compression_error = None  # type: typing.Optional[BaseException]
+        if compression != "none":
+            self._compressor = _create_compressor(compression, self._file)
+            self._queue = queue.Queue(maxsize=64)
+            self._thread = threading.Thread(target=self._compress_queued_data, daemon=True)
+            self._thread.start()
+
+    def _load_index(self):
+        try:
+            with self.index_path.open("r", encoding="utf-8") as f:
+                index = json.load(f)
+            if index.get("log") == self.path.name:
+                self._offset = index["size"]
+                self._line = index["lines"] + 1
+                self._entries = index["entries"]
+                self._counts = index["counts"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _compress_queued_data(self):
+        try:
+            while True:
+                data = self._queue.get()
+                if data is None:
+                    self._file.write(self._compressor.flush())
+                    return
+                self._file.write(self._compressor.compress(data))
+        except BaseException as e:
+            self._compression_error = e
+            # Keep draining the queue so that write() and close() never block on the bounded queue
+            while self._queue.get() is not None:
+                pass
+
+    def _check_compression_error(self):
+        # Re-raise errors from the compression thread in the writing thread (but only once)
+        error, self._compression_error = self._compression_error, None
+        if error is not None:
+            raise error
+
+    def _index_errors_and_warnings(self, data: bytes):
+        line = self._line
+        last_pos = 0
+        for match in _ERROR_OR_WARNING_REGEX.finditer(data):
+            start = data.rfind(b"\n", 0, match.start()) + 1
+            if start < last_pos:
+                continue  # Only record the first match per line
+            end = data.find(b"\n", match.end())
+            if end == -1:
+                end = len(data)
+            line += data.count(b"\n", last_pos, start)
+            last_pos = end
+            kind = match.lastgroup
+            self._counts[kind] += 1
+            if len(self._entries) < _MAX_INDEX_ENTRIES:
+                text = data[start:min(end, start + _MAX_INDEXED_LINE_LENGTH)].decode("utf-8", errors="replace")
+                self._entries.append({"kind": kind, "line": line, "offset": self._offset + start, "text": text})
+        self._line += data.count(b"\n")
+        self._offset += len(data)
+
+    def write(self, data: bytes) -> int:
+        self._index_errors_and_warnings(data)
+        if self._queue is not None:
+            self._check_compression_error()
+            self._queue.put(data)
+        else:
+            self._file.write(data)
+        return len(data)
+
+    def flush(self):
+        if self._queue is None:
+            self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+        self._file.close()
+        index = {"log": self.path.name, "size": self._offset, "lines": self._line - 1, "counts": self._counts,
+                 "entries": self._entries}
+        with self.index_path.open("w", encoding="utf-8") as f:
+            json.dump(index, f)
+        self._check_compression_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _numbered_log_path(logfile: Path, number: int) -> Path:
+    if number == 0:
+        return logfile
+    return logfile.with_name(logfile.stem + "." + str(number) + logfile.suffix)
+
+
+def rotate_build_logs(logfile: Path, keep: int):
+    """
+    Rename <name>.log to <name>.1.log, <name>.1.log to <name>.2.log, etc. (including compressed logs and indices)
+    and delete the logs that exceed the limit of keep logs (including the new one).
+    """
+    for number in reversed(range(max(keep, 1))):
+        for suffix in _ROTATED_SUFFIXES:
+            path = _numbered_log_path(logfile, number)
+            path = path.with_name(path.name + suffix)
+            if not path.is_file():
+                continue
+            if number + 1 >= keep:
+                path.unlink()
+            else:
+                new_path = _numbered_log_path(logfile, number + 1)
+                path.rename(new_path.with_name(new_path.name + suffix))
+
+
+def print_build_log_errors(build_dir: Path, max_entries: int = 50) -> int:
+    """Print the errors (and warnings if there are no errors) recorded in the indices of the latest logs"""
+    indices = [p for p in build_dir.glob("*.log" + _INDEX_SUFFIX)
+               if not re.search(r"\.\d+\.log" + re.escape(_INDEX_SUFFIX) + "$", p.name)]
+    if not indices:
+        warning_message("Could not find any build log indices in", build_dir, "(was --logfile set?)")
+        return 0
+    total_errors = 0
+    for index_path in sorted(indices, key=lambda p: p.stat().st_mtime):
+        try:
+            with index_path.open("r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            warning_message("Could not read", index_path, e)
+            continue
+        counts = index["counts"]
+        total_errors += counts["error"]
+        status_update(build_dir / index["log"], "contains", counts["error"], "errors and", counts["warning"],
+                      "warnings")
+        kind = "error" if counts["error"] else "warning"
+        colour = AnsiColour.red if kind == "error" else AnsiColour.magenta
+        entries = [e for e in index["entries"] if e["kind"] == kind]
+        for entry in entries[:max_entries]:
+            print(coloured(colour, "  line " + str(entry["line"]) + " (offset " + str(entry["offset"]) + "):"),
+                  entry["text"])
+        if len(entries) > max_entries:
+            print("  ...", len(entries) - max_entries, "more")
+    return total_errors
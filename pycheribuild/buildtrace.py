@@ -0,0 +1,177 @@
+# -
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import typing
+from collections import OrderedDict
+from pathlib import Path
+
+from .utils import status_update, warning_message
+
+__all__ = ["BuildTrace", "get_build_trace"]  # no-combine
+
+
+def _max_rss_mib(usage) -> float:
+    # ru_maxrss is in KiB on Linux/FreeBSD but in bytes on macOS
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+class BuildTrace(object):
+    """
+    Records the duration of every target, its build phases (update/clean/configure/compile/install) and the commands
+    that were run. The events use the Chrome trace event format (https://docs.google.com/document/d/
+    1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU) so the file written by write() can be opened in chrome://tracing
+    or https://ui.perfetto.dev.
+    """
+
+    def __init__(self):
+        self.events = []  # type: typing.List[dict]
+        self._lock = threading.Lock()  # some targets run build steps on multiple threads
+
+    @contextlib.contextmanager
+    def span(self, name: str, category: str, **args):
+        """
+        Records the wall time of the body as well as the CPU time of the child processes that exited during that time.
+        The peak RSS is only known if a child process used more memory than all previously terminated children.
+        """
+        start = time.time()
+        usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield
+        finally:
+            end = time.time()
+            usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            args["user_cpu_seconds"] = round(usage_after.ru_utime - usage_before.ru_utime, 3)
+            args["system_cpu_seconds"] = round(usage_after.ru_stime - usage_before.ru_stime, 3)
+            if usage_after.ru_maxrss > usage_before.ru_maxrss:
+                args["peak_child_rss_mib"] = round(_max_rss_mib(usage_after), 1)
+            self.add_event(dict(name=name, cat=category, ph="X", ts=int(start * 1000000),
+                                dur=int((end - start) * 1000000), pid=os.getpid(), tid=threading.get_ident(),
+                                args=args))
+
+    def add_event(self, event: dict):
+        with self._lock:
+            self.events.append(event)
+
+    def clear(self):
+        with self._lock:
+            self.events.clear()
+
+    def load_events(self, path: Path):
+        """Adds the events written by a child process (--parallel-targets)"""
+        try:
+            with path.open("r", encoding="utf-8") as f:
+                events = json.load(f)["traceEvents"]
+        except (OSError, ValueError, KeyError) as e:
+            warning_message("Could not read build trace", path, e)
+            return
+        with self._lock:
+            self.events.extend(events)
+
+    def write(self, path: Path, process_name: str = "cheribuild"):
+        with self._lock:
+            events = list(self.events)
+        # Targets built with --parallel-targets run in a separate process, name that process after the target
+        process_names = OrderedDict([(os.getpid(), process_name)])
+        for event in events:
+            if event["cat"] == "target" and event["pid"] != os.getpid():
+                process_names[event["pid"]] = event["name"]
+        metadata = [dict(name="process_name", ph="M", pid=pid, args=dict(name=name))
+                    for pid, name in process_names.items()]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(dict(traceEvents=metadata + events, displayTimeUnit="ms"), f)
+        os.replace(str(tmp), str(path))
+
+    def target_durations(self) -> "typing.Dict[str, float]":
+        result = OrderedDict()
+        for event in sorted(self.events, key=lambda e: e["ts"]):
+            if event["cat"] == "target":
+                result[event["name"]] = result.get(event["name"], 0.0) + event["dur"] / 1000000
+        return result
+
+    def critical_path(self, dependencies: "typing.Dict[str, typing.List[str]]") -> "typing.List[str]":
+        """
+        :param dependencies: the targets that had to complete before each target could start (in build order)
+        :return: the chain of dependent targets with the longest total duration
+        """
+        durations = self.target_durations()
+        finish = dict()  # type: typing.Dict[str, float]
+        predecessor = dict()  # type: typing.Dict[str, typing.Optional[str]]
+        for target, deps in dependencies.items():
+            if target not in durations:
+                continue
+            slowest_dep = max((d for d in deps if d in finish), key=lambda d: finish[d], default=None)
+            predecessor[target] = slowest_dep
+            finish[target] = durations[target] + (finish[slowest_dep] if slowest_dep else 0.0)
+        if not finish:
+            return []
+        path = [max(finish, key=lambda t: finish[t])]
+        while predecessor[path[-1]] is not None:
+            path.append(predecessor[path[-1]])
+        return list(reversed(path))
+
+    def print_summary(self, dependencies: "typing.Dict[str, typing.List[str]]", max_targets=10):
+        target_events = [e for e in self.events if e["cat"] == "target"]
+        if not target_events:
+            return
+        wall_time = (max(e["ts"] + e["dur"] for e in target_events) - min(e["ts"] for e in target_events)) / 1000000
+        durations = self.target_durations()
+        critical_path = self.critical_path(dependencies)
+        status_update("Build time summary: wall time {:.1f}s, critical path {:.1f}s".format(
+            wall_time, sum(durations[t] for t in critical_path)))
+        phases = OrderedDict()  # type: typing.Dict[str, typing.Dict[str, float]]
+        cpu_time = dict()  # type: typing.Dict[str, float]
+        for event in self.events:
+            target = event["args"].get("target")
+            if event["cat"] == "phase" and target is not None:
+                target_phases = phases.setdefault(target, OrderedDict())
+                target_phases[event["name"]] = target_phases.get(event["name"], 0.0) + event["dur"] / 1000000
+            elif event["cat"] == "target":
+                cpu_time[event["name"]] = cpu_time.get(event["name"], 0.0) + event["args"]["user_cpu_seconds"] + \
+                    event["args"]["system_cpu_seconds"]
+        slowest = sorted(durations, key=lambda t: durations[t], reverse=True)[:max_targets]
+        width = max(len(t) for t in slowest)
+        for target in slowest:
+            details = ", ".join("{} {:.1f}s".format(k, v) for k, v in phases.get(target, {}).items())
+            status_update("  {}{:>9.1f}s  (CPU {:.1f}s{})".format(target.ljust(width), durations[target],
+                                                                  cpu_time.get(target, 0.0),
+                                                                  "; " + details if details else ""))
+        if len(durations) > len(slowest):
+            status_update("  ... and", len(durations) - len(slowest), "more targets")
+        status_update("Critical path:", " -> ".join("{} ({:.1f}s)".format(t, durations[t]) for t in critical_path))
+
+
+_build_trace = BuildTrace()
+
+
+def get_build_trace() -> BuildTrace:
+    return _build_trace
@@ -0,0 +1,215 @@
+# -
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import hashlib
+import json
+import shutil
+import subprocess
+import typing
+from collections import namedtuple
+from pathlib import Path
+
+from .config.chericonfig import CheriConfig
+from .processutils import run_command
+from .utils import status_update, warning_message
+
+__all__ = ["CompilerCache", "CompilerCacheStats"]  # no-combine
+
+
+class CompilerCacheStats(namedtuple("CompilerCacheStats", ["hits", "misses", "uncacheable"])):
+    __slots__ = ()
+
+    def __str__(self):
+        cacheable = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / cacheable if cacheable else 0.0
+        return "{} hits, {} misses ({:.1f}% hit rate), {} uncacheable".format(
+            self.hits, self.misses, hit_rate, self.uncacheable)
+
+
+class CompilerCache(object):
+    """
+    A compiler launcher (ccache or sccache) that stores its cache in a directory managed by cheribuild.
+
+    Every target records its compilations in a separate statistics file so that the hit rate can be reported per
+    target (ccache writes one entry per compiler invocation to CCACHE_STATSLOG, which also works when targets are
+    built concurrently with --parallel-targets; for sccache we compare the server counters before and after).
+    Since the sccache server counters are global, the per-target sccache statistics also include the compilations of
+    all other targets that were built at the same time and are only accurate without --parallel-targets.
+    """
+    KINDS = ("ccache", "sccache")
+    _CCACHE_HITS = frozenset(("direct_cache_hit", "preprocessed_cache_hit"))
+
+    def __init__(self, kind: str, executable: Path, *, cache_dir: Path, max_size: str, base_dir: Path,
+                 stats_dir: Path, config: CheriConfig):
+        assert kind in self.KINDS, kind
+        self.kind = kind
+        self.executable = executable
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.base_dir = base_dir
+        self.stats_dir = stats_dir
+        self.config = config
+
+    @classmethod
+    def from_config(cls, config: CheriConfig) -> "typing.Optional[CompilerCache]":
+        if config.compiler_cache == "none":
+            return None
+        executable = shutil.which(config.compiler_cache)
+        return cls(config.compiler_cache, Path(executable or config.compiler_cache),
+                   cache_dir=config.compiler_cache_dir, max_size=config.compiler_cache_max_size,
+                   base_dir=config.source_root, stats_dir=config.build_root / "cheribuild-logs/compiler-cache",
+                   config=config)
+
+    def statistics_file(self, target_name: str) -> Path:
+        return self.stats_dir / (target_name + ".json")
+
+    def _ccache_stats_log(self, target_name: str) -> Path:
+        return self.stats_dir / (target_name + ".ccache-stats.log")
+
+    @property
+    def sccache_server_port(self) -> int:
+        """
+        The port of the sccache server used by cheribuild. A server that is already running ignores SCCACHE_DIR and
+        SCCACHE_CACHE_SIZE, so we use a separate server (instead of the default one on port 4226) for every cache
+        directory and size. This also avoids counting compilations of unrelated builds in the statistics.
+        """
+        digest = hashlib.sha1((str(self.cache_dir) + "\0" + self.max_size).encode("utf-8")).hexdigest()
+        return 10000 + int(digest[:8], 16) % 20000
+
+    def _sccache_env(self) -> "typing.Dict[str, str]":
+        return dict(SCCACHE_DIR=str(self.cache_dir), SCCACHE_CACHE_SIZE=self.max_size,
+                    SCCACHE_SERVER_PORT=str(self.sccache_server_port))
+
+    def env_vars(self, target_name: str) -> "typing.Dict[str, str]":
+        if self.kind == "sccache":
+            return self._sccache_env()
+        # CCACHE_BASEDIR rewrites absolute paths below the source root so that e.g. different worktrees share entries
+        result = dict(CCACHE_DIR=str(self.cache_dir), CCACHE_MAXSIZE=self.max_size, CCACHE_BASEDIR=str(self.base_dir))
+        if not self.config.pretend:
+            result["CCACHE_STATSLOG"] = str(self._ccache_stats_log(target_name))
+        return result
+
+    def start_server(self):
+        """
+        Starts the sccache server on sccache_server_port unless it is already running (e.g. for another cheribuild
+        process that uses the same cache). Servers on other ports (such as the default one) are not affected.
+        """
+        if self.kind != "sccache" or self.config.pretend:
+            return
+        # Don't capture the output since the background server process could keep the pipe open. --start-server
+        # fails if the server is already running, so we ignore the exit code.
+        try:
+            run_command([self.executable, "--start-server"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                        print_verbose_only=True, allow_unexpected_returncode=True, env=self._sccache_env(),
+                        config=self.config)
+        except OSError as e:
+            warning_message("Could not start the sccache server:", e)
+
+    def begin_target(self, target_name: str) -> "typing.Optional[CompilerCacheStats]":
+        """Discards the statistics of a previous build of target_name. The result must be passed to end_target()."""
+        if self.config.pretend:
+            return None
+        self.stats_dir.mkdir(parents=True, exist_ok=True)
+        for path in (self.statistics_file(target_name), self._ccache_stats_log(target_name)):
+            if path.exists():
+                path.unlink()
+        if self.kind == "sccache":
+            return self._sccache_counters(target_name)
+        return None
+
+    def end_target(self, target_name: str, baseline: "typing.Optional[CompilerCacheStats]"):
+        if self.config.pretend:
+            return
+        if self.kind == "ccache":
+            stats = self._parse_ccache_stats_log(self._ccache_stats_log(target_name))
+        else:
+            current = self._sccache_counters(target_name)
+            if current is None or baseline is None:
+                return
+            stats = CompilerCacheStats(*(c - b for c, b in zip(current, baseline)))
+        if stats is not None:
+            self.statistics_file(target_name).write_text(json.dumps(stats._asdict()))
+
+    def _parse_ccache_stats_log(self, path: Path) -> "typing.Optional[CompilerCacheStats]":
+        if not path.exists():
+            return None  # Either nothing was compiled or ccache is older than 4.0 and does not support stats_log
+        counts = [0, 0, 0]
+
+        def add_result(results: "typing.Set[str]"):
+            if results & self._CCACHE_HITS:
+                counts[0] += 1
+            elif "cache_miss" in results:
+                counts[1] += 1
+            else:
+                counts[2] += 1  # e.g. called_for_link, called_for_preprocessing, compile_failed
+
+        # The log contains a "# <input file>" line for every invocation followed by the result counters
+        results = None  # type: typing.Optional[typing.Set[str]]
+        with path.open("r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("#"):
+                    if results is not None:
+                        add_result(results)
+                    results = set()
+                elif line and results is not None:
+                    results.add(line)
+        if results is not None:
+            add_result(results)
+        return CompilerCacheStats(*counts)
+
+    def _sccache_counters(self, target_name: str) -> "typing.Optional[CompilerCacheStats]":
+        try:
+            output = run_command([self.executable, "--show-stats", "--stats-format=json"], capture_output=True,
+                                 print_verbose_only=True, env=self.env_vars(target_name), config=self.config).stdout
+            stats = json.loads(output.decode("utf-8"))["stats"]
+            return CompilerCacheStats(sum(stats["cache_hits"]["counts"].values()),
+                                      sum(stats["cache_misses"]["counts"].values()),
+                                      stats.get("requests_not_cacheable", 0))
+        except (subprocess.CalledProcessError, OSError, ValueError, KeyError, TypeError) as e:
+            warning_message("Could not query sccache statistics:", e)
+            return None
+
+    def print_statistics(self, target_names: "typing.Iterable[str]"):
+        results = []
+        for name in target_names:
+            try:
+                stats = CompilerCacheStats(**json.loads(self.statistics_file(name).read_text(encoding="utf-8")))
+            except (OSError, ValueError, TypeError):
+                continue
+            if any(stats):
+                results.append((name, stats))
+        if not results:
+            return
+        status_update(self.kind, "statistics (cache directory ", self.cache_dir, ", maximum size ", self.max_size,
+                      "):", sep="")
+        width = max(len(name) for name, _ in results)
+        for name, stats in results:
+            status_update("  ", name.ljust(width), " ", stats, sep="")
+        if self.kind == "sccache" and len(results) > 1 and self.config.parallel_targets > 1:
+            status_update("  Note: the sccache statistics for targets that were built concurrently (--parallel-targets)"
+                          " also include the compilations of the other targets.")
+        if len(results) > 1:
+            total = CompilerCacheStats(*(sum(values) for values in zip(*(stats for _, stats in results))))
+            status_update("  ", "total".ljust(width), " ", total, sep="")
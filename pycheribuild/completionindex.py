@@ -0,0 +1,183 @@
+# -
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import os
+import subprocess
+import sys
+import typing
+
+from .indexcache import SourceIndexCache
+
+# Note: this module is imported for every tab-completion request, so it must not import the rest of pycheribuild (or
+# anything else that is slow to import) at the top level.
+__all__ = ["CompletionIndex", "complete_from_index"]  # no-combine
+
+
+class CompletionIndex(SourceIndexCache):
+    """
+    A compact description of the cheribuild command line (target names, aliases, all option names with their choices)
+    that is used to answer argcomplete requests without importing the project modules and building the argument
+    parser. The index is stored per cheribuild checkout and is regenerated whenever any of the pycheribuild source
+    files change.
+    """
+    FORMAT_VERSION = 2
+    NAME = "completion-index"
+
+    def load(self) -> "typing.Optional[dict]":
+        """:return: the saved index or None if it does not exist or is out of date"""
+        return self._read()
+
+    def update(self) -> None:
+        """Build the full cheribuild argument parser and write the index for it"""
+        from .config.defaultconfig import DefaultCheriConfig
+        from .config.loader import ConfigLoaderBase, JsonAndCommandLineConfigLoader
+        from .projects.project import SimpleProject
+        from .targets import target_manager
+        assert not ConfigLoaderBase.is_completing_arguments, "Should not be called from argcomplete"
+        loader = JsonAndCommandLineConfigLoader()
+        SimpleProject._config_loader = loader
+        index = target_manager.load_all_targets()
+        DefaultCheriConfig(loader, sorted(name for name, _, _ in index) + ["__run_everything__"])
+        target_manager.register_command_line_options()
+        # noinspection PyProtectedMember
+        parser = loader._parser
+        # noinspection PyProtectedMember
+        mutex_groups = {action: i for i, group in enumerate(parser._mutually_exclusive_groups) for action in
+                        group._group_actions}
+        options = []
+        # noinspection PyProtectedMember
+        for action in parser._actions:
+            if action.option_strings:
+                choices = [str(c) for c in action.choices] if action.choices is not None else None
+                options.append([action.option_strings, action.nargs, choices, mutex_groups.get(action, -1)])
+        self._write({
+            "targets": [name for name, kind, _ in index if kind == target_manager.INDEX_TARGET],
+            "aliases": [name for name, kind, _ in index if kind == target_manager.INDEX_ALIAS],
+            "options": options, "excludes": loader.get_completion_excludes(),
+            })
+
+    def load_or_update(self) -> "typing.Optional[dict]":
+        result = self.load()
+        if result is None:
+            # Building the index needs a normal (non-completing) cheribuild process, so run it as a child process.
+            env = {k: v for k, v in os.environ.items() if not k.startswith(("_ARGCOMPLETE", "COMP_"))}
+            try:
+                subprocess.run([sys.executable, "-m", __name__], cwd=str(self.source_dir.parent), env=env,
+                               stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               check=True)
+            except (OSError, subprocess.CalledProcessError):
+                return None
+            result = self.load()
+        return result
+
+
+def _complete(index: dict, comp_words: "typing.List[str]", cword_prefix: str) -> "typing.Optional[typing.List[str]]":
+    # This mirrors what argcomplete does for the parser created by JsonAndCommandLineConfigLoader: target names for
+    # positional arguments, option names if the current word starts with "-" and the choices (or files) for option
+    # values. Returns None for anything it can't handle so that the caller can fall back to the real parser.
+    options = index["options"]
+    option_indices = {name: i for i, option in enumerate(options) for name in option[0]}
+    seen = set()  # type: typing.Set[int]
+    pending_value = None  # type: typing.Optional[list]
+    for word in comp_words[1:]:
+        if word == "--":
+            return None
+        if pending_value is not None:
+            pending_value = None
+            continue
+        if not word.startswith("-"):
+            continue
+        name, has_value, _ = word.partition("=")
+        i = option_indices.get(name)
+        if i is None:
+            continue  # unknown (e.g. abbreviated) options are ignored
+        seen.add(i)
+        nargs = options[i][1]
+        if nargs is None:
+            if not has_value:
+                pending_value = options[i]
+        elif nargs != 0:
+            return None
+
+    def complete_value(option: list, prefix: str) -> "typing.List[str]":
+        if option[2] is not None:
+            return [c for c in option[2] if c.startswith(prefix)]
+        from argcomplete.completers import FilesCompleter
+        return [f for f in FilesCompleter()(prefix) if f.startswith(prefix)]
+
+    if cword_prefix.startswith("-") and "=" in cword_prefix:
+        name, _, value_prefix = cword_prefix.partition("=")
+        i = option_indices.get(name)
+        if i is None or options[i][1] is not None:
+            return []
+        completions = [name + "=" + value for value in complete_value(options[i], value_prefix)]
+    elif pending_value is not None:
+        completions = complete_value(pending_value, cword_prefix)
+    elif cword_prefix.startswith("-"):
+        blocked_groups = set(options[i][3] for i in seen if options[i][3] != -1)
+        completions = []
+        for i, option in enumerate(options):
+            # Options in a mutually exclusive group (e.g. --foo and --no-foo) conflict with the ones already given
+            if option[3] in blocked_groups and i not in seen:
+                continue
+            completions.extend(name for name in option[0] if name.startswith(cword_prefix))
+    else:
+        completions = [t for t in sorted(index["targets"] + index["aliases"]) if t.startswith(cword_prefix)]
+    # Remove duplicates and the options that are hidden from completion (like argcomplete's filter_completions())
+    filtered = set(index["excludes"])
+    return [c for c in completions if c not in filtered and not filtered.add(c)]
+
+
+def complete_from_index() -> None:
+    """
+    Answer an argcomplete request using the completion index and exit. Returns if the request could not be handled,
+    in which case the caller should continue with the normal argcomplete handling.
+    """
+    if "_ARGCOMPLETE_DFS" in os.environ or "COMP_LINE" not in os.environ:
+        return
+    try:
+        import argcomplete
+    except ImportError:
+        return
+    index = CompletionIndex().load_or_update()
+    if index is None:
+        return
+    comp_line = os.environ["COMP_LINE"]
+    cword_prequote, cword_prefix, _, comp_words, last_wordbreak_pos = argcomplete.split_line(
+        comp_line, int(os.environ["COMP_POINT"]))
+    comp_words = comp_words[int(os.environ["_ARGCOMPLETE"]) - 1:]
+    completions = _complete(index, comp_words, cword_prefix)
+    if completions is None:
+        return
+    completions = argcomplete.CompletionFinder().quote_completions(completions, cword_prequote, last_wordbreak_pos)
+    ifs = os.environ.get("_ARGCOMPLETE_IFS", "\013")
+    if "_ARGCOMPLETE_BENCHMARK" not in os.environ:
+        filename = os.getenv("_ARGCOMPLETE_STDOUT_FILENAME")
+        with (open(filename, "wb") if filename else os.fdopen(8, "wb")) as output:
+            output.write(ifs.join(completions).encode("utf-8"))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    CompletionIndex().update()
@@ -248,6 +248,37 @@ class CheriConfig(ConfigBase):
 
         self.mips_cheri_bits = 128  # Backwards compat
         self.make_jobs = None  # type: Optional[int]
+        self.parallel_targets = loader.add_option(
+            "parallel-targets", type=int, default=1,
+            help="Number of independent targets that may be built concurrently. The --make-jobs budget is split "
+                 "between the targets that are running at the same time and the "
+                 "output of each target is written to <BUILD_ROOT>/cheribuild-logs/<TARGET>.log. The default (1) "
+                 "builds all targets one after another.")
+        self.use_make_jobserver = loader.add_bool_option(
+            "make-jobserver",
+            help="Share one GNU make compatible jobserver with --make-jobs slots between all GNU make and ninja "
+                 "processes started by cheribuild so that the total number of parallel jobs stays within that limit "
+                 "(also across --parallel-targets builds, as long as --parallel-targets is not larger than "
+                 "--make-jobs). Ninja only uses the jobserver starting with version 1.13 and bmake does not support "
+                 "it, so bmake builds use their share of --make-jobs instead.")
+        self.build_trace = loader.add_path_option(
+            "build-trace", metavar="FILE",
+            help="Write the duration of all targets, their build phases and the commands they ran (including the CPU "
+                 "time and peak RSS of the child processes) to FILE. The file uses the Chrome trace event format and "
+                 "can be opened in chrome://tracing or https://ui.perfetto.dev.")
+        self.ninja_log_top_edges = loader.add_option(
+            "ninja-log-top-edges", type=int, default=10, metavar="N",
+            help="After building a project with ninja, print the N slowest build steps and CMake targets from the "
+                 ".ninja_log file and append the build times to <BUILD_ROOT>/cheribuild-logs/<TARGET>.ninja-history"
+                 ".jsonl to detect regressions. Set to 0 to disable.")
+        self.log_compression = loader.add_option(
+            "log-compression", default="none", choices=("none", "xz", "zstd"),
+            help="Compress the --logfile build logs while they are being written. zstd compression uses the zstandard "
+                 "python module if it is installed and the zstd program otherwise.")
+        self.keep_logs = loader.add_option(
+            "keep-logs", type=int, default=1, metavar="N",
+            help="Number of --logfile build logs to keep for every build step. Older logs are renamed to "
+                 "<name>.1.log, <name>.2.log, etc.")
 
         self.source_root = None  # type: Path
         self.output_root = None  # type: Path
@@ -322,6 +353,11 @@ class CheriConfig(ConfigBase):
                                                                            "paths set up.")
         self.test_ld_preload = loader.add_path_option("test-ld-preload", group=loader.tests_group,
                                                       help="Preload the given library before running tests")
+        self.test_boot_snapshot_dir = loader.add_path_option(
+            "test-boot-snapshot-dir", group=loader.tests_group,
+            help="Directory for QEMU snapshots of a booted CheriBSD instance. If set, the test scripts boot once, save "
+                 "a snapshot when the shell prompt is reached and restore that snapshot for later test runs that use "
+                 "the same kernel and disk image instead of booting again.")
 
         self.benchmark_fpga_extra_args = loader.add_commandline_only_option(
             "benchmark-fpga-extra-args", group=loader.benchmark_group, type=list, metavar="ARGS",
@@ -360,6 +396,44 @@ class CheriConfig(ConfigBase):
             "shallow-clone", default=True,
             help="Perform a shallow `git clone` when cloning new projects. This can save a lot of time for large"
                  "repositories such as FreeBSD or LLVM. Use `git fetch --unshallow` to convert to a non-shallow clone")
+        self.git_mirror_dir = loader.add_path_option(
+            "git-mirror-dir",
+            help="Directory with bare mirrors of all cloned repositories (created on demand). New clones use the "
+                 "mirror as a --reference and the mirror is updated at most once per cheribuild run (shallow clones "
+                 "are not used when this option is set).")
+        self.git_mirror_dissociate = loader.add_bool_option(
+            "git-mirror-dissociate", default=True,
+            help="Pass --dissociate when cloning from a --git-mirror-dir mirror so that the clone does not depend on "
+                 "the mirror. If disabled, the clone keeps using the objects of the mirror via git alternates.")
+        self.fetch_jobs = loader.add_option(
+            "fetch-jobs", type=int, default=8,
+            help="Number of git repositories that are fetched concurrently before the first target is built. Only the "
+                 "`git fetch` step runs concurrently, updating the checkouts (and asking about local changes) still "
+                 "happens when each target is built. Set to 1 to disable the concurrent fetch step.")
+
+        self.build_cache_dir = loader.add_path_option(
+            "build-cache-dir",
+            help="Directory (e.g. on a shared NFS mount) for a cache of installed build artifacts. If set, the files "
+                 "installed by a project are stored in this cache keyed on the source revision, build configuration, "
+                 "configure arguments and dependencies. When building the same inputs again, the install tree is "
+                 "restored from the cache after the configure step instead of running build/install. The cache is "
+                 "only used if the configure step runs (e.g. for clean builds or new build directories).")
+        self.build_cache_max_size = loader.add_option(
+            "build-cache-max-size", type=int, default=50, metavar="GIB",
+            help="Maximum size of the --build-cache-dir cache in GiB. The least recently used entries are removed "
+                 "once the cache grows beyond this size.")
+        self.compiler_cache = loader.add_option(
+            "compiler-cache", default="none", choices=("none", "ccache", "sccache"),
+            help="Compiler launcher to use for CMake (CMAKE_<LANG>_COMPILER_LAUNCHER), autotools/makefile (CC/CXX) "
+                 "and FreeBSD (WITH_CCACHE_BUILD, ccache only) builds. The number of cache hits and misses for each "
+                 "target is printed once all targets have been built.")
+        self.compiler_cache_dir = loader.add_path_option(
+            "compiler-cache-dir", default=ComputedDefaultValue(function=lambda p, cls: p.build_root / "compiler-cache",
+                                                               as_string="'<BUILD_ROOT>/compiler-cache'"),
+            help="Directory used by the --compiler-cache launcher (set as CCACHE_DIR/SCCACHE_DIR)")
+        self.compiler_cache_max_size = loader.add_option(
+            "compiler-cache-max-size", default="20G", metavar="SIZE",
+            help="Maximum size of the --compiler-cache-dir cache (passed as CCACHE_MAXSIZE/SCCACHE_CACHE_SIZE)")
 
         self.fpga_custom_env_setup_script = loader.add_path_option(
             "beri-fpga-env-setup-script",
@@ -396,6 +396,8 @@ class CheriBSDTargetInfo(FreeBSDTargetInfo):
             cmd.append("--test-environment-only")
         if self.config.trap_on_unrepresentable:
             cmd.append("--trap-on-unrepresentable")
+        if self.config.test_boot_snapshot_dir and "--boot-snapshot-dir" not in self.config.test_extra_args:
+            cmd.extend(["--boot-snapshot-dir", self.config.test_boot_snapshot_dir])
         if self.config.test_ld_preload:
             cmd.append("--test-ld-preload=" + str(self.config.test_ld_preload))
             if xtarget.is_cheri_purecap():
@@ -47,6 +47,9 @@ class CheribuildAction(Enum):
     PRINT_CHOSEN_TARGETS = ("--print-chosen-targets", "List all the targets that would be built")
     DUMP_CONFIGURATION = ("--dump-configuration", "Print the current configuration as JSON. This can be saved to "
                                                   "~/.config/cheribuild.json to make it persistent")
+    BUILD_CACHE_INFO = ("--build-cache-info", "Print the entries of the --build-cache-dir artifact cache and exit")
+    BUILD_CACHE_PRUNE = ("--build-cache-prune", "Remove the least recently used entries from the --build-cache-dir "
+                                                "artifact cache until it is smaller than --build-cache-max-size")
 
     def __init__(self, option_name, help_message, altname=None, actions=None):
         self.option_name = option_name
@@ -67,6 +70,10 @@ class DefaultCheriConfig(CheriConfig):
         self.get_config_option = loader.add_option("get-config-option", type=str, metavar="KEY",
                                                    group=loader.action_group,
                                                    help="Print the value of config option KEY and exit")
+        self.show_log_errors = loader.add_option("show-log-errors", type=str, metavar="TARGET",
+                                                 group=loader.action_group,
+                                                 help="Print the errors (or warnings) recorded in the index of the "
+                                                      "most recent --logfile build logs of TARGET and exit")
         # boolean flags
         self.quiet = loader.add_bool_option("quiet", "q", help="Don't show stdout of the commands that are executed")
         self.verbose = loader.add_bool_option("verbose", "v", help="Print all commmands that are executed")
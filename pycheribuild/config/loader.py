@@ -200,8 +200,21 @@ class ConfigLoaderBase(object):
         self.docker_group = self._parser.add_argument_group("Options controlling the use of docker for building")
         self.unknown_config_option_is_error = False
         self.completion_excludes = []
+        # Called with the option names (e.g. "llvm/build-type") that are used on the command line or in the config
+        # file but have not been registered yet (or None to register all options). This allows registering the
+        # options of lazily loaded targets on demand. Returns True if any new options were added.
+        self.register_deferred_options = None  # type: typing.Optional[typing.Callable[..., bool]]
+
+    def _unknown_option_names(self, args: "typing.List[str]") -> "typing.List[str]":
+        # noinspection PyProtectedMember
+        known_options = set(name.lstrip("-") for name in self._parser._option_string_actions)
+        option_names = (a.partition("=")[0].lstrip("-") for a in args if a.startswith("-"))
+        return [name for name in option_names if name not in known_options]
 
     def _load_command_line_args(self):
+        if self.is_completing_arguments and self.register_deferred_options is not None:
+            if self._argcomplete_prefix and self._argcomplete_prefix.startswith("-"):
+                self.register_deferred_options(self._unknown_option_names([self._argcomplete_prefix]))
         if argcomplete and self.is_completing_arguments:
             if "_ARGCOMPLETE_BENCHMARK" in os.environ:
                 with open(os.devnull, "wb") as output:
@@ -225,6 +238,15 @@ class ConfigLoaderBase(object):
         # Ideally we would use parse_intermixed_args() but that requires python3.7
         # so we work around it using parse_known_args().
         self._parsed_args, trailing = self._parser.parse_known_args()
+        if self.register_deferred_options is not None:
+            # Options for targets that have not been loaded yet will not have been recognized. First try to load the
+            # targets named by those options and otherwise register all options (which also ensures that the error
+            # message below includes all possible suggestions).
+            for option_names in (self._unknown_option_names(trailing), None):
+                if not any(x.startswith('-') for x in trailing):
+                    break
+                if self.register_deferred_options(option_names):
+                    self._parsed_args, trailing = self._parser.parse_known_args()
         # TODO: python 3.7 self._parsed_args = self._parser.parse_intermixed_args()
         # print(self._parsed_args, trailingTargets, file=sys.stderr)
         for x in trailing:
@@ -553,6 +575,10 @@ class CommandLineConfigOption(ConfigOptionBase):
         if self.default is not None and action.help is not None and has_default_help_text:
             if action.help != argparse.SUPPRESS:
                 action.help = action.help + " (default: \'" + self.default_str + "\')"
+        # Options of lazily loaded targets can be added after the command line has been parsed. They can't have been
+        # passed on the command line (that would have caused them to be registered earlier), so use the default.
+        if self._loader._parsed_args is not None and not hasattr(self._loader._parsed_args, action.dest):
+            setattr(self._loader._parsed_args, action.dest, None)
         assert action.default is None  # we don't want argparse default values!
         assert isinstance(action, argparse.Action)
         assert not action.default  # we handle the default value manually
@@ -705,12 +731,7 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
         target_option = self._parser.add_argument("targets", metavar="TARGET", nargs=argparse.ZERO_OR_MORE,
                                                   help="The targets to build")
         if argcomplete and self.is_completing_arguments:
-            # if OSInfo.IS_FREEBSD: # FIXME: for some reason this won't work
-            self.completion_excludes = ["-t", "--skip-dependencies"]
-            if sys.platform.startswith("freebsd"):
-                self.completion_excludes += ["--freebsd-builder-copy-only", "--freebsd-builder-hostname",
-                                             "--freebsd-builder-output-path"]
-
+            self.completion_excludes = self.get_completion_excludes()
             visible_targets = available_targets.copy()
             visible_targets.remove("__run_everything__")
             target_completer = argcomplete.completers.ChoicesCompleter(visible_targets)
@@ -721,6 +742,14 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
                                                  help=argparse.SUPPRESS, choices=available_targets)
             unparsed.completer = target_completer
 
+    @staticmethod
+    def get_completion_excludes() -> "typing.List[str]":
+        # if OSInfo.IS_FREEBSD: # FIXME: for some reason this won't work
+        result = ["-t", "--skip-dependencies"]
+        if sys.platform.startswith("freebsd"):
+            result += ["--freebsd-builder-copy-only", "--freebsd-builder-hostname", "--freebsd-builder-output-path"]
+        return result
+
     def __load_json_with_comments(self, config_path: Path) -> "typing.Dict[str, typing.Any]":
         """
         Loads a JSON file ignoring any lines that start with '#' or '//'
@@ -836,12 +865,18 @@ class JsonAndCommandLineConfigLoader(ConfigLoaderBase):
                 if fullname in option.alias_names:
                     return True
 
+        if self.register_deferred_options is not None and self.register_deferred_options(None):
+            return self.__validate(prefix, key, lcv)
         error_message("Unknown config option '", fullname, "' in ", self._config_path, sep="")
         if self.unknown_config_option_is_error:
             raise ValueError("Unknown config option '" + fullname + "'")
         return False
 
     def _validate_config_file(self):
+        if self.register_deferred_options is not None:
+            # Load the targets that are configured in the JSON file (either as a nested object or as "target/option")
+            self.register_deferred_options([k + "/" if v.is_nested_dict() else k for k, v in self._json.items() if
+                                            "/" in k or v.is_nested_dict()])
         for k, v in self._json.items():
             self.__validate("", k, v)
 
@@ -0,0 +1,97 @@
+# -
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import contextlib
+import fcntl
+import hashlib
+import os
+import re
+import time
+from pathlib import Path
+
+from .processutils import run_command
+from .utils import ConfigBase, status_update
+
+__all__ = ["git_mirror_path", "update_git_mirror"]  # no-combine
+
+# Mirrors that were fetched after this timestamp are not fetched again (the timestamp is inherited by the processes
+# forked for --parallel-targets so each mirror is only fetched once per cheribuild invocation).
+_RUN_START_TIME = time.time()
+_FETCH_STAMP = "cheribuild-last-fetch"
+
+
+def git_mirror_path(mirror_dir: Path, url: str) -> Path:
+    """Returns the path of the bare mirror for url (the name includes a hash of the URL to avoid collisions)"""
+    name = re.sub(r"[^A-Za-z0-9._-]", "_", url.rstrip("/").rsplit("/", 1)[-1])
+    if name.endswith(".git"):
+        name = name[:-len(".git")]
+    return mirror_dir / (name + "-" + hashlib.sha1(url.encode("utf-8")).hexdigest()[:12] + ".git")
+
+
+@contextlib.contextmanager
+def _locked(lock_path: Path):
+    with lock_path.open("a") as lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            status_update("Waiting for another process to finish updating", lock_path.with_suffix(""))
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def update_git_mirror(mirror_dir: Path, url: str, *, config: ConfigBase) -> Path:
+    """
+    Create or update the bare mirror of url inside mirror_dir. The mirror is fetched at most once per cheribuild run
+    and a file lock ensures that concurrent cheribuild processes (e.g. multiple Jenkins jobs) don't update it at the
+    same time.
+    :return: the path to the mirror
+    """
+    mirror = git_mirror_path(mirror_dir, url)
+    if config.pretend:
+        if not mirror.is_dir():
+            run_command("git", "clone", "--mirror", url, mirror, config=config)
+        else:
+            run_command("git", "-C", mirror, "fetch", "--prune", config=config)
+        return mirror
+    mirror_dir.mkdir(parents=True, exist_ok=True)
+    with _locked(mirror.with_name(mirror.name + ".lock")):
+        stamp = mirror / _FETCH_STAMP
+        if not (mirror / "HEAD").is_file():
+            status_update("Creating git mirror of", url, "in", mirror)
+            tmp_mirror = mirror.with_name(mirror.name + ".tmp")
+            if tmp_mirror.exists():
+                run_command("rm", "-rf", tmp_mirror, config=config)
+            run_command("git", "clone", "--mirror", url, tmp_mirror, config=config)
+            os.rename(str(tmp_mirror), str(mirror))
+        elif stamp.exists() and stamp.stat().st_mtime >= _RUN_START_TIME:
+            return mirror  # already fetched during this run
+        else:
+            start = time.time()
+            run_command("git", "-C", mirror, "fetch", "--prune", config=config, print_verbose_only=True)
+            status_update("Updated git mirror", mirror, "in", "{:.1f}s".format(time.time() - start))
+        stamp.touch()
+    return mirror
@@ -0,0 +1,276 @@
+# -
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import heapq
+import json
+import os
+import re
+import typing
+from collections import namedtuple
+from pathlib import Path
+
+from .processutils import run_command
+from .utils import ConfigBase, status_update
+
+__all__ = ["IncrementalBuildState", "FreeBSDRebuildPlan", "freebsd_rebuild_plan"]  # no-combine
+
+FreeBSDRebuildPlan = namedtuple("FreeBSDRebuildPlan", ["subdirs", "rebuild_kernel"])
+
+# Changes to any of these files affect (almost) everything that is built, so they require a full buildworld.
+_FULL_REBUILD_PREFIXES = ("include/", "sys/sys/", "share/mk/", "tools/build/", "lib/csu/", "lib/libc/include/",
+                          "contrib/llvm-project/", "Makefile")
+# Headers below sys/ are also installed for userspace (sys/net, sys/netinet, sys/dev, sys/<arch>/include, etc.)
+_FULL_REBUILD_RE = re.compile(r"^sys/(?:[^/]+/include/|.*\.h$)")
+# Third-party code is built from Makefiles elsewhere in the tree that reference it with .PATH or include paths.
+_CONTRIB_RE = re.compile(r"^((?:cddl/)?contrib/[^/]+|crypto/[^/]+)/")
+_LIB_NAME_RE = re.compile(r"^\s*(?:LIB|SHLIB|LIB_CXX|SHLIB_NAME)\s*\??=\s*(\S+)", re.MULTILINE)
+
+
+def _git(source_dir: Path, *args, config: ConfigBase) -> "typing.Optional[bytes]":
+    result = run_command(["git"] + list(args), cwd=source_dir, capture_output=True, capture_error=True,
+                         print_verbose_only=True, run_in_pretend_mode=True, allow_unexpected_returncode=True,
+                         config=config)
+    return result.stdout if result.returncode == 0 else None
+
+
+def _split_nul(output: bytes) -> "typing.List[str]":
+    return [p.decode("utf-8", errors="surrogateescape") for p in output.split(b"\0") if p]
+
+
+class IncrementalBuildState(object):
+    """
+    Records the git revision of a source checkout (and the contents of the files that had local changes) at the start
+    of the last successful build. This allows computing the files that changed since then, including uncommitted edits.
+    """
+
+    def __init__(self, state_file: Path, source_dir: Path, *, config: ConfigBase):
+        self.state_file = state_file
+        self.source_dir = source_dir
+        self.config = config
+
+    def _dirty_files(self) -> "typing.Optional[typing.List[str]]":
+        modified = _git(self.source_dir, "diff", "--name-only", "-z", "HEAD", config=self.config)
+        untracked = _git(self.source_dir, "ls-files", "-z", "--others", "--exclude-standard", config=self.config)
+        if modified is None or untracked is None:
+            return None
+        return sorted(set(_split_nul(modified) + _split_nul(untracked)))
+
+    def _hash_files(self, paths: "typing.Iterable[str]") -> "typing.Dict[str, typing.Optional[str]]":
+        paths = list(paths)
+        existing = [p for p in paths if os.path.isfile(os.path.join(str(self.source_dir), p))]
+        result = dict.fromkeys(paths)  # type: typing.Dict[str, typing.Optional[str]]
+        if existing:
+            output = run_command(["git", "hash-object", "--stdin-paths"], input="\n".join(existing) + "\n",
+                                 cwd=self.source_dir, capture_output=True, print_verbose_only=True,
+                                 run_in_pretend_mode=True, config=self.config).stdout
+            result.update(zip(existing, output.decode("utf-8").split()))
+        return result
+
+    def snapshot(self, build_options: str) -> "typing.Optional[dict]":
+        """Returns the current state of the source tree (to be passed to save() once the build succeeded)"""
+        if not (self.source_dir / ".git").exists():
+            return None
+        revision = _git(self.source_dir, "rev-parse", "--verify", "--quiet", "HEAD", config=self.config)
+        dirty = self._dirty_files()
+        if revision is None or dirty is None:
+            return None
+        return {"revision": revision.decode("utf-8").strip(), "dirty": self._hash_files(dirty),
+                "options": build_options}
+
+    def save(self, snapshot: "typing.Optional[dict]"):
+        if snapshot is None or self.config.pretend:
+            return
+        self.state_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.state_file.with_name(self.state_file.name + ".tmp")
+        tmp.write_text(json.dumps(snapshot, indent=2, sort_keys=True))
+        os.replace(str(tmp), str(self.state_file))
+
+    def invalidate(self):
+        """Forget the last successful build (e.g. when a full build failed after the object directory was cleaned)"""
+        if self.state_file.exists() and not self.config.pretend:
+            self.state_file.unlink()
+
+    def changed_files(self, build_options: str) -> "typing.Optional[typing.List[str]]":
+        """
+        :return: the files that changed since the last successful build or None if that can't be determined (no
+        previous build, changed build options, the recorded revision is no longer available, etc.)
+        """
+        try:
+            with self.state_file.open("r", encoding="utf-8") as f:
+                state = json.load(f)
+            revision = state["revision"]
+            recorded_dirty = state["dirty"]  # type: typing.Dict[str, typing.Optional[str]]
+            if state["options"] != build_options:
+                status_update("Build options changed since the last build, cannot rebuild incrementally")
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+        if not (self.source_dir / ".git").exists():
+            return None
+        committed = _git(self.source_dir, "diff", "--name-only", "-z", revision, config=self.config)
+        untracked = _git(self.source_dir, "ls-files", "-z", "--others", "--exclude-standard", config=self.config)
+        if committed is None or untracked is None:
+            status_update("Could not compare", self.source_dir, "to revision", revision, "of the last build")
+            return None
+        changed = set(_split_nul(committed) + _split_nul(untracked))
+        # Files that had local changes when the last build started: only treat them as changed if their contents are
+        # different now (this also handles local changes that have been reverted since then).
+        current_hashes = self._hash_files(recorded_dirty.keys())
+        for path, recorded_hash in recorded_dirty.items():
+            if current_hashes[path] == recorded_hash:
+                changed.discard(path)
+            else:
+                changed.add(path)
+        return sorted(changed)
+
+
+class _FreeBSDSourceTree(object):
+    def __init__(self, source_dir: Path, config: ConfigBase):
+        self.source_dir = source_dir
+        self.config = config
+        self._lib_consumers = None  # type: typing.Optional[typing.Dict[str, typing.Set[str]]]
+        self._lib_names = dict()  # type: typing.Dict[str, typing.Optional[str]]
+
+    def has_makefile(self, subdir: str) -> bool:
+        return (self.source_dir / subdir / "Makefile").is_file()
+
+    def subdir_for_file(self, path: str) -> "typing.Optional[str]":
+        """:return: the closest directory with a Makefile that contains path (or None for top-level directories)"""
+        subdir = os.path.dirname(path)
+        while subdir and "/" in subdir:
+            if self.has_makefile(subdir):
+                return subdir
+            subdir = os.path.dirname(subdir)
+        return None
+
+    def _grep_makefiles(self, *args) -> "typing.List[typing.Tuple[str, str]]":
+        output = _git(self.source_dir, "grep", "-z", "-I", *args, "--", "*Makefile*", config=self.config)
+        result = []
+        for line in (output or b"").decode("utf-8", errors="replace").splitlines():
+            filename, _, match = line.partition("\0")
+            result.append((filename, match))
+        return result
+
+    def consumers_of_contrib_dir(self, contrib_dir: str) -> "typing.Set[str]":
+        result = set()
+        for makefile, _ in self._grep_makefiles("-F", contrib_dir):
+            if not makefile.startswith(contrib_dir + "/"):
+                subdir = self.subdir_for_file(makefile)
+                if subdir is not None:
+                    result.add(subdir)
+        return result
+
+    def library_name(self, subdir: str) -> "typing.Optional[str]":
+        if subdir not in self._lib_names:
+            try:
+                match = _LIB_NAME_RE.search((self.source_dir / subdir / "Makefile").read_text(errors="replace"))
+            except OSError:
+                match = None
+            self._lib_names[subdir] = match.group(1) if match else None
+        return self._lib_names[subdir]
+
+    def consumers_of_library(self, name: str) -> "typing.Set[str]":
+        if self._lib_consumers is None:
+            # Parse all LIBADD lines in a single git grep call instead of one call per library
+            self._lib_consumers = dict()
+            for makefile, match in self._grep_makefiles("-E", r"^[[:space:]]*LIBADD[^=]*="):
+                subdir = self.subdir_for_file(makefile)
+                if subdir is None:
+                    continue
+                for lib in match.partition("=")[2].replace("\\", " ").split():
+                    self._lib_consumers.setdefault(lib, set()).add(subdir)
+        return self._lib_consumers.get(name, set())
+
+
+def freebsd_rebuild_plan(source_dir: Path, changed_files: "typing.List[str]", *, config: ConfigBase,
+                         max_subdirs: int = 100) -> "typing.Optional[FreeBSDRebuildPlan]":
+    """
+    Computes the FreeBSD source subdirectories that need to be rebuilt (in build order) after changed_files were
+    modified, including all directories that link against a changed library.
+    :return: the subdirectories and whether the kernel has to be rebuilt, or None if a full buildworld is required.
+    """
+    tree = _FreeBSDSourceTree(source_dir, config)
+    subdirs = set()
+    rebuild_kernel = False
+    for path in changed_files:
+        if path.startswith(_FULL_REBUILD_PREFIXES) or _FULL_REBUILD_RE.match(path):
+            status_update("Full rebuild required since", path, "changed")
+            return None
+        if path.startswith("sys/"):
+            rebuild_kernel = True
+            continue
+        if "/" not in path:
+            continue  # top-level files other than the Makefiles (README, etc.) don't affect the build
+        contrib = _CONTRIB_RE.match(path)
+        if contrib:
+            consumers = tree.consumers_of_contrib_dir(contrib.group(1))
+            if not consumers:
+                status_update("Full rebuild required since no Makefile references", contrib.group(1))
+                return None
+            subdirs.update(consumers)
+            continue
+        subdir = tree.subdir_for_file(path)
+        if subdir is None:
+            status_update("Full rebuild required since", path, "is not part of an individual subdirectory")
+            return None
+        subdirs.add(subdir)
+    # Add the reverse dependencies of all changed libraries (transitively, for static libraries and e.g. rescue)
+    pending = sorted(subdirs)
+    while pending:
+        name = tree.library_name(pending.pop())
+        if name is None:
+            continue
+        for consumer in tree.consumers_of_library(name):
+            if consumer not in subdirs:
+                subdirs.add(consumer)
+                pending.append(consumer)
+        if len(subdirs) > max_subdirs:
+            status_update("Full rebuild required since more than", max_subdirs, "directories are affected")
+            return None
+    return FreeBSDRebuildPlan(_build_order(tree, subdirs), rebuild_kernel)
+
+
+def _build_order(tree: _FreeBSDSourceTree, subdirs: "typing.Set[str]") -> "typing.List[str]":
+    """Sort the libraries in subdirs topologically (based on LIBADD) and add the other directories at the end"""
+    libraries = sorted(d for d in subdirs if tree.library_name(d) is not None)
+    # Number of libraries in subdirs that each library depends on
+    num_deps = dict.fromkeys(libraries, 0)
+    for lib in libraries:
+        for consumer in tree.consumers_of_library(tree.library_name(lib)):
+            if consumer in num_deps and consumer != lib:
+                num_deps[consumer] += 1
+    result = []
+    ready = [lib for lib in libraries if num_deps[lib] == 0]
+    heapq.heapify(ready)
+    while ready:
+        lib = heapq.heappop(ready)
+        result.append(lib)
+        for consumer in tree.consumers_of_library(tree.library_name(lib)):
+            if consumer in num_deps and consumer != lib:
+                num_deps[consumer] -= 1
+                if num_deps[consumer] == 0:
+                    heapq.heappush(ready, consumer)
+    # Dependency cycles should not happen, but if they do just build the remaining libraries in alphabetical order
+    result.extend(lib for lib in libraries if num_deps[lib] > 0)
+    return result + sorted(d for d in subdirs if tree.library_name(d) is None)
@@ -0,0 +1,85 @@
+# -
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import typing
+from pathlib import Path
+
+# Note: this module is used by completionindex.py, so it must not import the rest of pycheribuild.
+__all__ = ["SourceIndexCache"]  # no-combine
+
+
+class SourceIndexCache(object):
+    """
+    Base class for the JSON files that cache information derived from the pycheribuild sources (e.g. the list of
+    targets). The files are stored per cheribuild checkout and are invalidated whenever any of the pycheribuild source
+    files change.
+    """
+    FORMAT_VERSION = 1
+    NAME = None  # type: str
+
+    def __init__(self, source_dir: Path = Path(__file__).parent):
+        self.source_dir = source_dir.absolute()
+        checkout_hash = hashlib.sha1(str(self.source_dir).encode("utf-8")).hexdigest()[:16]
+        cache_home = os.getenv("XDG_CACHE_HOME") or str(Path.home() / ".cache")
+        self.path = Path(cache_home, "cheribuild", self.NAME + "-" + checkout_hash + ".json")
+        self._stamp = None  # type: typing.Optional[str]
+
+    @property
+    def stamp(self) -> str:
+        if self._stamp is None:
+            # Only stat() the sources instead of hashing them since this happens on every cheribuild invocation (and
+            # for every tab-completion request).
+            stamp = hashlib.sha1("{}.{} {}\n".format(sys.version_info[0], sys.version_info[1],
+                                                     sys.platform).encode("utf-8"))
+            for f in sorted(self.source_dir.rglob("*.py")):
+                st = f.stat()
+                stamp.update("{} {} {}\n".format(f.relative_to(self.source_dir), st.st_mtime_ns,
+                                                 st.st_size).encode("utf-8"))
+            self._stamp = stamp.hexdigest()
+        return self._stamp
+
+    def _read(self) -> "typing.Optional[dict]":
+        """:return: the saved data or None if it does not exist or is out of date"""
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.FORMAT_VERSION and data.get("stamp") == self.stamp:
+                return data
+        except (OSError, ValueError, AttributeError):
+            pass
+        return None
+
+    def _write(self, data: dict) -> None:
+        """Atomically replace the saved data. Raises OSError on failure."""
+        data = dict(data, version=self.FORMAT_VERSION, stamp=self.stamp)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=str(self.path.parent), prefix=self.path.name, suffix=".tmp",
+                                         delete=False, encoding="utf-8") as tmp:
+            json.dump(data, tmp, separators=(",", ":"))
+        os.replace(tmp.name, str(self.path))
@@ -39,6 +39,7 @@ import typing
 # noinspection PyUnresolvedReferences
 from pathlib import Path
 
+from .archive import extract_archive, ReproducibleTarWriter
 from .config.jenkinsconfig import JenkinsAction, JenkinsConfig
 from .config.loader import CommandLineConfigOption, ConfigLoaderBase
 # make sure all projects are loaded so that target_manager gets populated
@@ -49,8 +50,8 @@ from .projects.cross import *  # noqa: F401,F403
 from .projects.cross.crosscompileproject import CrossCompileMixin
 from .projects.project import Project, SimpleProject
 from .targets import MultiArchTargetAlias, SimpleTargetAlias, Target, target_manager
-from .processutils import commandline_to_str, get_program_version, run_command
-from .utils import fatal_error, init_global_config, OSInfo, status_update, ThreadJoiner, warning_message
+from .processutils import commandline_to_str, run_command
+from .utils import fatal_error, init_global_config, status_update, ThreadJoiner, warning_message
 
 EXTRACT_SDK_TARGET = "extract-sdk"
 RUN_EVERYTHING_TARGET = "__run_everything__"
@@ -99,8 +100,8 @@ class SdkArchive(object):
     def extract(self):
         assert self.archive.exists(), str(self.archive)
         self.cheri_config.FS.makedirs(self.output_dir)
-        run_command(["tar", "Jxf", self.archive, "-C", self.output_dir] + self.extra_args,
-                    cwd=self.cheri_config.workspace)
+        extract_archive(self.archive, self.output_dir, extra_args=self.extra_args,
+                        threads=self.cheri_config.make_jobs, cwd=self.cheri_config.workspace, config=self.cheri_config)
         self.check_required_files()
 
     def check_required_files(self, fatal=True) -> bool:
@@ -305,54 +306,33 @@ def build_target(cheri_config, target: Target):
 
 
 def create_tarball(cheri_config):
-    if True:  # Note: This if exists for now to avoid a large whitespace diff.
-        bsdtar_path = shutil.which("bsdtar")
-        tar_cmd = None
-        tar_flags = ["--invalid-flag"]
-        if bsdtar_path:
-            bsdtar_version = get_program_version(Path(bsdtar_path), regex=b"bsdtar\\s+(\\d+)\\.(\\d+)\\.?(\\d+)?")
-            if bsdtar_version > (3, 0, 0):
-                # Only newer versions support --uid/--gid
-                tar_cmd = bsdtar_path
-                tar_flags = ["--uid=0", "--gid=0", "--numeric-owner"]
-            if bsdtar_version > (3, 2, 0):
-                # Use parallel xz compression
-                tar_flags.append("--options=xz:threads=" + str(cheri_config.make_jobs))
-
-        if not tar_cmd and (shutil.which("gtar") or OSInfo.IS_LINUX):
-            # GNU tar
-            tar_cmd = "tar" if OSInfo.IS_LINUX else "gtar"
-            tar_flags = ["--owner=0", "--group=0", "--numeric-owner"]
-
-        # bsdtar too old and GNU tar not found
-        if not tar_cmd:
-            fatal_error("Could not find a usable version of the tar command")
-            return
-        status_update("Creating tarball", cheri_config.tarball_name)
-        # Strip all ELF files:
-        if cheri_config.strip_elf_files:
-            # TODO: we only accept one target name to infer the correct llvm-strip binary path
-            assert len(cheri_config.targets) == 1, "--create-tarball only accepts one target name"
-            target = target_manager.get_target_raw(cheri_config.targets[0])
-            Target.instantiating_targets_should_warn = False
-            project = target.get_or_create_project(cheri_config.preferred_xtarget, cheri_config)
-            strip_binaries(cheri_config, project, cheri_config.workspace / "tarball")
-        run_command(
-            [tar_cmd, "--create", "--xz"] + tar_flags + ["-f", cheri_config.tarball_name, "-C", "tarball", "."],
-            cwd=cheri_config.workspace)
-        run_command("du", "-sh", cheri_config.workspace / cheri_config.tarball_name)
+    tarball = cheri_config.workspace / cheri_config.tarball_name
+    status_update("Creating tarball", cheri_config.tarball_name)
+    # Strip all ELF files:
+    if cheri_config.strip_elf_files:
+        # TODO: we only accept one target name to infer the correct llvm-strip binary path
+        assert len(cheri_config.targets) == 1, "--create-tarball only accepts one target name"
+        target = target_manager.get_target_raw(cheri_config.targets[0])
+        Target.instantiating_targets_should_warn = False
+        project = target.get_or_create_project(cheri_config.preferred_xtarget, cheri_config)
+        strip_binaries(cheri_config, project, cheri_config.workspace / "tarball")
+    # Use the built-in archive writer instead of tar to get a reproducible archive (sorted entries, numeric owner 0
+    # and fixed timestamps) that is compressed by a multi-threaded xz/zstd process independent of the tar version.
+    writer = ReproducibleTarWriter(tarball, threads=cheri_config.make_jobs)
+    status_update("Adding", cheri_config.workspace / "tarball", "to", tarball, "(" + writer.compression,
+                  "compression)")
+    if not cheri_config.pretend:
+        with writer:
+            writer.add_tree(cheri_config.workspace / "tarball")
+    run_command("du", "-sh", tarball)
 
 
 def strip_binaries(_: JenkinsConfig, project: SimpleProject, directory: Path):
     status_update("Tarball directory size before stripping ELF files:")
     run_command("du", "-sh", directory)
-    for root, dirs, filelist in os.walk(str(directory)):
-        for file in filelist:
-            # Try to shrink the size by stripping all elf binaries
-            filepath = Path(root, file)
-            if filepath.is_symlink():
-                continue
-            project.maybe_strip_elf_file(filepath)
+    # Try to shrink the size by stripping all elf binaries (symlinks are skipped by strip_elf_files_batched())
+    project.strip_elf_files_batched(Path(root, file) for root, _, filelist in os.walk(str(directory))
+                                    for file in filelist)
     status_update("Tarball directory size after stripping ELF files:")
     run_command("du", "-sh", directory)
 
@@ -0,0 +1,129 @@
+# -
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import atexit
+import functools
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import typing
+from pathlib import Path
+
+from .processutils import get_version_output
+from .utils import status_update
+
+__all__ = ["JobServer", "get_jobserver", "init_jobserver"]  # no-combine
+
+
+class JobServer(object):
+    """
+    A GNU make compatible jobserver (see https://www.gnu.org/software/make/manual/html_node/Job-Slots.html) that is
+    shared by all GNU make/ninja processes started by cheribuild.
+    The token pipe is a named FIFO: GNU make >= 4.4 and ninja >= 1.13 open it by name, older GNU make versions use
+    the inherited read/write file descriptors instead. bmake is not a client since it can only use the jobserver
+    via the internal -J flag.
+    Every top-level client (one per target that is built concurrently) owns an implicit job slot in addition to the
+    tokens in the pipe, so the pipe only contains num_jobs - num_clients tokens.
+    """
+
+    def __init__(self, num_jobs: int, num_clients: int = 1):
+        assert num_jobs >= 1 and num_clients >= 1
+        self.num_jobs = num_jobs
+        self.num_clients = num_clients
+        self._tempdir = tempfile.mkdtemp(prefix="cheribuild-jobserver-")
+        self.fifo_path = Path(self._tempdir, "tokens")
+        os.mkfifo(str(self.fifo_path), 0o600)
+        # Opening the write end of a FIFO blocks until there is a reader, so open the read end first.
+        self.read_fd = os.open(str(self.fifo_path), os.O_RDONLY | os.O_NONBLOCK)
+        self.write_fd = os.open(str(self.fifo_path), os.O_WRONLY)
+        os.set_blocking(self.read_fd, True)
+        # Note: if there are more concurrent clients than jobs we can't avoid exceeding num_jobs.
+        os.write(self.write_fd, b"+" * max(0, num_jobs - num_clients))
+
+    @property
+    def pass_fds(self) -> "typing.Tuple[int, int]":
+        return self.read_fd, self.write_fd
+
+    @property
+    def fd_auth_string(self) -> str:
+        return str(self.read_fd) + "," + str(self.write_fd)
+
+    def gnu_make_flags(self, make_command: str) -> str:
+        version = _get_tool_version(make_command)
+        # GNU make 4.4 added the fifo: style, 4.2 renamed --jobserver-fds to --jobserver-auth
+        if version >= (4, 4):
+            auth = "--jobserver-auth=fifo:" + str(self.fifo_path)
+        elif version >= (4, 2):
+            auth = "--jobserver-auth=" + self.fd_auth_string
+        else:
+            auth = "--jobserver-fds=" + self.fd_auth_string
+        return "-j" + str(self.num_jobs) + " " + auth
+
+    def ninja_flags(self, ninja_command: str) -> "typing.Optional[str]":
+        # Ninja only supports the fifo: style on POSIX systems and older versions ignore the jobserver entirely
+        if _get_tool_version(ninja_command) < (1, 13):
+            return None
+        return "-j" + str(self.num_jobs) + " --jobserver-auth=fifo:" + str(self.fifo_path)
+
+    def close(self):
+        for fd in (self.read_fd, self.write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        shutil.rmtree(self._tempdir, ignore_errors=True)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_tool_version(command: str) -> "typing.Tuple[int, ...]":
+    try:
+        output = get_version_output(Path(shutil.which(command) or command))
+    except (OSError, subprocess.CalledProcessError):
+        return 0, 0
+    match = re.search(rb"(\d+)\.(\d+)", output)
+    if not match:
+        return 0, 0
+    return int(match.group(1)), int(match.group(2))
+
+
+_jobserver = None  # type: typing.Optional[JobServer]
+
+
+def init_jobserver(num_jobs: int, num_clients: int = 1) -> JobServer:
+    """
+    Create the jobserver. This must happen before any build processes are forked.
+    :param num_clients: the maximum number of build processes (i.e. targets) that use the jobserver concurrently
+    """
+    global _jobserver
+    if _jobserver is None:
+        _jobserver = JobServer(num_jobs, num_clients)
+        atexit.register(_jobserver.close)
+        status_update("Started jobserver with", num_jobs, "job slots using", _jobserver.fifo_path)
+    return _jobserver
+
+
+def get_jobserver() -> "typing.Optional[JobServer]":
+    return _jobserver
@@ -41,47 +41,115 @@ from .processutils import commandline_to_str
 from .utils import status_update, warning_message
 
 
+# Keywords that are ignored because makefs doesn't like them: sometimes there will be time with nanoseconds in the
+# manifest (makefs can't handle that) and the tags= key is not supported.
+_IGNORED_KEYWORDS = frozenset(("tags", "time"))
+# Keywords whose values are (almost) unique for every entry. All other keyword=value pairs are shared between lots of
+# entries so we parse them only once and reuse the resulting (key, value) tuple to save both time and memory.
+_UNIQUE_VALUE_KEYWORDS = frozenset(("contents", "link", "size", "md5digest", "sha1digest", "sha256digest",
+                                    "sha384digest", "sha512digest", "rmd160digest", "cksum"))
+_SHLEX_SPECIAL_CHARS = ("\"", "'", "\\")
+
+
 class MtreeEntry(object):
-    def __init__(self, path: str, attributes: "typing.Dict[str, str]"):
+    # A METALOG for a full CheriBSD image has >100k entries, so keep the per-entry overhead as low as possible:
+    # the attributes are stored as a tuple of (key, value) pairs and only converted to a dict on demand.
+    __slots__ = ("path", "_attribute_items", "_attributes")
+
+    def __init__(self, path: str,
+                 attributes: "typing.Union[typing.Dict[str, str], typing.Tuple[typing.Tuple[str, str], ...]]"):
         self.path = path
-        self.attributes = attributes
+        if isinstance(attributes, tuple):
+            self._attribute_items = attributes
+            self._attributes = None  # type: typing.Optional[typing.Dict[str, str]]
+        else:
+            self._attribute_items = None
+            self._attributes = attributes
+
+    @property
+    def attributes(self) -> "typing.Dict[str, str]":
+        if self._attributes is None:
+            self._attributes = OrderedDict(self._attribute_items)
+            self._attribute_items = None
+        return self._attributes
+
+    def get_attribute(self, key: str) -> "typing.Optional[str]":
+        if self._attributes is not None:
+            return self._attributes.get(key)
+        for k, v in self._attribute_items:
+            if k == key:
+                return v
+        return None
 
     def is_dir(self):
-        return self.attributes.get("type") == "dir"
+        return self.get_attribute("type") == "dir"
 
     def is_file(self):
-        return self.attributes.get("type") == "file"
+        return self.get_attribute("type") == "file"
 
-    @classmethod
-    def parse(cls, line: str, contents_root: Path = None) -> "MtreeEntry":
-        elements = shlex.split(line)
-        path = elements[0]
+    @staticmethod
+    def _normalize_path(path: str) -> str:
         # Ensure that the path is normalized:
         if path != ".":
-            # print("Before:", path)
-            assert path[:2] == "./"
-            path = path[:2] + os.path.normpath(path[2:])
-            # print("After:", path)
-        attr_dict = OrderedDict()  # keep them in insertion order
-        for k, v in map(lambda s: s.split(sep="=", maxsplit=1), elements[1:]):
-            # ignore some tags that makefs doesn't like
-            # sometimes there will be time with nanoseconds in the manifest, makefs can't handle that
-            # also the tags= key is not supported
-            if k in ("tags", "time"):
-                continue
-            # convert relative contents=keys to absolute ones
-            if contents_root and k == "contents":
-                if not os.path.isabs(v):
-                    v = str(contents_root / v)
-            attr_dict[k] = v
-        return MtreeEntry(path, attr_dict)
-        # FIXME: use contents=
+            if path[:2] != "./":
+                raise ValueError("mtree path must start with ./: " + path)
+            if "//" in path or "/." in path or path.endswith("/"):
+                path = "./" + os.path.normpath(path[2:])
+        return path
+
+    @classmethod
+    def parse(cls, line: str, contents_root: Path = None,
+              defaults: "typing.Dict[str, str]" = None) -> "MtreeEntry":
+        return cls._parse(line, str(contents_root) if contents_root else None, defaults, dict())
+
+    @classmethod
+    def _parse(cls, line: str, contents_root: "typing.Optional[str]",
+               defaults: "typing.Optional[typing.Dict[str, str]]",
+               keyword_cache: "typing.Dict[str, typing.Tuple[str, str]]") -> "MtreeEntry":
+        if any(c in line for c in _SHLEX_SPECIAL_CHARS):
+            elements = shlex.split(line)
+        else:
+            elements = line.split()  # much faster than shlex.split() and sufficient for almost all lines
+        path = cls._normalize_path(elements[0])
+        attrs = cls._parse_keywords(elements[1:], contents_root, keyword_cache)
+        if defaults:
+            # Keywords set using /set apply to all entries that don't override them
+            overrides = dict(attrs)
+            merged = [(k, overrides.pop(k)) if k in overrides else (k, v) for k, v in defaults.items()]
+            merged.extend(kv for kv in attrs if kv[0] in overrides)
+            attrs = merged
+        return MtreeEntry(path, tuple(attrs))
+
+    @staticmethod
+    def _parse_keywords(elements: "typing.List[str]", contents_root: "typing.Optional[str]",
+                        keyword_cache: "typing.Dict[str, typing.Tuple[str, str]]"
+                        ) -> "typing.List[typing.Tuple[str, str]]":
+        result = []
+        for element in elements:
+            kv = keyword_cache.get(element, False)
+            if kv is False:
+                k, sep, v = element.partition("=")
+                if not sep:
+                    raise ValueError("Missing value for keyword " + k)
+                if k in _IGNORED_KEYWORDS:
+                    continue  # not cached since the values (e.g. time=) are different for almost every entry
+                k = sys.intern(k)
+                if k in _UNIQUE_VALUE_KEYWORDS:
+                    # convert relative contents=keys to absolute ones
+                    if contents_root and k == "contents" and not os.path.isabs(v):
+                        v = os.path.normpath(os.path.join(contents_root, v))
+                    result.append((k, v))
+                    continue
+                kv = (k, sys.intern(v))
+                keyword_cache[element] = kv
+            result.append(kv)
+        return result
 
     @classmethod
     def parse_all_dirs_in_mtree(cls, mtree_file: Path) -> "typing.List[MtreeEntry]":
         with mtree_file.open("r", encoding="utf-8") as f:
             result = []
-            for line in f.readlines():
+            for line in f:
                 if " type=dir" in line:
                     try:
                         result.append(MtreeEntry.parse(line))
@@ -90,7 +158,8 @@ class MtreeEntry(object):
             return result
 
     def __str__(self):
-        return self.path + " " + commandline_to_str(k + "=" + v for k, v in self.attributes.items())
+        items = self._attribute_items if self._attributes is None else self._attributes.items()
+        return self.path + " " + commandline_to_str(k + "=" + v for k, v in items)
 
     def __repr__(self):
         return "<MTREE entry: " + str(self) + ">"
@@ -98,7 +167,7 @@ class MtreeEntry(object):
 
 class MtreeFile(object):
     def __init__(self, file: "typing.Union[io.StringIO,Path,typing.IO]" = None, contents_root: Path = None):
-        self._mtree = OrderedDict()  # type: typing.Dict[str, MtreeEntry]
+        self._mtree = dict()  # type: typing.Dict[str, MtreeEntry]  # write() sorts the entries by path
         if file:
             self.load(file, contents_root=contents_root, append=False)
 
@@ -112,20 +181,40 @@ class MtreeFile(object):
         if "_TEST_SKIP_METALOG" in os.environ:
             status_update("Not parsing", file, "in test mode")
             return  # avoid parsing all metalog files in the basic sanity checks
-        for line in file.readlines():
+        contents_root_str = str(contents_root) if contents_root else None
+        defaults = OrderedDict()  # type: typing.Dict[str, str]
+        keyword_cache = dict()  # type: typing.Dict[str, typing.Tuple[str, str]]
+        mtree = self._mtree
+        for line in file:
             line = line.strip()
-            if not line or line.startswith("#"):
+            if not line or line[0] == "#":
                 continue
             try:
-                entry = MtreeEntry.parse(line, contents_root)
-                key = str(entry.path)
-                assert key == "." or os.path.normpath(key[2:]) == key[2:]
-                if key in self._mtree:
+                if line[0] == "/":
+                    self._parse_special_command(line, defaults, keyword_cache)
+                    continue
+                entry = MtreeEntry._parse(line, contents_root_str, defaults, keyword_cache)
+                if entry.path in mtree:
                     warning_message("Found duplicate definition for", entry.path)
-                self._mtree[key] = entry
+                mtree[entry.path] = entry
             except Exception as e:
                 warning_message("Could not parse line", line, "in mtree file", file, ":", e)
 
+    @staticmethod
+    def _parse_special_command(line: str, defaults: "typing.Dict[str, str]",
+                               keyword_cache: "typing.Dict[str, typing.Tuple[str, str]]"):
+        elements = line.split()
+        if elements[0] == "/set":
+            defaults.update(MtreeEntry._parse_keywords(elements[1:], None, keyword_cache))
+        elif elements[0] == "/unset":
+            for keyword in elements[1:]:
+                if keyword == "all":
+                    defaults.clear()
+                else:
+                    defaults.pop(keyword, None)
+        else:
+            raise ValueError("Unknown special command " + elements[0])
+
     @staticmethod
     def _ensure_mtree_mode_fmt(mode: "typing.Union[str, int]") -> str:
         if not isinstance(mode, str):
@@ -144,14 +233,18 @@ class MtreeFile(object):
             mtree_path = "./" + os.path.normpath(path)
         return mtree_path
 
-    @staticmethod
-    def infer_mode_string(path: Path, should_be_dir):
+    @classmethod
+    def infer_mode_string(cls, path: Path, should_be_dir):
         try:
             result = "0{0:o}".format(stat.S_IMODE(path.lstat().st_mode))  # format as octal with leading 0 prefix
         except IOError as e:
             default = "0755" if should_be_dir else "0644"
             warning_message("Failed to stat", path, "assuming mode", default, e)
             result = default
+        return cls._fix_ssh_mode_string(path, result)
+
+    @staticmethod
+    def _fix_ssh_mode_string(path: Path, result: str) -> str:
         # make sure that the .ssh config files are installed with the right permissions
         if path.name == ".ssh" and result != "0700":
             warning_message("Wrong file mode", result, "for", path, " --  it should be 0700, fixing it for image")
@@ -162,7 +255,10 @@ class MtreeFile(object):
         return result
 
     def add_file(self, file: "typing.Optional[Path]", path_in_image, mode=None, uname="root", gname="wheel",
-                 print_status=True, parent_dir_mode=None, symlink_dest: str = None):
+                 print_status=True, parent_dir_mode=None, symlink_dest: str = None, st_mode: int = None):
+        """
+        :param st_mode: the lstat() st_mode of file if it is already known (avoids another stat() call)
+        """
         if isinstance(path_in_image, Path):
             path_in_image = str(path_in_image)
         assert not path_in_image.startswith("/")
@@ -170,6 +266,8 @@ class MtreeFile(object):
         if mode is None:
             if symlink_dest is not None:
                 mode = "0755"
+            elif st_mode is not None:
+                mode = self._fix_ssh_mode_string(file, "0{0:o}".format(stat.S_IMODE(st_mode)))
             else:
                 mode = self.infer_mode_string(file, False)
         mode = self._ensure_mtree_mode_fmt(mode)
@@ -180,12 +278,12 @@ class MtreeFile(object):
             reference_dir = None
         else:
             reference_dir = file.parent
-        self.add_dir(str(Path(path_in_image).parent), mode=parent_dir_mode, uname=uname, gname=gname,
+        self.add_dir(os.path.dirname(path_in_image) or ".", mode=parent_dir_mode, uname=uname, gname=gname,
                      reference_dir=reference_dir, print_status=print_status)
         if symlink_dest is not None:
             mtree_type = "link"
             last_attrib = ("link", str(symlink_dest))
-        elif file.is_symlink():
+        elif stat.S_ISLNK(st_mode) if st_mode is not None else file.is_symlink():
             mtree_type = "link"
             last_attrib = ("link", os.readlink(str(file)))
         else:
@@ -201,6 +299,11 @@ class MtreeFile(object):
                 status_update("Adding file", file, "to mtree as", mtree_path, file=sys.stderr)
         self._mtree[mtree_path] = MtreeEntry(mtree_path, attribs)
 
+    def add_files(self, files: "typing.Iterable[typing.Tuple[Path, str, int]]", **kwargs):
+        """Add a batch of (file, path_in_image, lstat() st_mode) tuples, e.g. collected using os.scandir()"""
+        for file, path_in_image, st_mode in files:
+            self.add_file(file, path_in_image, st_mode=st_mode, **kwargs)
+
     def add_symlink(self, *, src_symlink: Path = None, symlink_dest=None, path_in_image: str, **kwargs):
         if src_symlink is not None:
             assert symlink_dest is None
@@ -231,7 +334,7 @@ class MtreeFile(object):
                 warning_message("Wrong file mode", mode, "for /", path, " --  it should be 0755, fixing it for image")
                 mode = "0755"
         # recursively add all parent dirs that don't exist yet
-        parent = str(Path(path).parent)
+        parent = os.path.dirname(path) or "."
         if parent != path:  # avoid recursion for path == "."
             # print("adding parent", parent, file=sys.stderr)
             if reference_dir is not None:
@@ -248,6 +351,10 @@ class MtreeFile(object):
         mtree_path = self._ensure_mtree_path_fmt(str(item))
         return mtree_path in self._mtree
 
+    def entries(self) -> "typing.List[MtreeEntry]":
+        """Returns all entries sorted by path (i.e. directories are returned before their contents)"""
+        return [self._mtree[path] for path in sorted(self._mtree.keys())]
+
     def __repr__(self):
         import pprint
         return "<MTREE: " + pprint.pformat(self._mtree) + ">"
@@ -0,0 +1,160 @@
+# -
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import datetime
+import json
+import os
+import re
+import typing
+from collections import namedtuple, OrderedDict
+from pathlib import Path
+
+__all__ = ["NinjaLogEdge", "NinjaBuildSummary", "parse_ninja_log", "update_ninja_build_history"]  # no-combine
+
+NinjaLogEdge = namedtuple("NinjaLogEdge", ["start_ms", "end_ms", "outputs", "command_hash"])
+
+_CMAKE_TARGET_RE = re.compile(r"CMakeFiles/([^/]+)\.dir/")
+_OBJECT_FILE_SUFFIXES = (".o", ".obj")
+
+
+def parse_ninja_log(path: Path, offset: int = 0) -> "typing.List[NinjaLogEdge]":
+    """
+    Returns the edges that were run by the ninja invocations that appended to path after offset (the size of the file
+    before the build was started). Entries are appended in completion order and the times are relative to the start
+    of each ninja invocation, so a new invocation starts whenever the end time goes backwards.
+    If ninja recompacted the log (i.e. it is smaller than offset), only the last invocation is returned.
+    """
+    with path.open("rb") as f:
+        recompacted = offset > os.fstat(f.fileno()).st_size
+        f.seek(0 if recompacted else offset)
+        data = f.read().decode("utf-8", errors="replace")
+    invocations = []  # type: typing.List[typing.List[NinjaLogEdge]]
+    previous_end = None
+    for line in data.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        fields = line.split("\t")
+        if len(fields) != 5:
+            continue
+        start, end, output, command_hash = int(fields[0]), int(fields[1]), fields[3], fields[4]
+        if previous_end is None or end < previous_end:
+            invocations.append([])
+        previous_end = end
+        edges = invocations[-1]
+        # Edges with multiple outputs have one line (with the same times and command hash) per output
+        if edges and edges[-1].command_hash == command_hash and edges[-1].start_ms == start and \
+                edges[-1].end_ms == end:
+            edges[-1].outputs.append(output)
+        else:
+            edges.append(NinjaLogEdge(start, end, [output], command_hash))
+    if recompacted:
+        invocations = invocations[-1:]
+    return [edge for edges in invocations for edge in edges]
+
+
+class NinjaBuildSummary(object):
+    def __init__(self, edges: "typing.List[NinjaLogEdge]"):
+        self.edges = edges
+        self.num_edges = len(edges)
+        self.serial_seconds = sum(e.end_ms - e.start_ms for e in edges) / 1000
+        # Multiple ninja invocations run one after another -> sum up the wall time of each of them
+        wall_ms = 0
+        invocation_start = invocation_end = None
+        for edge in edges:
+            if invocation_end is not None and edge.end_ms < invocation_end:
+                wall_ms += invocation_end - invocation_start
+                invocation_start = invocation_end = None
+            invocation_start = edge.start_ms if invocation_start is None else min(invocation_start, edge.start_ms)
+            invocation_end = edge.end_ms
+        if invocation_end is not None:
+            wall_ms += invocation_end - invocation_start
+        self.wall_seconds = wall_ms / 1000
+        # Everything that does not produce an object file is (mostly) a link step
+        self.link_seconds = sum(e.end_ms - e.start_ms for e in edges
+                                if not e.outputs[0].endswith(_OBJECT_FILE_SUFFIXES)) / 1000
+
+    @property
+    def parallelism(self) -> float:
+        return self.serial_seconds / self.wall_seconds if self.wall_seconds else 0.0
+
+    def slowest_edges(self, count: int) -> "typing.List[typing.Tuple[str, float]]":
+        edges = sorted(self.edges, key=lambda e: e.end_ms - e.start_ms, reverse=True)[:count]
+        return [(e.outputs[0], (e.end_ms - e.start_ms) / 1000) for e in edges]
+
+    @staticmethod
+    def group_name(output: str) -> str:
+        """:return: the CMake target that output belongs to (or the containing directory for other outputs)"""
+        match = _CMAKE_TARGET_RE.search(output)
+        if match:
+            return match.group(1)
+        return os.path.dirname(output) or "."
+
+    def slowest_groups(self, count: int) -> "typing.List[typing.Tuple[str, float, int]]":
+        groups = OrderedDict()  # type: typing.Dict[str, typing.List[float]]
+        for edge in self.edges:
+            group = groups.setdefault(self.group_name(edge.outputs[0]), [0.0, 0])
+            group[0] += (edge.end_ms - edge.start_ms) / 1000
+            group[1] += 1
+        result = sorted(groups.items(), key=lambda item: item[1][0], reverse=True)[:count]
+        return [(name, seconds, num_edges) for name, (seconds, num_edges) in result]
+
+    def to_json(self, top_edges: int, **extra) -> dict:
+        result = OrderedDict(time=datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), edges=self.num_edges,
+                             serial_seconds=round(self.serial_seconds, 3), wall_seconds=round(self.wall_seconds, 3),
+                             link_seconds=round(self.link_seconds, 3))
+        result.update(extra)
+        result["slowest_edges"] = [[output, round(seconds, 3)] for output, seconds in self.slowest_edges(top_edges)]
+        return result
+
+
+def update_ninja_build_history(history_file: Path, entry: dict,
+                               max_entries: int = 100) -> "typing.Optional[dict]":
+    """
+    Appends entry to the history file (one JSON object per line).
+    :return: the most recent previous entry for a build of similar size (number of edges within 10%), which can be
+    used to detect regressions (e.g. compare a full rebuild to the previous full rebuild and not to a no-op build).
+    """
+    history = []  # type: typing.List[dict]
+    try:
+        with history_file.open("r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    history.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    previous = None
+    for old_entry in reversed(history):
+        if abs(old_entry.get("edges", 0) - entry["edges"]) <= entry["edges"] / 10:
+            previous = old_entry
+            break
+    history = history[-(max_entries - 1):] + [entry]
+    history_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = history_file.with_name(history_file.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        for line in history:
+            f.write(json.dumps(line) + "\n")
+    os.replace(str(tmp), str(history_file))
+    return previous
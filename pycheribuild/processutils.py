@@ -31,11 +31,14 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import atexit
 import contextlib
 import fcntl
 import functools
+import json
 import os
 import re
+import selectors
 import shlex
 import shutil
 import signal
@@ -43,6 +46,7 @@ import subprocess
 import sys
 import tempfile
 import termios
+import time
 import typing
 from pathlib import Path
 from subprocess import CompletedProcess
@@ -52,7 +56,8 @@ from .utils import (ConfigBase, fatal_error, get_global_config, OSInfo, status_u
 
 __all__ = ["print_command", "get_compiler_info", "CompilerInfo", "popen", "popen_handle_noexec",  # no-combine
            "run_command", "latest_system_clang_tool", "commandline_to_str", "set_env", "extract_version",  # no-combine
-           "get_program_version", "check_call_handle_noexec", "get_version_output", "keep_terminal_sane"]  # no-combine
+           "get_program_version", "check_call_handle_noexec", "get_version_output", "keep_terminal_sane",  # no-combine
+           "stream_process_output"]  # no-combine
 
 
 def __filter_env(env: dict) -> dict:
@@ -245,6 +250,79 @@ def popen_handle_noexec(cmdline: "typing.List[str]", **kwargs) -> subprocess.Pop
         raise _make_called_process_error(e.errno, cmdline, cwd=kwargs.get("cwd", None), stderr=str(e).encode("utf-8"))
 
 
+def stream_process_output(stdout: "typing.IO", stderr: "typing.Optional[typing.IO]",
+                          logfile: "typing.Optional[typing.IO]", *,
+                          stdout_callback: "typing.Callable[[bytes], None]",
+                          stderr_callback: "typing.Callable[[bytes], None]",
+                          split_stdout_lines=True, latest_stdout_line_only=False, update_interval: float = 0.1,
+                          chunk_size: int = 64 * 1024) -> None:
+    """
+    Copy the output of a subprocess to a logfile and pass it on to callbacks for display.
+
+    Both pipes are read in large chunks from a single thread. All complete lines of a chunk are appended to the
+    logfile with a single write (partial lines are held back so that stdout and stderr only interleave at line
+    boundaries) and lines are only split out for the callbacks.
+    :param split_stdout_lines: if False, stdout_callback receives chunks of complete lines instead of single lines
+    :param latest_stdout_line_only: only pass the most recent stdout line to stdout_callback and do so at most once
+    every update_interval seconds. This is sufficient for filters that keep overwriting the current terminal line.
+    """
+    selector = selectors.DefaultSelector()
+    pending = {}  # type: typing.Dict[int, bytes]
+    for stream in (stdout, stderr):
+        if stream is not None:
+            selector.register(stream.fileno(), selectors.EVENT_READ)
+            pending[stream.fileno()] = b""
+    stdout_fd = stdout.fileno()
+    deferred_line = None  # type: typing.Optional[bytes]
+    last_update = 0.0
+    try:
+        while selector.get_map():
+            events = selector.select(update_interval if deferred_line is not None else None)
+            if deferred_line is not None and time.monotonic() - last_update >= update_interval:
+                stdout_callback(deferred_line)
+                deferred_line = None
+                last_update = time.monotonic()
+            for key, _ in events:
+                fd = key.fd
+                chunk = os.read(fd, chunk_size)
+                if not chunk:
+                    # EOF: flush the remaining partial line
+                    selector.unregister(fd)
+                    data = pending.pop(fd)
+                    if data and not data.endswith(b"\n"):
+                        data += b"\n"
+                else:
+                    data = pending[fd] + chunk if pending[fd] else chunk
+                    end = data.rfind(b"\n") + 1
+                    if end != len(data):
+                        pending[fd] = data[end:]
+                        data = data[:end]
+                    else:
+                        pending[fd] = b""
+                if not data:
+                    continue
+                if logfile is not None:
+                    logfile.write(data)
+                if fd != stdout_fd:
+                    for line in data.splitlines(keepends=True):
+                        stderr_callback(line)
+                elif not split_stdout_lines:
+                    stdout_callback(data)
+                elif latest_stdout_line_only:
+                    deferred_line = data[data.rfind(b"\n", 0, len(data) - 1) + 1:]
+                    if time.monotonic() - last_update >= update_interval:
+                        stdout_callback(deferred_line)
+                        deferred_line = None
+                        last_update = time.monotonic()
+                else:
+                    for line in data.splitlines(keepends=True):
+                        stdout_callback(line)
+        if deferred_line is not None:
+            stdout_callback(deferred_line)
+    finally:
+        selector.close()
+
+
 # https://stackoverflow.com/a/15257702/894271
 def _become_tty_foreground_process():
     os.setpgrp()
@@ -384,6 +462,8 @@ class CompilerInfo(object):
         self.config = config
         self._resource_dir = None  # type: typing.Optional[Path]
         self._supported_warning_flags = dict()  # type: typing.Dict[str, bool]
+        if not config.TEST_MODE:
+            self._supported_warning_flags.update(_probe_cache.get(path, "warning_flags") or {})
         assert compiler in ("unknown compiler", "clang", "apple-clang", "gcc"), "unknown type: " + compiler
 
     def get_resource_dir(self) -> Path:
@@ -391,6 +471,10 @@ class CompilerInfo(object):
         if not self._resource_dir:
             if not self.path.exists():
                 return Path("/unknown/resource/dir")  # avoid failing in jenkins
+            cached = None if self.config.TEST_MODE else _probe_cache.get(self.path, "resource_dir")
+            if cached:
+                self._resource_dir = Path(cached)
+                return self._resource_dir
             # Clang 5.0 added the -print-resource-dir flag
             if self.is_clang and self.version >= (5, 0):
                 resource_dir = run_command(self.path, "-print-resource-dir", config=self.config,
@@ -404,6 +488,8 @@ class CompilerInfo(object):
                                       capture_error=True, print_verbose_only=True, run_in_pretend_mode=True)
                 resource_dir_pat = re.compile(b'"-cc1".+"-resource-dir" "([^"]+)"')
                 self._resource_dir = Path(resource_dir_pat.search(cc1_cmd.stderr).group(1).decode("utf-8"))
+            if not self.config.TEST_MODE:
+                _probe_cache.set(self.path, "resource_dir", str(self._resource_dir))
         return self._resource_dir
 
     def _supports_warning_flag(self, flag: str):
@@ -422,6 +508,8 @@ class CompilerInfo(object):
         if result is None:
             result = self._supports_warning_flag(flag)
             self._supported_warning_flags[flag] = result
+            if not self.config.TEST_MODE:
+                _probe_cache.set(self.path, "warning_flags", self._supported_warning_flags)
         return result
 
     def get_matching_binutil(self, binutil):
@@ -460,6 +548,82 @@ class CompilerInfo(object):
         return "{} ({} {})".format(self.path, self.compiler, ".".join(map(str, self.version)))
 
 
+class _ProbeCache(object):
+    """
+    Stores the results of probing compilers and other tools (version, default target, resource directory, supported
+    warning flags and --version output) in a JSON file so that later cheribuild invocations don't have to run the same
+    commands again. Entries are keyed on the real path of the binary and are discarded when its size or modification
+    time changes.
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self):
+        self._entries = None  # type: typing.Optional[typing.Dict[str, dict]]
+        self._changed_keys = set()  # type: typing.Set[str]
+
+    @property
+    def path(self) -> Path:
+        cache_home = os.getenv("XDG_CACHE_HOME") or str(Path.home() / ".cache")
+        return Path(cache_home, "cheribuild", "probe-cache.json")
+
+    def _read(self) -> "typing.Dict[str, dict]":
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.FORMAT_VERSION:
+                return data["entries"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+        return dict()
+
+    def _entry(self, binary: Path, create: bool) -> "typing.Optional[typing.Tuple[str, dict]]":
+        try:
+            stat = binary.stat()
+            key = str(binary.resolve())
+        except OSError:
+            return None  # Don't cache anything for binaries that don't exist (yet)
+        if self._entries is None:
+            self._entries = self._read()
+            atexit.register(self.save)
+        stamp = [stat.st_mtime_ns, stat.st_size]
+        entry = self._entries.get(key)
+        if entry is None or entry.get("stamp") != stamp:
+            if not create:
+                return None
+            entry = {"stamp": stamp}
+            self._entries[key] = entry
+        return key, entry
+
+    def get(self, binary: Path, name: str):
+        key_and_entry = self._entry(binary, create=False)
+        return key_and_entry[1].get(name) if key_and_entry else None
+
+    def set(self, binary: Path, name: str, value):
+        key_and_entry = self._entry(binary, create=True)
+        if key_and_entry:
+            key, entry = key_and_entry
+            entry[name] = value
+            self._changed_keys.add(key)
+
+    def save(self):
+        if not self._changed_keys:
+            return
+        # Merge with the current file contents since other cheribuild processes might have updated it
+        entries = self._read()
+        for key in self._changed_keys:
+            entries[key] = self._entries[key]
+        self._changed_keys.clear()
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile("w", dir=str(self.path.parent), prefix=self.path.name, suffix=".tmp",
+                                             delete=False, encoding="utf-8") as tmp:
+                json.dump({"version": self.FORMAT_VERSION, "entries": entries}, tmp, sort_keys=True)
+            os.replace(tmp.name, str(self.path))
+        except OSError as e:
+            warning_message("Could not update", self.path, "-", e)
+
+
+_probe_cache = _ProbeCache()
 _cached_compiler_infos = dict()  # type: typing.Dict[Path, CompilerInfo]
 
 
@@ -477,6 +641,12 @@ def get_compiler_info(compiler: "typing.Union[str, Path]", *, config: ConfigBase
         if compiler_realpath in _cached_compiler_infos:
             _cached_compiler_infos[compiler] = _cached_compiler_infos[compiler_realpath]
         compiler = compiler_realpath
+    if compiler not in _cached_compiler_infos and not config.TEST_MODE:
+        cached = _probe_cache.get(compiler, "compiler")
+        if cached:
+            _cached_compiler_infos[compiler] = CompilerInfo(compiler, cached["kind"], tuple(cached["version"]),
+                                                            cached["version_str"], cached["default_target"],
+                                                            config=config)
     if compiler not in _cached_compiler_infos:
         clang_version_pattern = re.compile(b"clang version (\\d+)\\.(\\d+)\\.?(\\d+)?")
         gcc_version_pattern = re.compile(b"gcc version (\\d+)\\.(\\d+)\\.?(\\d+)?")
@@ -527,6 +697,9 @@ def get_compiler_info(compiler: "typing.Union[str, Path]", *, config: ConfigBase
         # Don't cache the result if the -v command failed (e.g. compiler doesn't exist yet)
         if executed_sucessfully:
             _cached_compiler_infos[compiler] = result
+            if not config.TEST_MODE:
+                _probe_cache.set(compiler, "compiler", dict(kind=kind, version=version, version_str=version_str,
+                                                            default_target=target_string))
         return result
     return _cached_compiler_infos[compiler]
 
@@ -538,8 +711,15 @@ def get_version_output(program: Path, command_args: tuple = None, *, config: Con
         config = get_global_config()  # TODO: remove
     if command_args is None:
         command_args = ["--version"]
+    cache_key = " ".join(command_args)
+    cached_outputs = dict() if config.TEST_MODE else (_probe_cache.get(program, "version_output") or dict())
+    if cache_key in cached_outputs:
+        return cached_outputs[cache_key].encode("latin-1")
     prog = run_command([str(program)] + list(command_args), config=config, stdin=subprocess.DEVNULL,
                        stderr=subprocess.STDOUT, capture_output=True, run_in_pretend_mode=True)
+    if not config.TEST_MODE:
+        cached_outputs[cache_key] = prog.stdout.decode("latin-1")
+        _probe_cache.set(program, "version_output", cached_outputs)
     return prog.stdout
 
 
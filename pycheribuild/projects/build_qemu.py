@@ -197,8 +197,8 @@ class BuildQEMUBase(AutotoolsProject):
             "--disable-werror",
             "--disable-pie",  # no need to build as PIE (this just slows down QEMU)
             "--extra-cflags=" + self.commandline_to_str(self.default_compiler_flags + self.CFLAGS),
-            "--cxx=" + str(self.CXX),
-            "--cc=" + str(self.CC),
+            "--cxx=" + self._with_compiler_launcher("CXX", str(self.CXX)),
+            "--cc=" + self._with_compiler_launcher("CC", str(self.CC)),
             # Using /usr/bin/make on macOS breaks compilation DB creation with bear since SIP prevents it from
             # injecting shared libraries into any process that is installed as part of the system.
             "--make=" + self.make_args.command,
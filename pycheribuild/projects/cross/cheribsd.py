@@ -27,6 +27,8 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
+import collections
+import concurrent.futures
 import os
 import shutil
 import subprocess
@@ -38,12 +40,15 @@ from pathlib import Path
 from ..llvm import BuildLLVMMonoRepoBase
 from ..project import (CheriConfig, CPUArchitecture, DefaultInstallDir, flush_stdio, GitRepository,
                        MakeCommandKind, MakeOptions, Project, SimpleProject, TargetBranchInfo)
+from ...archive import ReproducibleTarWriter
 from ...config.compilation_targets import CompilationTargets, FreeBSDTargetInfo
 from ...config.loader import ComputedDefaultValue
 from ...config.target_info import AutoVarInit, CompilerType as FreeBSDToolchainKind, CrossCompileTarget
-from ...processutils import latest_system_clang_tool, print_command
+from ...incrementalbuild import FreeBSDRebuildPlan, freebsd_rebuild_plan, IncrementalBuildState
+from ...mtree import MtreeFile
+from ...processutils import latest_system_clang_tool
 from ...targets import target_manager
-from ...utils import classproperty, include_local_file, is_jenkins_build, OSInfo, ThreadJoiner
+from ...utils import classproperty, is_jenkins_build, OSInfo, ThreadJoiner
 
 
 def freebsd_install_dir(config: CheriConfig, project: SimpleProject):
@@ -293,6 +298,9 @@ class BuildFreeBSD(BuildFreeBSDBase):
                                                        "compile with an assertions-enabled LLVM.")
         cls.fast_rebuild = cls.add_bool_option("fast",
                                                help="Skip some (usually) unnecessary build steps to speed up rebuilds")
+        cls.incremental_rebuild = cls.add_bool_option(
+            "incremental", help="Only rebuild (and install) the subdirectories affected by the source changes since "
+                                "the last successful build. Falls back to a full build if they cannot be determined.")
 
     def default_kernel_config(self):
         xtarget = self.crosscompile_target
@@ -490,6 +498,9 @@ class BuildFreeBSD(BuildFreeBSDBase):
         self.destdir = self.install_dir
         self._install_prefix = Path("/")
         self.kernel_toolchain_exists = False
+        self._incremental_state = None  # type: typing.Optional[IncrementalBuildState]
+        self._incremental_snapshot = None  # type: typing.Optional[dict]
+        self._incremental_plan = None  # type: typing.Optional[FreeBSDRebuildPlan]
         self.cross_toolchain_config = MakeOptions(MakeCommandKind.BsdMake, self)
         assert self.kernel_config is not None
         self.make_args.set(**self.arch_build_flags)
@@ -497,6 +508,14 @@ class BuildFreeBSD(BuildFreeBSDBase):
         if self.subdir_override:
             # build only part of the tree
             self.make_args.set(SUBDIR_OVERRIDE=self.subdir_override)
+        if self.compiler_cache is not None:
+            if self.compiler_cache.kind == "ccache":
+                # Let the FreeBSD build system prefix all compiler invocations (including the bootstrap tools).
+                self.make_args.set_with_options(CCACHE_BUILD=True)
+                self.make_args.set(CCACHE_BIN=self.compiler_cache.executable)
+            else:
+                self.warning("The FreeBSD build system only supports ccache, building", self.target,
+                             "without --compiler-cache", self.compiler_cache.kind)
 
     def _setup_cross_toolchain_config(self):
         if self.use_bootstrapped_toolchain:
@@ -665,7 +684,7 @@ class BuildFreeBSD(BuildFreeBSDBase):
             return self.async_clean_directory(builddir)
 
     def _buildkernel(self, kernconf: str, mfs_root_image: Path = None, extra_make_args=None,
-                     ignore_skip_buildkernel=False):
+                     ignore_skip_buildkernel=False, logfile_name: str = None, make_jobs: int = None):
         # Check that --skip-buildkernel is respected. However, we ignore it for the cheribsd-mfs-root-kernel targets
         # since those targets only build a kernel.
         assert not self.config.skip_buildkernel or ignore_skip_buildkernel, "--skip-buildkernel set but building kernel"
@@ -682,6 +701,18 @@ class BuildFreeBSD(BuildFreeBSDBase):
             kernel_make_args.set(MFS_IMAGE=mfs_root_image)
             if self.compiling_for_mips(include_purecap=True) and "MFS_ROOT" not in kernconf:
                 self.warning("Attempting to build an MFS_ROOT kernel but kernel config name sounds wrong")
+        self._build_kernel_toolchain_if_needed(kernel_make_args)
+        parallel = True
+        if make_jobs is not None:
+            # Only use a share of the --make-jobs budget (used when building multiple kernels concurrently)
+            if make_jobs > 1:
+                kernel_make_args.add_flags("-j" + str(make_jobs))
+            parallel = False
+        self.info("Building kernels for configs:", kernconf)
+        self.run_make("buildkernel", options=kernel_make_args, logfile_name=logfile_name, parallel=parallel,
+                      compilation_db_name="compile_commands_" + kernconf.replace(" ", "_") + ".json")
+
+    def _build_kernel_toolchain_if_needed(self, kernel_make_args: MakeOptions):
         if not self.kernel_toolchain_exists and not self.fast_rebuild:
             kernel_toolchain_opts = kernel_make_args.copy()
             # The kernel seems to use LDFLAGS and ignore XLDFLAGS. Ensure we don't pass those flags when building host
@@ -696,11 +727,9 @@ class BuildFreeBSD(BuildFreeBSDBase):
                 kernel_toolchain_opts.set_with_options(AUTO_OBJ=True)
             self.run_make("kernel-toolchain", options=kernel_toolchain_opts)
             self.kernel_toolchain_exists = True
-        self.info("Building kernels for configs:", kernconf)
-        self.run_make("buildkernel", options=kernel_make_args,
-                      compilation_db_name="compile_commands_" + kernconf.replace(" ", "_") + ".json")
 
-    def _installkernel(self, kernconf, *, install_dir: Path, extra_make_args=None, ignore_skip_buildkernel=False):
+    def _installkernel(self, kernconf, *, install_dir: Path, extra_make_args=None, ignore_skip_buildkernel=False,
+                       logfile_name: str = None):
         # Check that --skip-buildkernel is respected. However, we ignore it for the cheribsd-mfs-root-kernel targets
         # since those targets only build a kernel.
         assert not self.config.skip_buildkernel or ignore_skip_buildkernel, "--skip-buildkernel set but building kernel"
@@ -716,7 +745,7 @@ class BuildFreeBSD(BuildFreeBSDBase):
         install_kernel_args.set_env(DESTDIR=install_dir, METALOG=install_dir / "METALOG.kernel")
         self.info("Installing kernels for configs:", kernconf)
         self.delete_file(install_dir / "METALOG.kernel")  # Ensure that METALOG does not contain stale values.
-        self.run_make("installkernel", options=install_kernel_args, parallel=False)
+        self.run_make("installkernel", options=install_kernel_args, logfile_name=logfile_name, parallel=False)
 
     def compile(self, mfs_root_image: Path = None, sysroot_only=False, all_kernel_configs: str = None, **kwargs):
         # The build seems to behave differently when -j1 is passed (it still complains about parallel make failures)
@@ -736,15 +765,32 @@ class BuildFreeBSD(BuildFreeBSDBase):
             self.run_make("buildsysroot", options=build_args)
             return  # We are done after building the sysroot
 
-        if not self.config.skip_buildworld:
+        if not self.config.skip_buildworld and self.incremental_rebuild:
+            self._incremental_plan = self._compute_incremental_rebuild_plan(build_args)
+            if self._incremental_plan is not None and not self._incremental_plan.subdirs:
+                self.info("No changes to the userspace sources since the last build, skipping buildworld")
+            elif self._incremental_plan is not None:
+                self.info("Rebuilding", len(self._incremental_plan.subdirs), "directories affected by the changes "
+                          "since the last build:", " ".join(self._incremental_plan.subdirs))
+                incremental_args = build_args.copy()
+                incremental_args.set(SUBDIR_OVERRIDE=" ".join(self._incremental_plan.subdirs), WORLDFAST=True)
+                self.run_make("buildworld", options=incremental_args)
+        if not self.config.skip_buildworld and self._incremental_plan is None:
             if self.fast_rebuild:
                 if self.config.clean:
                     self.info("Ignoring --", self.target, "/fast option since --clean was passed", sep="")
                 else:
                     build_args.set(WORLDFAST=True)
-            self.run_make("buildworld", options=build_args)
+            try:
+                self.run_make("buildworld", options=build_args)
+            except BaseException:
+                # The object directory may now be partially cleaned or rebuilt (e.g. with --clean), so the next build
+                # must not rely on the state recorded for the last successful build.
+                if self._incremental_state is not None:
+                    self._incremental_state.invalidate()
+                raise
             self.kernel_toolchain_exists = True  # includes the necessary tools for kernel-toolchain
-        if not self.config.skip_buildkernel and not self.subdir_override:
+        if self._should_build_kernel():
             for i in ("USBROOT", "NFSROOT", "MDROOT"):
                 if ("_" + i) in self.kernel_config:
                     self.info("Not embedding MFS_ROOT image in non-MFS root kernel config:", self.kernel_config)
@@ -754,6 +800,71 @@ class BuildFreeBSD(BuildFreeBSDBase):
                 all_kernel_configs = self.kernel_config
             self._buildkernel(kernconf=all_kernel_configs, mfs_root_image=mfs_root_image)
 
+    def _should_build_kernel(self) -> bool:
+        if self.config.skip_buildkernel or self.subdir_override:
+            return False
+        if self._incremental_plan is not None and not self._incremental_plan.rebuild_kernel:
+            self.verbose_print("Not rebuilding the kernel since no files in sys/ changed since the last build")
+            return False
+        return True
+
+    def _incremental_build_options(self, build_args: MakeOptions) -> str:
+        # Any change to the make flags (or the steps that are run) may affect every file so must trigger a full build
+        env = sorted(k + "=" + str(v) for k, v in build_args.env_vars.items())
+        return self.commandline_to_str(build_args.all_commandline_args + env +
+                                       ["skip_buildkernel=" + str(self.config.skip_buildkernel)])
+
+    def _compute_incremental_rebuild_plan(self, build_args: MakeOptions) -> "typing.Optional[FreeBSDRebuildPlan]":
+        if self.subdir_override:
+            return None
+        self._incremental_state = IncrementalBuildState(self.build_dir / "cheribuild-incremental-state.json",
+                                                        self.source_dir, config=self.config)
+        options = self._incremental_build_options(build_args)
+        # Record the state before building so that changes made while building are picked up by the next build.
+        self._incremental_snapshot = self._incremental_state.snapshot(options)
+        if self.config.clean:
+            return None
+        changed_files = self._incremental_state.changed_files(options)
+        if changed_files is None:
+            self.info("Cannot determine the files changed since the last build, performing a full build.")
+            return None
+        plan = freebsd_rebuild_plan(self.source_dir, changed_files, config=self.config)
+        if plan is None:
+            self.info("Performing a full build since", len(changed_files), "files changed since the last build.")
+        return plan
+
+    def _save_incremental_build_state(self):
+        # Only called once everything has been installed, so a failed build will be retried with the same changes
+        if self._incremental_state is not None:
+            self._incremental_state.save(self._incremental_snapshot)
+
+    def _install_incremental(self, plan: FreeBSDRebuildPlan):
+        if not plan.subdirs:
+            return
+        install_world_args = self.installworld_args
+        install_world_args.set(SUBDIR_OVERRIDE=" ".join(plan.subdirs))
+        # Keep the existing METALOG.world (needed for the disk image) and only update the entries for reinstalled files
+        metalog = self.install_dir / "METALOG.world"
+        incremental_metalog = self.install_dir / "METALOG.incremental"
+        install_world_args.set_env(METALOG=incremental_metalog)
+        self.delete_file(incremental_metalog)
+        self.run_make("installworld", options=install_world_args)
+        if self.config.pretend:
+            return
+        if not metalog.exists():
+            self.fatal("Cannot update", metalog, "since it does not exist. Please perform a full build.")
+            return
+        updated = collections.OrderedDict()
+        for line in incremental_metalog.read_text(encoding="utf-8").splitlines():
+            if line and not line.startswith("#"):
+                updated[line.split(" ", 1)[0]] = line
+        lines = []
+        for line in metalog.read_text(encoding="utf-8").splitlines():
+            lines.append(updated.pop(line.split(" ", 1)[0], line))
+        lines.extend(updated.values())
+        metalog.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        self.delete_file(incremental_metalog)
+
     def _remove_old_rootfs(self):
         assert self.config.clean or not self.keep_old_rootfs
         if self.config.skip_buildworld:
@@ -840,6 +951,12 @@ class BuildFreeBSD(BuildFreeBSDBase):
         if self.config.freebsd_host_tools_only:
             self.info("Skipping install step because freebsd-host-tools was set")
             return
+        if self._incremental_plan is not None and not sysroot_only:
+            self._install_incremental(self._incremental_plan)
+            if self._should_build_kernel():
+                self._installkernel(kernconf=all_kernel_configs or self.kernel_config, install_dir=self.install_dir)
+            self._save_incremental_build_state()
+            return
         # keeping the old rootfs directory prior to install can sometimes cause the build to fail so delete by default
         if self.config.clean or not self.keep_old_rootfs:
             self._remove_old_rootfs()
@@ -908,12 +1025,14 @@ class BuildFreeBSD(BuildFreeBSDBase):
 
         assert not sysroot_only, "Should not end up here"
         if self.config.skip_buildkernel:
+            self._save_incremental_build_state()
             return
         # Run installkernel after installworld since installworld deletes METALOG and therefore the files added by
         # the installkernel step will not be included if we run it first.
         if not all_kernel_configs:
             all_kernel_configs = self.kernel_config
         self._installkernel(kernconf=all_kernel_configs, install_dir=self.install_dir)
+        self._save_incremental_build_state()
 
     def add_cross_build_options(self):
         self.make_args.set_env(CC=self.host_CC, CXX=self.host_CXX, CPP=self.host_CPP)
@@ -1321,7 +1440,7 @@ class BuildCHERIBSD(BuildFreeBSD):
         if self.sysroot_only:
             # Don't attempt to build extra kernels if we are only building a sysroot
             return
-        if not self.config.skip_buildkernel and not self.subdir_override:
+        if self._should_build_kernel():
             if self.extra_kernels:
                 self._buildkernel(kernconf=" ".join(self.extra_kernels))
             if self.extra_kernels_with_mfs and self.mfs_root_image:
@@ -1378,6 +1497,11 @@ class BuildCheriBsdMfsKernel(SimpleProject):
         super().setup_config_options(**kwargs)
         cls.build_fpga_kernels = cls.add_bool_option("build-fpga-kernels", show_help=True, _allow_unknown_targets=True,
                                                      default=True, help="Also build kernels for the FPGA.")
+        cls.parallel_kernel_builds = cls.add_bool_option(
+            "parallel-kernel-builds", _allow_unknown_targets=True,
+            help="Build and install each kernel configuration concurrently (sharing the kernel toolchain) instead of "
+                 "passing all of them to a single buildkernel invocation. The --make-jobs budget is split between the "
+                 "kernels.")
 
     def __init__(self, config: CheriConfig):
         super().__init__(config)
@@ -1442,6 +1566,9 @@ class BuildCheriBsdMfsKernel(SimpleProject):
         # noinspection PyProtectedMember
         # Don't bother with modules for the MFS kernels:
         extra_make_args = dict(NO_MODULES="yes")
+        if self.parallel_kernel_builds and len(kernconfs) > 1:
+            self._build_and_install_kernel_binaries_in_parallel(build_cheribsd, kernconfs, image, extra_make_args)
+            return
         # noinspection PyProtectedMember
         build_cheribsd._buildkernel(kernconf=" ".join(kernconfs), mfs_root_image=image, extra_make_args=extra_make_args,
                                     ignore_skip_buildkernel=True)
@@ -1451,18 +1578,47 @@ class BuildCheriBsdMfsKernel(SimpleProject):
                                           extra_make_args=extra_make_args, ignore_skip_buildkernel=True)
             self.run_cmd("find", td)
             for conf in kernconfs:
-                kernel_install_path = self.installed_kernel_for_config(self, conf)
-                self.delete_file(kernel_install_path)
                 if conf == kernconfs[0]:
-                    source_path = Path(td, "boot/kernel/kernel")
+                    self._copy_kernel_binaries(conf, Path(td, "boot/kernel/kernel"))
                 else:
                     # All other kernels are installed with a suffixex name:
-                    source_path = Path(td, "boot/kernel." + conf, "kernel")
-                self.install_file(source_path, kernel_install_path, force=True, print_verbose_only=False)
-                dbg_info_kernel = source_path.with_suffix(".full")
-                if dbg_info_kernel.exists():
-                    fullkernel_install_path = kernel_install_path.with_name(kernel_install_path.name + ".full")
-                    self.install_file(dbg_info_kernel, fullkernel_install_path, force=True, print_verbose_only=False)
+                    self._copy_kernel_binaries(conf, Path(td, "boot/kernel." + conf, "kernel"))
+
+    def _build_and_install_kernel_binaries_in_parallel(self, build_cheribsd: BuildCHERIBSD,
+                                                       kernconfs: "typing.List[str]", image: Path, extra_make_args):
+        # Every kernel config is built in its own objdir ($OBJDIR/sys/<KERNCONF>), so the buildkernel and installkernel
+        # steps can run concurrently once the (shared) kernel toolchain has been built.
+        # noinspection PyProtectedMember
+        build_cheribsd._build_kernel_toolchain_if_needed(
+            build_cheribsd.kernel_make_args_for_config(" ".join(kernconfs), extra_make_args))
+        jobs_per_kernel = max(1, self.config.make_jobs // len(kernconfs))
+        self.info("Building", len(kernconfs), "kernels in parallel with", jobs_per_kernel, "jobs each")
+
+        def build_and_install(conf: str, install_dir: Path):
+            # noinspection PyProtectedMember
+            build_cheribsd._buildkernel(kernconf=conf, mfs_root_image=image, extra_make_args=extra_make_args,
+                                        ignore_skip_buildkernel=True, logfile_name="make.buildkernel." + conf,
+                                        make_jobs=jobs_per_kernel)
+            self.makedirs(install_dir)
+            # noinspection PyProtectedMember
+            build_cheribsd._installkernel(kernconf=conf, install_dir=install_dir, extra_make_args=extra_make_args,
+                                          ignore_skip_buildkernel=True, logfile_name="make.installkernel." + conf)
+            self._copy_kernel_binaries(conf, install_dir / "boot/kernel/kernel")
+
+        with tempfile.TemporaryDirectory(prefix="cheribuild-" + self.target + "-") as td:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(kernconfs)) as executor:
+                futures = [executor.submit(build_and_install, conf, Path(td, conf)) for conf in kernconfs]
+                for future in futures:
+                    future.result()
+
+    def _copy_kernel_binaries(self, conf: str, source_path: Path):
+        kernel_install_path = self.installed_kernel_for_config(self, conf)
+        self.delete_file(kernel_install_path)
+        self.install_file(source_path, kernel_install_path, force=True, print_verbose_only=False)
+        dbg_info_kernel = source_path.with_suffix(".full")
+        if dbg_info_kernel.exists():
+            fullkernel_install_path = kernel_install_path.with_name(kernel_install_path.name + ".full")
+            self.install_file(dbg_info_kernel, fullkernel_install_path, force=True, print_verbose_only=False)
 
     @property
     def crossbuild(self):
@@ -1620,20 +1776,8 @@ class BuildCheriBsdSysroot(SimpleProject):
 
     def __init__(self, config: CheriConfig):
         super().__init__(config)
-        # GNU tar doesn't accept --include (and doesn't handle METALOG). bsdtar appears to be available
-        # on FreeBSD and macOS by default. On Linux it is not always installed by default.
-        self.bsdtar_cmd = "bsdtar"
-        self.add_required_system_tool("bsdtar", cheribuild_target="bsdtar", apt="libarchive-tools")
         self.install_dir = self.target_info.sdk_root_dir
 
-    def fix_symlinks(self):
-        # copied from the build_sdk.sh script
-        # TODO: we could do this in python as well, but this method works
-        # FIXME: should no longer be needed
-        fixlinks_src = include_local_file("files/fixlinks.c")
-        self.run_cmd("cc", "-x", "c", "-", "-o", self.install_dir / "bin/fixlinks", input=fixlinks_src)
-        self.run_cmd(self.install_dir / "bin/fixlinks", cwd=self.cross_sysroot_path / "usr/lib")
-
     def check_system_dependencies(self):
         super().check_system_dependencies()
         if not OSInfo.IS_FREEBSD and not self.remote_path and not self.rootfs_source_class.get_instance(
@@ -1688,22 +1832,17 @@ class BuildCheriBsdSysroot(SimpleProject):
 
     @property
     def sysroot_archive(self):
+        # Always use gzip (compressed in parallel if pigz is installed) so that the file name does not depend on the
+        # compression programs that happen to be installed on the build host.
         return self.cross_sysroot_path.parent / (self.cross_sysroot_path.name + ".tar.gz")
 
+    # Only the files below these directories are copied to the sysroot
+    sysroot_include_dirs = ("./lib", "./usr/include", "./usr/lib", "./usr/libdata", "./usr/libcheri", "./usr/lib32",
+                            "./usr/lib64", "./usr/libsoft")
+
     def create_sysroot(self):
         # we need to add include files and libraries to the sysroot directory
         self.makedirs(self.cross_sysroot_path / "usr")
-        # use tar+untar to copy all necessary files listed in metalog to the sysroot dir
-        # Since we are using the metalog argument we need to use BSD tar and not GNU tar!
-        bsdtar_path = shutil.which(str(self.bsdtar_cmd))
-        if not bsdtar_path:
-            bsdtar_path = str(self.bsdtar_cmd)
-        tar_cmd = [bsdtar_path, "cf", "-", "--include=./lib/", "--include=./usr/include/",
-                   "--include=./usr/lib/", "--include=./usr/libdata/",
-                   "--include=./usr/libcheri", "--include=./usr/lib32", "--include=./usr/lib64",
-                   "--include=./usr/libsoft",
-                   # only pack those files that are mentioned in METALOG
-                   "@METALOG.world"]
         if self.compiling_for_mips(include_purecap=False) and self.use_cheri_sysroot_for_mips:
             rootfs_target = self.rootfs_source_class.get_instance_for_cross_target(
                 CompilationTargets.CHERIBSD_MIPS_PURECAP, self.config)
@@ -1718,23 +1857,49 @@ class BuildCheriBsdSysroot(SimpleProject):
             else:
                 fixit = "Run `cheribuild.py " + rootfs_target.target + "` first"
             self.fatal("Sysroot source directory", rootfs_dir, "does not contain libc.so.7", fixit_hint=fixit)
-        print_command(tar_cmd, cwd=rootfs_dir)
+        # Copy all the files listed in METALOG to the sysroot directory and create an archive to make it easier to
+        # copy the sysroot to another machine. Both are written in the same pass so every file is only read once.
+        self.delete_file(self.sysroot_archive, print_verbose_only=True)
+        self.info("Copying files listed in", rootfs_dir / "METALOG.world", "to", self.cross_sysroot_path, "and",
+                  self.sysroot_archive)
         if not self.config.pretend:
-            tar_cwd = str(rootfs_dir)
-            with subprocess.Popen(tar_cmd, stdout=subprocess.PIPE, cwd=tar_cwd) as tar:
-                self.run_cmd(["tar", "xf", "-"], stdin=tar.stdout, cwd=self.cross_sysroot_path)
+            with ReproducibleTarWriter(self.sysroot_archive, threads=self.config.make_jobs) as archive:
+                self._copy_metalog_files_to_sysroot(rootfs_dir, archive)
         if not (self.cross_sysroot_path / "lib/libc.so.7").is_file():
             self.fatal(self.cross_sysroot_path, "is missing the libc library, install seems to have failed!")
-
-        # fix symbolic links in the sysroot:
-        self.info("Fixing absolute paths in symbolic links inside lib directory...")
-        self.fix_symlinks()
-        # create an archive to make it easier to copy the sysroot to another machine
-        self.delete_file(self.sysroot_archive, print_verbose_only=True)
-        self.run_cmd("tar", "-czf", self.sysroot_archive, self.cross_sysroot_path.name,
-                     cwd=self.cross_sysroot_path.parent)
         self.info("Successfully populated sysroot")
 
+    def _copy_metalog_files_to_sysroot(self, rootfs_dir: Path, archive: ReproducibleTarWriter):
+        arcname_prefix = self.cross_sysroot_path.name
+        archive.add_directory(arcname_prefix)
+        fixed_links = 0
+        for entry in MtreeFile(rootfs_dir / "METALOG.world").entries():
+            if not any(entry.path == d or entry.path.startswith(d + "/") for d in self.sysroot_include_dirs):
+                continue
+            relpath = entry.path[2:]
+            arcname = arcname_prefix + "/" + relpath
+            target = self.cross_sysroot_path / relpath
+            entry_type = entry.get_attribute("type")
+            mode = int(entry.get_attribute("mode") or "0755", 8)
+            if entry_type == "dir":
+                os.makedirs(str(target), exist_ok=True)
+                archive.add_directory(arcname, mode)
+            elif entry_type == "link":
+                link = entry.get_attribute("link")
+                # Absolute symlinks in usr/lib (e.g. libfoo.so -> /lib/libfoo.so.1) would point to the host libraries
+                if link.startswith("/") and os.path.dirname(relpath) == "usr/lib":
+                    link = "../.." + link
+                    fixed_links += 1
+                os.makedirs(str(target.parent), exist_ok=True)
+                os.symlink(link, str(target))
+                archive.add_symlink(arcname, link)
+            elif entry_type in ("file", "hlink"):
+                os.makedirs(str(target.parent), exist_ok=True)
+                archive.add_file(arcname, rootfs_dir / relpath, mode=mode, copy_to=target)
+            else:
+                self.warning("Not copying", entry.path, "with unsupported type", entry_type, "to the sysroot")
+        self.verbose_print("Fixed", fixed_links, "absolute symbolic links in", self.cross_sysroot_path / "usr/lib")
+
     def process(self):
         if self.config.skip_buildworld:
             self.info("Not building sysroot because --skip-buildworld was passed")
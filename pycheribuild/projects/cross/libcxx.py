@@ -221,6 +221,10 @@ class BuildLibCXX(_CxxRuntimeCMakeProject):
                                               help="Number of QEMU instances spawned to run tests "
                                                    "(default: number of build jobs (-j flag) / 2)",
                                               default=lambda c, p: c.make_jobs / 2, kind=int)
+        cls.use_guest_pool = cls.add_bool_option("use-guest-pool",
+                                                 help="Run the tests on a pool of parallel-test-jobs guests that "
+                                                      "each run the next test as soon as they are idle instead of "
+                                                      "splitting the testsuite into one fixed shard per guest")
 
     def __init__(self, config: CheriConfig):
         super().__init__(config)
@@ -356,7 +360,8 @@ class BuildLibCXX(_CxxRuntimeCMakeProject):
             self.run_make("check-cxx", cwd=self.build_dir)
         else:
             # long running test -> speed up by using a kernel without invariants
-            self.target_info.run_cheribsd_test_script("run_libcxx_tests.py", "--parallel-jobs", self.test_jobs,
+            parallel_flag = "--guest-pool" if self.use_guest_pool else "--parallel-jobs"
+            self.target_info.run_cheribsd_test_script("run_libcxx_tests.py", parallel_flag, self.test_jobs,
                                                       "--ssh-executor-script", self.source_dir / "utils/ssh.py",
                                                       use_benchmark_kernel_by_default=True)
 
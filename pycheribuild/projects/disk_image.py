@@ -28,8 +28,12 @@
 # SUCH DAMAGE.
 #
 
+import concurrent.futures
+import hashlib
 import io
+import json
 import os
+import re
 import shutil
 import sys
 import tempfile
@@ -44,7 +48,7 @@ from .project import (AutotoolsProject, CheriConfig, ComputedDefaultValue, CPUAr
 from ..config.compilation_targets import CompilationTargets
 from ..mtree import MtreeFile
 from ..targets import target_manager
-from ..utils import AnsiColour, classproperty, coloured, include_local_file, OSInfo
+from ..utils import AnsiColour, classproperty, coloured, include_local_file, OSInfo, warning_message
 
 
 # Notes:
@@ -110,6 +114,48 @@ def _default_disk_image_hostname(prefix: str) -> "ComputedDefaultValue[str]":
         as_string=prefix + "-<ARCHITECTURE>")
 
 
+def _scan_directory_tree(root: str) -> "typing.List[typing.Tuple[str, os.DirEntry]]":
+    """
+    Returns (path relative to root, DirEntry) for all non-directory entries below root, sorted by path. Like os.walk()
+    symlinks to directories are not followed (and not included). The top-level subdirectories are scanned in parallel.
+    """
+    def scan_subtree(relpath: str, path: str) -> "typing.List[typing.Tuple[str, os.DirEntry]]":
+        result = []
+        pending = [(relpath, path)]
+        while pending:
+            dir_relpath, dir_path = pending.pop()
+            try:
+                for entry in os.scandir(dir_path):
+                    entry_relpath = dir_relpath + "/" + entry.name
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            pending.append((entry_relpath, entry.path))
+                    else:
+                        result.append((entry_relpath, entry))
+            except OSError as e:
+                warning_message("Could not scan", dir_path, e)
+        return result
+
+    files = []
+    subdirs = []
+    try:
+        for entry in os.scandir(root):
+            if not entry.is_dir():
+                files.append((entry.name, entry))
+            elif not entry.is_symlink():
+                subdirs.append(entry)
+    except OSError as e:
+        # Like os.walk() ignore a missing or unreadable root directory
+        warning_message("Could not scan", root, e)
+        return files
+    # Most of the time is spent in the scandir()/stat() syscalls which release the GIL, so using threads helps here.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+        for subtree in executor.map(lambda e: scan_subtree(e.name, e.path), subdirs):
+            files.extend(subtree)
+    files.sort(key=lambda f: f[0])
+    return files
+
+
 class _BuildDiskImageBase(SimpleProject):
     do_not_add_to_targets = True
     disk_image_path = None  # type: Path
@@ -152,6 +198,11 @@ class _BuildDiskImageBase(SimpleProject):
                                                   help="The output path for the QEMU disk image", show_help=True)
         cls.force_overwrite = cls.add_bool_option("force-overwrite", default=False,
                                                   help="Overwrite an existing disk image without prompting")
+        cls.incremental = cls.add_bool_option(
+            "incremental", default=False,
+            help="Keep the existing disk image if no file in the image manifest (or its metadata) changed since the "
+                 "image was last built. The manifest state is saved to <IMGPATH>.manifest-state.json. Note: changes "
+                 "made to the image by booting it are not detected, use --clean to force a rebuild.")
 
     def __init__(self, config, source_class: "typing.Type[BuildFreeBSD]"):
         super().__init__(config)
@@ -685,7 +736,11 @@ class _BuildDiskImageBase(SimpleProject):
             # Given a directory, derive the default file name inside it
             self.disk_image_path = _default_disk_image_name(self.config, self.disk_image_path, self)
 
-        if self.disk_image_path.is_file():
+        manifest_state_file = self.disk_image_path.with_name(self.disk_image_path.name + ".manifest-state.json")
+        incremental = self.incremental and not self.config.clean
+        if not incremental:
+            self.delete_file(manifest_state_file)
+        if self.disk_image_path.is_file() and not incremental:
             # only show prompt if we can actually input something to stdin
             if not self.config.clean and not self.force_overwrite:
                 # with --clean always delete the image
@@ -748,38 +803,100 @@ class _BuildDiskImageBase(SimpleProject):
                 # skip adding to the metalog in the git push hook since it takes a long time and isn't that useful
                 self.add_unlisted_files_to_metalog()
 
+            if incremental:
+                old_state = self._load_manifest_state(manifest_state_file)
+                new_state = self._compute_manifest_state(old_state)
+                if self.disk_image_path.is_file() and self._manifest_state_unchanged(old_state, new_state):
+                    self.info("Disk image", self.disk_image_path, "is up to date (none of the",
+                              len(new_state["files"]), "files in the image changed), not running makefs.")
+                    self.tmpdir = None
+                    self.manifest_file = None
+                    return
+                self.delete_file(manifest_state_file)
+                self.delete_file(self.disk_image_path)
             # finally create the disk image
             self.make_disk_image()
+            if incremental and not self.config.pretend:
+                with manifest_state_file.open("w", encoding="utf-8") as f:
+                    json.dump(new_state, f)
         self.tmpdir = None
         self.manifest_file = None
 
+    @staticmethod
+    def _load_manifest_state(state_file: Path) -> dict:
+        try:
+            with state_file.open("r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _compute_manifest_state(self, old_state: dict) -> dict:
+        """
+        Compute a hash of the final image manifest and the size, mtime and SHA256 of every file added to the image.
+        The SHA256 is only recomputed if size or mtime changed since the last build (installworld always updates the
+        mtime, so this ensures that reinstalling unchanged files doesn't invalidate the image).
+        """
+        tmpdir_prefix = str(self.tmpdir) + "/"
+        old_files = old_state.get("files", {})  # type: typing.Dict[str, typing.List]
+        files = dict()
+        manifest_hash = hashlib.sha256()
+        for option in (self.makefs_cmd, self.mkimg_cmd, self.is_minimal, self.big_endian, self.is_x86,
+                       self.minimum_image_size, self.use_qcow2, self.crosscompile_target.generic_suffix):
+            manifest_hash.update(str(option).encode("utf-8") + b"\0")
+        # noinspection PyProtectedMember
+        mtree_entries = self.mtree._mtree
+        for path in sorted(mtree_entries.keys()):
+            entry = mtree_entries[path]
+            # The files generated in the temporary directory have a different path and mtime every time
+            manifest_hash.update(str(entry).replace(tmpdir_prefix, "$TMPDIR/").encode("utf-8") + b"\n")
+            contents = entry.get_attribute("contents")
+            if contents is None:
+                continue
+            contents_path = Path(self.rootfs_dir, contents)  # relative contents= paths are relative to the rootfs
+            try:
+                st = contents_path.stat()
+            except OSError:
+                continue  # makefs will report an error
+            old = old_files.get(path)
+            if old and old[0] == st.st_size and old[1] == st.st_mtime_ns and not contents.startswith(tmpdir_prefix):
+                sha256 = old[2]
+            else:
+                sha256 = self.sha256sum(contents_path)
+            files[path] = [st.st_size, st.st_mtime_ns, sha256]
+        return {"manifest": manifest_hash.hexdigest(), "files": files}
+
+    def _manifest_state_unchanged(self, old_state: dict, new_state: dict) -> bool:
+        if old_state.get("manifest") != new_state["manifest"]:
+            self.verbose_print("Disk image manifest or makefs options changed")
+            return False
+        old_files = old_state.get("files", {})
+        changed = [path for path, (_, _, sha256) in new_state["files"].items()
+                   if path not in old_files or old_files[path][2] != sha256]
+        if changed:
+            self.info("Rebuilding disk image since", len(changed), "files changed:",
+                      " ".join(changed[:10]) + (" ..." if len(changed) > 10 else ""))
+            return False
+        return True
+
     def add_unlisted_files_to_metalog(self):
         unlisted_files = []
-        rootfs_str = str(self.rootfs_dir)  # compat with python < 3.6
-        for root, dirnames, filenames in os.walk(rootfs_str):
-            for filename in filenames:
-                full_path = Path(root, filename)
-                target_path = os.path.relpath(str(full_path), rootfs_str)
-                added = False
-                for prefix in self.auto_prefixes:
-                    if target_path.startswith(prefix):
-                        self.mtree.add_file(full_path, target_path, print_status=self.config.verbose)
-                        added = True
-                        break
-                if added:
-                    continue
-                elif target_path not in self.mtree:
-                    # METALOG is not added to the disk image
-                    if target_path not in ("METALOG", "METALOG.kernel", "METALOG.world"):
-                        unlisted_files.append((full_path, target_path))
+        auto_files = []
+        auto_prefixes_regex = re.compile("|".join(re.escape(prefix) for prefix in self.auto_prefixes))
+        for target_path, entry in _scan_directory_tree(str(self.rootfs_dir)):
+            if auto_prefixes_regex.match(target_path):
+                auto_files.append((Path(entry.path), target_path, entry.stat(follow_symlinks=False).st_mode))
+            elif target_path not in self.mtree:
+                # METALOG is not added to the disk image
+                if target_path not in ("METALOG", "METALOG.kernel", "METALOG.world"):
+                    unlisted_files.append((Path(entry.path), target_path, entry.stat(follow_symlinks=False).st_mode))
+        self.mtree.add_files(auto_files, print_status=self.config.verbose)
         if unlisted_files:
             print("Found the following files in the rootfs that are not listed in METALOG:")
             for i in unlisted_files:
                 print("\t", i[1])
             if self.query_yes_no("Should these files also be added to the image?", default_result=True,
                                  force_result=True):
-                for i in unlisted_files:
-                    self.mtree.add_file(i[0], i[1], print_status=self.config.verbose)
+                self.mtree.add_files(unlisted_files, print_status=self.config.verbose)
 
     def generate_ssh_host_keys(self):
         # do the same as "ssh-keygen -A" just with a different output directory as it does not allow customizing that
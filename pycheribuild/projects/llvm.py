@@ -126,7 +126,8 @@ class BuildLLVMBase(CMakeProject):
             # For debug builds we default to enabling expensive checks (override using --llvm/cmake-options)
             self.add_cmake_options(LLVM_ENABLE_EXPENSIVE_CHECKS=True)
 
-        self.add_cmake_options(LLVM_CCACHE_BUILD=self.use_ccache)
+        # --compiler-cache already sets CMAKE_<LANG>_COMPILER_LAUNCHER, don't wrap the compiler twice
+        self.add_cmake_options(LLVM_CCACHE_BUILD=self.use_ccache and self.compiler_cache is None)
         # Lit multiprocessing seems broken with python 2.7 on FreeBSD (and python 3 seems faster at least for
         # libunwind/libcxx)
         self.add_cmake_options(PYTHON_EXECUTABLE=sys.executable)
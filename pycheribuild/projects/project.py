@@ -27,17 +27,19 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
+import concurrent.futures
 import copy
 import datetime
 import errno
+import hashlib
 import inspect
 import os
 import re
 import shlex
 import shutil
+import stat
 import subprocess
 import sys
-import threading
 import time
 import typing
 from collections import OrderedDict
@@ -45,14 +47,21 @@ from enum import Enum
 from pathlib import Path
 from typing import Callable, Tuple, Union
 
+from ..buildcache import BuildArtifactCache, InstallTreeSnapshot
+from ..buildlogs import BuildLogWriter, LOG_COMPRESSION_SUFFIXES, rotate_build_logs
+from ..buildtrace import get_build_trace
+from ..compilercache import CompilerCache
 from ..config.chericonfig import BuildType, CheriConfig
 from ..config.loader import (ComputedDefaultValue, ConfigLoaderBase, ConfigOptionBase, DefaultValueOnlyConfigOption)
 from ..config.target_info import (AutoVarInit, BasicCompilationTargets, CPUArchitecture, CrossCompileTarget, Linkage,
                                   TargetInfo)
 from ..filesystemutils import FileSystemUtils
+from ..gitmirror import update_git_mirror
+from ..jobserver import get_jobserver
+from ..ninjalog import NinjaBuildSummary, parse_ninja_log, update_ninja_build_history
 from ..processutils import (check_call_handle_noexec, commandline_to_str, CompilerInfo, get_compiler_info,
                             get_program_version, get_version_output, popen_handle_noexec, print_command, run_command,
-                            set_env)
+                            set_env, stream_process_output)
 from ..targets import MultiArchTarget, MultiArchTargetAlias, Target, target_manager
 from ..utils import (AnsiColour, cached_property, classproperty, coloured, fatal_error, include_local_file,
                      is_jenkins_build, OSInfo, replace_one, status_update, ThreadJoiner, warning_message)
@@ -731,24 +740,18 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
         if not self.query_yes_no(message, default_result=default_result, **kwargs):
             self.fatal(error_message)
 
+    def _show_stderr_line(self, line: bytes):
+        if self._last_stdout_line_can_be_overwritten:
+            sys.stdout.buffer.write(b"\n")
+            flush_stdio(sys.stdout)
+            self._last_stdout_line_can_be_overwritten = False
+        sys.stderr.buffer.write(line)
+        flush_stdio(sys.stderr)
+
     @staticmethod
-    def _handle_stderr(outfile, stream, file_lock, project: "Project"):
-        for errLine in stream:
-            with file_lock:
-                try:
-                    # noinspection PyProtectedMember
-                    if project._last_stdout_line_can_be_overwritten:
-                        sys.stdout.buffer.write(b"\n")
-                        flush_stdio(sys.stdout)
-                        project._last_stdout_line_can_be_overwritten = False
-                    sys.stderr.buffer.write(errLine)
-                    flush_stdio(sys.stderr)
-                    if project.config.write_logfile:
-                        outfile.write(errLine)
-                except ValueError:
-                    # Don't print a backtrace on ctrl+C (since that will exit the main thread and close the file)
-                    # ValueError: write to closed file
-                    continue
+    def _show_unfiltered_stdout(data: bytes):
+        sys.stdout.buffer.write(data)
+        flush_stdio(sys.stdout)
 
     def _line_not_important_stdout_filter(self, line: bytes):
         # by default we don't keep any line persistent, just have updating output
@@ -792,77 +795,76 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
         assert not logfile_name.startswith("/")
         if self.config.write_logfile:
             logfile_path = self.build_dir / (logfile_name + ".log")
-            print("Saving build log to", logfile_path)
+            print("Saving build log to", logfile_path.with_name(
+                logfile_path.name + LOG_COMPRESSION_SUFFIXES[self.config.log_compression]))
         else:
             logfile_path = Path(os.devnull)
         if self.config.pretend:
             return
         if self.config.verbose:
             stdout_filter = None
-
-        if self.config.write_logfile and logfile_path.is_file() and not append_to_logfile:
-            logfile_path.unlink()  # remove old logfile
+        with get_build_trace().span(logfile_name, "command", target=self.target, command=commandline_to_str(args)):
+            self.__run_with_logfile(args, logfile_path, stdout_filter=stdout_filter, cwd=cwd, new_env=new_env,
+                                    append_to_logfile=append_to_logfile)
+
+    def _trace_phase(self, phase: str):
+        """Records the duration of a build phase of this target in the --build-trace file and the final summary"""
+        return get_build_trace().span(phase, "phase", target=self.target)
+
+    def __run_with_logfile(self, args: "typing.Sequence[str]", logfile_path: Path, *, stdout_filter, cwd: Path,
+                           new_env: "typing.Optional[typing.Dict[str, str]]", append_to_logfile: bool):
+        if self.config.write_logfile and not append_to_logfile:
+            rotate_build_logs(logfile_path, self.config.keep_logs)  # remove or rename the old logfiles
         args = list(map(str, args))  # make sure all arguments are strings
+        # Make the jobserver file descriptors available to all make/ninja processes:
+        jobserver = get_jobserver()
+        pass_fds = jobserver.pass_fds if jobserver is not None else ()
 
         if not self.config.write_logfile:
             if stdout_filter is None:
                 # just run the process connected to the current stdout/stdin
-                check_call_handle_noexec(args, cwd=str(cwd), env=new_env)
+                check_call_handle_noexec(args, cwd=str(cwd), env=new_env, pass_fds=pass_fds)
             else:
-                make = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, env=new_env)
+                make = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, env=new_env,
+                                           pass_fds=pass_fds)
                 self.__run_process_with_filtered_output(make, None, stdout_filter, args)
             return
 
-        # open file in append mode
-        with logfile_path.open("ab") as logfile:
+        with BuildLogWriter(logfile_path, compression=self.config.log_compression,
+                            append=append_to_logfile) as logfile:
             # print the command and then the logfile
             if append_to_logfile:
                 logfile.write(b"\n\n")
             if cwd:
                 logfile.write(("cd " + shlex.quote(str(cwd)) + " && ").encode("utf-8"))
             logfile.write(self.commandline_to_str(args).encode("utf-8") + b"\n\n")
-            if self.config.quiet:
-                # a lot more efficient than filtering every line
-                check_call_handle_noexec(args, cwd=str(cwd), stdout=logfile, stderr=logfile, env=new_env)
-                return
-            make = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=new_env)
-            self.__run_process_with_filtered_output(make, logfile, stdout_filter, args)
+            make = popen_handle_noexec(args, cwd=str(cwd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=new_env,
+                                       pass_fds=pass_fds)
+            # In quiet mode the output is only written to the logfile
+            self.__run_process_with_filtered_output(make, logfile, stdout_filter, args, quiet=self.config.quiet)
 
     def __run_process_with_filtered_output(self, proc: subprocess.Popen, logfile: "typing.Optional[typing.IO]",
                                            stdout_filter: "typing.Callable[[bytes], None]",
-                                           args: "typing.List[str]"):
-        logfile_lock = threading.Lock()  # we need a mutex so the logfile line buffer doesn't get messed up
-        stderr_thread = None
-        if logfile:
-            # use a thread to print stderr output and write it to logfile (not using a thread would block)
-            stderr_thread = threading.Thread(target=self._handle_stderr,
-                                             args=(logfile, proc.stderr, logfile_lock, self))
-            stderr_thread.start()
-        for line in proc.stdout:
-            with logfile_lock:  # make sure we don't interleave stdout and stderr lines
-                if logfile:
-                    logfile.write(line)
-                if stdout_filter:
-                    stdout_filter(line)
-                else:
-                    sys.stdout.buffer.write(line)
-                    flush_stdio(sys.stdout)
+                                           args: "typing.List[str]", quiet=False):
+        # Filters that only ever show the most recent line (overwriting the previous one) don't need to see every
+        # line of output, so we only pass them the latest line every 100ms instead of once per line.
+        only_shows_latest_line = getattr(stdout_filter, "__func__", None) in (Project._stdout_filter,
+                                                                              Project._line_not_important_stdout_filter)
+        if quiet:
+            stdout_callback = stderr_callback = (lambda _: None)
+        else:
+            stdout_callback = stdout_filter or self._show_unfiltered_stdout
+            stderr_callback = self._show_stderr_line
+        try:
+            stream_process_output(proc.stdout, proc.stderr, logfile, stdout_callback=stdout_callback,
+                                  stderr_callback=stderr_callback, split_stdout_lines=stdout_filter is not None,
+                                  latest_stdout_line_only=only_shows_latest_line)
+        finally:
+            for stream in (proc.stdout, proc.stderr):
+                if stream is not None:
+                    stream.close()
         retcode = proc.wait()
-        if stderr_thread:
-            stderr_thread.join()
-        # Not sure if the remaining call is needed
-        remaining_err, remaining_out = proc.communicate()
-        if remaining_err:
-            print("Process had remaining stderr:", remaining_err)
-            sys.stderr.buffer.write(remaining_err)
-            if logfile:
-                logfile.write(remaining_out)
-        if remaining_out:
-            print("Process had remaining stdout:", remaining_out)
-            sys.stdout.buffer.write(remaining_out)
-            if logfile:
-                logfile.write(remaining_err)
-        if stdout_filter and self._last_stdout_line_can_be_overwritten:
+        if stdout_filter and not quiet and self._last_stdout_line_can_be_overwritten:
             # add the final new line after the filtering
             sys.stdout.buffer.write(b"\n")
         if retcode:
@@ -895,6 +897,50 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
             return False
         return True
 
+    def strip_elf_files_batched(self, files: "typing.Iterable[Path]") -> int:
+        """
+        Runs llvm-strip on all ELF files in files. Unlike calling maybe_strip_elf_file() for every file, this reads the
+        first bytes of each file only once and runs llvm-strip in parallel with many files per process.
+        :return: the number of bytes saved by stripping
+        """
+        def elf_file_size(file: Path) -> int:
+            # Returns -1 for anything that should not be stripped (symlinks, directories, non-ELF files, etc.)
+            try:
+                if not stat.S_ISREG(os.lstat(str(file)).st_mode):
+                    return -1
+                with file.open("rb") as f:
+                    if f.read(4) != b"\x7fELF":
+                        return -1
+                    return os.fstat(f.fileno()).st_size
+            except OSError as e:
+                self.warning("Failed to detect file type for", file, e)
+                return -1
+
+        files = list(files)
+        num_threads = max(1, self.config.make_jobs)
+        # Opening the files is dominated by syscalls that release the GIL, so use threads for this step too.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, num_threads)) as executor:
+            sizes = list(executor.map(elf_file_size, files))
+        candidates = OrderedDict((file, size) for file, size in zip(files, sizes)
+                                 if size >= 0 and self.should_strip_elf_file_for_tarball(file))
+        if not candidates:
+            return 0
+        # Use at least one batch per thread, but limit the command line length for huge directories.
+        batch_size = min(256, -(-len(candidates) // num_threads))
+        to_strip = list(candidates.keys())
+        batches = [to_strip[i:i + batch_size] for i in range(0, len(to_strip), batch_size)]
+        self.info("Stripping", len(to_strip), "ELF files using", min(num_threads, len(batches)), "parallel",
+                  self.target_info.strip_tool.name, "processes")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            for future in [executor.submit(run_command, [self.target_info.strip_tool] + batch,
+                                           print_verbose_only=True) for batch in batches]:
+                future.result()
+        if self.config.pretend:
+            return 0
+        saved = sum(size - os.stat(str(file)).st_size for file, size in candidates.items())
+        self.info("Stripping", len(to_strip), "ELF files saved", round(saved / 1024 / 1024, 1), "MiB")
+        return saved
+
     def _cleanup_old_files(self, current_path: Path, current_suffix: str, old_suffixes: typing.List[str]):
         """Remove old build directories/disk-images, etc. to avoid wasted disk space after renaming targets"""
         if not old_suffixes:
@@ -948,6 +994,13 @@ class SimpleProject(FileSystemUtils, metaclass=ProjectSubclassDefinitionHook):
                 self.dependency_error("Required C header", header, "is missing!", install_instructions=instructions)
         self._system_deps_checked = True
 
+    def get_repository_to_fetch(self) -> "typing.Optional[typing.Tuple[GitRepository, Path]]":
+        """
+        :return: the git repository and source directory that can be fetched concurrently with the other targets
+        before anything is built (or None if this project does not need to fetch anything)
+        """
+        return None
+
     def process(self):
         raise NotImplementedError()
 
@@ -1240,6 +1293,23 @@ class MakeOptions(object):
             return self.__can_pass_j_flag
         return self.kind != MakeCommandKind.CustomMakeTool
 
+    def jobserver_env(self, make_command: str) -> "typing.Optional[typing.Dict[str, str]]":
+        """
+        :return: the environment variables that should be used instead of a -j flag to make the command use the
+        global jobserver or None if there is no jobserver/it is not supported.
+        """
+        jobserver = get_jobserver()
+        if jobserver is None or not self.can_pass_jflag:
+            return None
+        if self.kind == MakeCommandKind.Ninja:
+            ninja_flags = jobserver.ninja_flags(make_command)
+            return None if ninja_flags is None else {"MAKEFLAGS": ninja_flags}
+        # bmake only supports its own (undocumented) -J R,W internal flag, so it is limited with a -j flag instead.
+        if self.kind == MakeCommandKind.GnuMake or (self.kind == MakeCommandKind.DefaultMake and
+                                                    not OSInfo.IS_FREEBSD):
+            return {"MAKEFLAGS": jobserver.gnu_make_flags(make_command)}
+        return None
+
 
 class SourceRepository(object):
     def ensure_cloned(self, current_project: "Project", *, src_dir: Path, base_project_source_dir: Path,
@@ -1348,7 +1418,14 @@ class GitRepository(SourceRepository):
                     default_result=True):
                 current_project.fatal("Sources for", str(base_project_source_dir), " missing!")
             clone_cmd = ["git", "clone"]
-            if current_project.config.shallow_clone and not current_project.needs_full_history:
+            mirror_dir = current_project.config.git_mirror_dir
+            if mirror_dir is not None:
+                # Use the local mirror for all objects that it contains (only fetch the remaining ones)
+                mirror = update_git_mirror(mirror_dir, self.url, config=current_project.config)
+                clone_cmd.extend(["--reference", mirror])
+                if current_project.config.git_mirror_dissociate:
+                    clone_cmd.append("--dissociate")
+            elif current_project.config.shallow_clone and not current_project.needs_full_history:
                 # Note: we pass --no-single-branch since otherwise git fetch will not work with branches and
                 # the solution of running  `git config remote.origin.fetch "+refs/heads/*:refs/remotes/origin/*"`
                 # is not very intuitive. This increases the amount of data fetched but increases usability
@@ -1441,6 +1518,28 @@ class GitRepository(SourceRepository):
             return base_project_source_dir
         return base_project_source_dir.with_name(target_override.directory_name)
 
+    # Source directories that have already been fetched by TargetManager.run() during this cheribuild invocation
+    fetched_source_dirs = set()  # type: typing.Set[Path]
+
+    def _fetch(self, current_project: "Project", *, src_dir: Path, **kwargs):
+        if current_project.config.git_mirror_dir is not None and not current_project.config.git_mirror_dissociate:
+            # The checkout uses the objects in the mirror, so updating the mirror first avoids fetching them again
+            update_git_mirror(current_project.config.git_mirror_dir, self.url, config=current_project.config)
+        # First fetch all the current upstream branch to see if we need to autostash/pull.
+        # Note: "git fetch" without other arguments will fetch from the currently configured upstream.
+        # If there is no upstream, it will just return immediately.
+        run_command(["git", "fetch"], cwd=src_dir, config=current_project.config, **kwargs)
+
+    def fetch_noninteractive(self, current_project: "Project", *, src_dir: Path):
+        """
+        Run git fetch without any user interaction (this is called concurrently for all repositories by
+        TargetManager.run()). The later call to update() then only needs to rebase the local checkout.
+        """
+        # Fail instead of asking for a username/password, update() will fetch again with the terminal available.
+        self._fetch(current_project, src_dir=src_dir, capture_output=True, capture_error=True, print_verbose_only=True,
+                    stdin=subprocess.DEVNULL, env=dict(GIT_TERMINAL_PROMPT="0"))
+        self.fetched_source_dirs.add(src_dir)
+
     def update(self, current_project: "Project", *, src_dir: Path, base_project_source_dir: Path = None, revision=None,
                skip_submodules=False):
         self.ensure_cloned(current_project, src_dir=src_dir, base_project_source_dir=base_project_source_dir,
@@ -1476,11 +1575,12 @@ class GitRepository(SourceRepository):
                     if current_project.query_yes_no("Update to correct URL?"):
                         run_command("git", "remote", "set-url", remote_name, self.url,
                                     run_in_pretend_mode=_PRETEND_RUN_GIT_COMMANDS, cwd=src_dir)
+                        self.fetched_source_dirs.discard(src_dir)  # fetch again from the new URL
 
-        # First fetch all the current upstream branch to see if we need to autostash/pull.
-        # Note: "git fetch" without other arguments will fetch from the currently configured upstream.
-        # If there is no upstream, it will just return immediately.
-        run_command(["git", "fetch"], cwd=src_dir)
+        if src_dir in self.fetched_source_dirs:
+            current_project.verbose_print("Not running git fetch in", src_dir, "since it has already been fetched")
+        else:
+            self._fetch(current_project, src_dir=src_dir)
 
         if revision is not None:
             # TODO: do some rev-parse stuff to check if we are on the right revision?
@@ -1653,6 +1753,7 @@ class Project(SimpleProject):
     compile_db_requires_bear = True
     do_not_add_to_targets = True
     set_pkg_config_path = True  # set the PKG_CONFIG_* environment variables when building
+    can_use_compiler_cache = True  # Set to False if the build system breaks when CC/CXX are prefixed with ccache
 
     build_dir_suffix = ""  # add a suffix to the build dir (e.g. for freebsd-with-bootstrap-clang)
     add_build_dir_suffix_for_native = False  # Whether to add -native to the native build dir
@@ -2046,6 +2147,10 @@ class Project(SimpleProject):
                 self.add_required_system_tool("bear", install_instructions="Run `cheribuild.py bear`")
                 self._compiledb_tool = "bear"
         self._force_clean = False
+        self.compiler_cache = CompilerCache.from_config(self.config) if self.can_use_compiler_cache else None
+        if self.compiler_cache is not None:
+            self.add_required_system_tool(self.compiler_cache.kind, homebrew=self.compiler_cache.kind,
+                                          apt=self.compiler_cache.kind, freebsd=self.compiler_cache.kind)
         self._prevent_assign = True
 
         # Setup destdir and installprefix:
@@ -2225,9 +2330,12 @@ class Project(SimpleProject):
         self.__dict__[name] = value
 
     def _get_make_commandline(self, make_target: "typing.Union[str, typing.List[str]]", make_command,
-                              options: MakeOptions, parallel: bool = True, compilation_db_name: str = None):
+                              options: MakeOptions, parallel: bool = True, compilation_db_name: str = None
+                              ) -> "typing.Tuple[typing.List[str], typing.Optional[typing.Dict[str, str]]]":
+        """:return: the command line and the jobserver environment variables (if the jobserver is used)"""
         assert options is not None
         assert make_command is not None
+        jobserver_env = options.jobserver_env(make_command) if parallel else None
         options = options.copy()
         if compilation_db_name is not None and self.config.create_compilation_db and self.compile_db_requires_bear:
             assert self._compiledb_tool is not None
@@ -2252,7 +2360,7 @@ class Project(SimpleProject):
                 all_args.extend(make_target)
         else:
             all_args = [make_command] + options.all_commandline_args
-        if parallel and options.can_pass_jflag:
+        if parallel and options.can_pass_jflag and jobserver_env is None:
             all_args.append(self.config.make_j_flag)
         if not self.config.make_without_nice:
             all_args = ["nice"] + all_args
@@ -2263,7 +2371,7 @@ class Project(SimpleProject):
             if options.kind == MakeCommandKind.Ninja:
                 # ninja needs the maximum number of failed jobs as an argument
                 all_args.append("50")
-        return all_args
+        return all_args, jobserver_env
 
     def get_make_commandline(self, make_target: "typing.Union[str, typing.List[str]]", make_command: str = None,
                              options: MakeOptions = None, parallel: bool = True,
@@ -2272,7 +2380,7 @@ class Project(SimpleProject):
             options = self.make_args
         if not make_command:
             make_command = self.make_args.command
-        return self._get_make_commandline(make_target, make_command, options, parallel, compilation_db_name)
+        return self._get_make_commandline(make_target, make_command, options, parallel, compilation_db_name)[0]
 
     def run_make(self, make_target: "typing.Union[str, typing.List[str]]" = "", *, make_command: str = None,
                  options: MakeOptions = None, logfile_name: str = None, cwd: Path = None, append_to_logfile=False,
@@ -2282,8 +2390,8 @@ class Project(SimpleProject):
             options = self.make_args
         if not make_command:
             make_command = self.make_args.command
-        all_args = self._get_make_commandline(make_target, make_command, options, parallel=parallel,
-                                              compilation_db_name=compilation_db_name)
+        all_args, jobserver_env = self._get_make_commandline(make_target, make_command, options, parallel=parallel,
+                                                             compilation_db_name=compilation_db_name)
         if not cwd:
             cwd = self.build_dir
         if not logfile_name:
@@ -2300,6 +2408,8 @@ class Project(SimpleProject):
         if stdout_filter is _default_stdout_filter:
             stdout_filter = self._stdout_filter
         env = options.env_vars
+        if jobserver_env is not None:
+            env = dict(env, **jobserver_env)
         self.run_with_logfile(all_args, logfile_name=logfile_name, stdout_filter=stdout_filter, cwd=cwd, env=env,
                               append_to_logfile=append_to_logfile)
         # if we create a compilation db, copy it to the source dir:
@@ -2308,6 +2418,13 @@ class Project(SimpleProject):
         # add a newline at the end in case it ended with a filtered line (no final newline)
         print("Running", make_command, make_target, "took", time.time() - starttime, "seconds")
 
+    def get_repository_to_fetch(self) -> "typing.Optional[typing.Tuple[GitRepository, Path]]":
+        if self.skip_update or not isinstance(self.repository, GitRepository):
+            return None
+        if not (self.source_dir / ".git").exists():
+            return None  # cloning may need to ask questions, so it happens in update()
+        return self.repository, self.source_dir
+
     def update(self):
         if not self.repository and not self.skip_update:
             self.fatal("Cannot update", self.project_name, "as it is missing a repository source",
@@ -2370,11 +2487,18 @@ class Project(SimpleProject):
         assert not isinstance(value, tuple), ("Wrong type:", type(value))
         self.configure_environment[arg] = str(value)
 
+    def _with_compiler_launcher(self, var: str, command: str) -> str:
+        # Only wrap the compilers and not CPP/CCLD since preprocessing and linking can't be cached. Any target flags
+        # (e.g. -target/-mabi=purecap) remain arguments of the compiler so they are part of the cache key.
+        if var in ("CC", "CXX") and self.compiler_cache is not None:
+            return self.commandline_to_str([self.compiler_cache.executable]) + " " + command
+        return command
+
     def set_configure_prog_with_args(self, prog: str, path: Path, args: list):
         fullpath = str(path)
         if args:
             fullpath += " " + self.commandline_to_str(args)
-        self.configure_environment[prog] = fullpath
+        self.configure_environment[prog] = self._with_compiler_launcher(prog, fullpath)
 
     def configure(self, cwd: Path = None, configure_path: Path = None):
         if cwd is None:
@@ -2396,6 +2520,54 @@ class Project(SimpleProject):
             cwd = self.build_dir
         self.run_make("all", cwd=cwd, parallel=parallel)
 
+    @property
+    def _ninja_log_path(self) -> "typing.Optional[Path]":
+        if self.make_args.kind != MakeCommandKind.Ninja or self.config.pretend or self.config.ninja_log_top_edges <= 0:
+            return None
+        return self.build_dir / ".ninja_log"
+
+    def _ninja_log_size(self) -> int:
+        path = self._ninja_log_path
+        try:
+            return path.stat().st_size if path is not None else 0
+        except OSError:
+            return 0
+
+    def _report_ninja_build_statistics(self, ninja_log_offset: int):
+        path = self._ninja_log_path
+        if path is None or not path.is_file():
+            return
+        try:
+            edges = parse_ninja_log(path, ninja_log_offset)
+        except (OSError, ValueError) as e:
+            self.warning("Could not parse", path, e)
+            return
+        if not edges:
+            return  # nothing was rebuilt
+        summary = NinjaBuildSummary(edges)
+        top_edges = self.config.ninja_log_top_edges
+        self.info("Ninja ran {} build steps in {:.1f}s: {:.1f}s serial time ({:.1f}x parallelism), {:.1f}s of which "
+                  "were not compile steps (linking, etc.)".format(summary.num_edges, summary.wall_seconds,
+                                                                  summary.serial_seconds, summary.parallelism,
+                                                                  summary.link_seconds))
+        self.info("Slowest build steps:")
+        for output, seconds in summary.slowest_edges(top_edges):
+            self.info("  {:>8.1f}s  {}".format(seconds, output))
+        self.info("Slowest targets/directories:")
+        for name, seconds, num_edges in summary.slowest_groups(top_edges):
+            self.info("  {:>8.1f}s  {} ({} build steps)".format(seconds, name, num_edges))
+        history_file = self.config.build_root / "cheribuild-logs" / (self.target + ".ninja-history.jsonl")
+        previous = update_ninja_build_history(history_file, summary.to_json(top_edges, jobs=self.config.make_jobs,
+                                                                            lto=bool(self.use_lto)))
+        if previous is not None and previous.get("serial_seconds"):
+            change = summary.serial_seconds / previous["serial_seconds"] - 1
+            message = "Serial build time changed by {:+.1f}% compared to the previous build of similar size " \
+                      "({})".format(change * 100, previous["time"])
+            if change > 0.1:
+                self.warning(message)
+            else:
+                self.info(message)
+
     @property
     def make_install_env(self):
         if self.destdir:
@@ -2490,14 +2662,16 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
         """
         self.info("Stripping all ELF files in", benchmark_dir)
         self.run_cmd("du", "-sh", benchmark_dir)
+        files = []
         for root, dirnames, filenames in os.walk(str(benchmark_dir)):
             for filename in filenames:
                 file = Path(root, filename)
                 if file.suffix == ".dump":
                     # TODO: make this an error since we should have deleted them
                     self.warning("Will copy a .dump file to the FPGA:", file)
-                # Try to reduce the amount of copied data
-                self.maybe_strip_elf_file(file)
+                files.append(file)
+        # Try to reduce the amount of copied data
+        self.strip_elf_files_batched(files)
         self.run_cmd("du", "-sh", benchmark_dir)
 
     # @cached_property is important to only compute it once since we encode seconds in the file name:
@@ -2538,6 +2712,136 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
     def _last_clean_counter_path(self):
         return Path(self.build_dir, ".cheribuild_last_clean_counter")
 
+    def _artifact_cache_stamp_path(self):
+        # Contains the artifact cache key of the last install (used to compute the keys of dependent projects)
+        return Path(self.build_dir, ".cheribuild_artifact_cache_key")
+
+    def _artifact_cache_install_roots(self) -> "typing.List[Path]":
+        roots = [self.destdir if self.destdir is not None else self.install_dir]
+        rootfs_path = getattr(self, "rootfs_path", None)
+        if rootfs_path is not None and rootfs_path not in roots:
+            roots.append(rootfs_path)
+        return roots
+
+    def _artifact_cache_installed_files(self) -> "typing.Optional[typing.List[Path]]":
+        """
+        :return: All files installed by this project (including the ones that the install step did not modify because
+        an up-to-date copy already existed in the install directory) or None if there is no install manifest.
+        """
+        return None
+
+    def _get_artifact_cache(self) -> "typing.Optional[BuildArtifactCache]":
+        if self.config.build_cache_dir is None or self.config.pretend:
+            return None
+        if self.config.skip_configure or self.config.configure_only or self.config.skip_build or \
+                self.config.skip_install:
+            return None
+        if self.get_default_install_dir_kind() == DefaultInstallDir.DO_NOT_INSTALL:
+            return None
+        if not isinstance(self.repository, GitRepository):
+            return None
+        return BuildArtifactCache(self.config.build_cache_dir, self.config.build_cache_max_size * 1024 * 1024 * 1024)
+
+    def _clean_git_revision(self, source_dir: Path) -> "typing.Optional[str]":
+        """:return: the HEAD revision (and submodule revisions) of source_dir or None if it has local changes"""
+        if source_dir is None or not (source_dir / ".git").exists():
+            return None
+        status = run_command("git", "status", "--porcelain", "--untracked-files=no", cwd=source_dir,
+                             capture_output=True, print_verbose_only=True).stdout
+        if status.strip():
+            return None
+        rev_parse = run_command("git", "rev-parse", "--verify", "--quiet", "HEAD", cwd=source_dir, capture_output=True,
+                                print_verbose_only=True, allow_unexpected_returncode=True)
+        if rev_parse.returncode != 0:
+            return None  # no commits yet
+        revision = rev_parse.stdout.strip()
+        if (source_dir / ".gitmodules").exists():
+            submodules = run_command("git", "submodule", "status", "--recursive", cwd=source_dir, capture_output=True,
+                                     print_verbose_only=True).stdout
+            revision += b"\n" + submodules.strip()
+        return revision.decode("utf-8")
+
+    def artifact_cache_key(self) -> "typing.Optional[str]":
+        """
+        :return: a hash of all inputs that affect the files installed by this project or None if the build can't be
+        cached (e.g. because the source directory has uncommitted changes).
+        Note: this must be called after configure() since that adds most of the configure/CMake arguments.
+        """
+        revision = self._clean_git_revision(self.source_dir)
+        if revision is None:
+            self.info("Not using the artifact cache for", self.target, "since", self.source_dir,
+                      "is not a clean git checkout.")
+            return None
+        key = hashlib.sha256()
+
+        def add(*values):
+            for v in values:
+                key.update(str(v).encode("utf-8"))
+                key.update(b"\0")
+
+        add("target", self.target, self.build_configuration_suffix(), revision)
+        add("cflags", *self.default_compiler_flags)
+        add("ldflags", *self.default_ldflags)
+        add("configure", *self.configure_args)
+        add("configure-env", *sorted(self.configure_environment.items()))
+        add("cmake-options", *getattr(self, "cmake_options", []))
+        add("make", *self.make_args.all_commandline_args)
+        add("make-env", *sorted(self.make_args.env_vars.items()))
+        add("install", self.install_prefix, self.destdir)
+        if self.CC.exists():
+            cc_stat = self.CC.stat()
+            add("cc", self.CC, cc_stat.st_size, cc_stat.st_mtime_ns)
+        # The build logic for this project is part of the inputs:
+        project_module_file = sys.modules[type(self).__module__].__file__
+        add("cheribuild", hashlib.sha256(Path(project_module_file).read_bytes()).hexdigest())
+        # Dependencies record the key of their last install in the build directory. For dependencies that were not
+        # built with the artifact cache enabled we fall back to the revision of their source directory.
+        for dep in self.cached_full_dependencies():
+            dep_project = dep.get_or_create_project(None, self.config)
+            if not isinstance(dep_project, Project):
+                continue
+            stamp = dep_project._artifact_cache_stamp_path()
+            if stamp.is_file():
+                add("dep", dep.name, stamp.read_text().strip())
+            elif dep_project.source_dir is not None and (dep_project.source_dir / ".git").exists():
+                dep_revision = self._clean_git_revision(dep_project.source_dir)
+                if dep_revision is None:
+                    self.info("Not using the artifact cache for", self.target, "since dependency", dep.name,
+                              "has uncommitted changes.")
+                    return None
+                add("dep", dep.name, dep_revision)
+            else:
+                add("dep", dep.name, "external")
+        return key.hexdigest()
+
+    def _update_artifact_cache(self, cache: "typing.Optional[BuildArtifactCache]", key: "typing.Optional[str]",
+                               snapshot: "typing.Optional[InstallTreeSnapshot]", clean_build: bool):
+        stamp = self._artifact_cache_stamp_path()
+        if cache is None or key is None:
+            # The install directory no longer matches any cache key -> ensure dependent projects don't get cache hits
+            if stamp.exists() and not self.config.pretend:
+                stamp.unlink()
+            return
+        assert snapshot is not None
+        installed_files = self._artifact_cache_installed_files()
+        if installed_files is None and not clean_build:
+            # Without an install manifest we only know the files that were added/modified by the install step. After
+            # an incremental build that could be a subset of the installed files, so only store clean builds.
+            self.info("Not adding", self.target, "to the artifact cache since this was an incremental build.")
+            self.write_file(stamp, key, overwrite=True, never_print_cmd=True)
+            return
+        roots = snapshot.roots
+        files_per_root = snapshot.changed_files()
+        for f in installed_files or []:
+            for root, files in zip(roots, files_per_root):
+                relpath = os.path.relpath(str(f), str(root))
+                if not relpath.startswith(os.path.pardir) and relpath not in files and os.path.lexists(str(f)):
+                    files.append(relpath)
+                    break
+        cache.store(key, roots, files_per_root, {"target": self.target, "revision": self._clean_git_revision(
+            self.source_dir) or "unknown"})
+        self.write_file(stamp, key, overwrite=True, never_print_cmd=True)
+
     def _parse_require_clean_build_counter(self) -> typing.Optional[int]:
         require_clean_path = Path(self.source_dir, ".require_clean_build")
         if not require_clean_path.exists():
@@ -2629,11 +2933,15 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
                                               base_project_source_dir=self._initial_source_dir,
                                               skip_submodules=self.skip_git_submodules)
         else:
-            self.update()
+            with self._trace_phase("update"):
+                self.update()
         if not self._system_deps_checked:
             self.check_system_dependencies()
         assert self._system_deps_checked, "self._system_deps_checked must be set by now!"
 
+        artifact_cache = self._get_artifact_cache()
+        artifact_cache_key = None  # type: typing.Optional[str]
+
         last_build_file = self._last_build_kind_path()
         if self.build_in_source_dir and not self.config.clean:
             if not last_build_file.exists():
@@ -2674,7 +2982,12 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
                     self._force_clean = True
 
         # run the rm -rf <build dir> in the background
-        cleaning_task = self.clean() if (self._force_clean or self.config.clean) else ThreadJoiner(None)
+        clean_build = self._force_clean or self.config.clean or not self.build_dir.is_dir()
+        cleaning_task = ThreadJoiner(None)
+        if self._force_clean or self.config.clean:
+            # Note: this only includes the time until the (asynchronous) clean has been started
+            with self._trace_phase("clean"):
+                cleaning_task = self.clean()
         if cleaning_task is None:
             cleaning_task = ThreadJoiner(None)
         assert isinstance(cleaning_task, ThreadJoiner), ""
@@ -2706,13 +3019,35 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
             # Clean completed
 
             # Configure step
+            configured = False
             if not self.config.skip_configure or self.config.configure_only:
                 if self.should_run_configure():
                     status_update("Configuring", self.display_name, "... ")
-                    self.configure()
+                    with self._trace_phase("configure"):
+                        self.configure()
+                    configured = True
             if self.config.configure_only:
                 return
 
+            # Many projects only add their configure/CMake arguments in configure(), so the artifact cache key can
+            # only be computed once configure() has run.
+            install_snapshot = None
+            if artifact_cache is not None:
+                if configured:
+                    artifact_cache_key = self.artifact_cache_key()
+                else:
+                    self.verbose_print("Not using the artifact cache for", self.target, "since configure was skipped")
+                if artifact_cache_key is not None and not self.config.clean:
+                    if artifact_cache.restore(artifact_cache_key, self._artifact_cache_install_roots()):
+                        self.write_file(self._artifact_cache_stamp_path(), artifact_cache_key, overwrite=True,
+                                        never_print_cmd=True)
+                        status_update("Restored", self.display_name, "from artifact cache, skipping build/install")
+                        if is_jenkins_build():
+                            self.prepare_install_dir_for_archiving()
+                        return
+                if artifact_cache_key is not None:
+                    install_snapshot = InstallTreeSnapshot(self._artifact_cache_install_roots())
+
             # Build step
             if not self.config.skip_build:
                 if self.config.csetbounds_stats and (self.csetbounds_stats_file.exists() or self.config.pretend):
@@ -2721,7 +3056,10 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
                                    force=True)
                     # move any csetbounds stats from configuration (since they are not useful)
                 status_update("Building", self.display_name, "... ")
-                self.compile()
+                ninja_log_size = self._ninja_log_size()
+                with self._trace_phase("compile"):
+                    self.compile()
+                self._report_ninja_build_statistics(ninja_log_size)
 
             # Install step
             if not self.config.skip_install:
@@ -2729,7 +3067,9 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
                 if install_dir_kind == DefaultInstallDir.DO_NOT_INSTALL:
                     self.info("Not installing", self.target, "since install dir is set to DO_NOT_INSTALL")
                 else:
-                    self.install()
+                    with self._trace_phase("install"):
+                        self.install()
+                    self._update_artifact_cache(artifact_cache, artifact_cache_key, install_snapshot, clean_build)
                 if is_jenkins_build():
                     self.prepare_install_dir_for_archiving()
 
@@ -2827,6 +3167,17 @@ class CMakeProject(Project):
         assert "@" not in configured_jenkins_workaround, configured_jenkins_workaround
         self.write_file(contents=configured_template, file=file, overwrite=True)
 
+    def _artifact_cache_installed_files(self) -> "typing.Optional[typing.List[Path]]":
+        # CMake lists all installed files (including the "Up-to-date" ones) in install_manifest.txt
+        manifest = self.build_dir / "install_manifest.txt"
+        if not manifest.is_file():
+            return None
+        result = []
+        for line in manifest.read_text(encoding="utf-8").splitlines():
+            if line:
+                result.append(Path(self.destdir, line.lstrip("/")) if self.destdir is not None else Path(line))
+        return result
+
     def add_cmake_options(self, *, _include_empty_vars=False, _replace=True, **kwargs):
         for option, value in kwargs.items():
             if not _replace and any(x.startswith("-D" + option + "=") for x in self.configure_args):
@@ -2908,6 +3259,9 @@ set(CMAKE_FIND_LIBRARY_CUSTOM_LIB_SUFFIX "cheri")
         else:
             self.add_cmake_options(CMAKE_INSTALL_PREFIX=self.install_dir)
         custom_ldflags = self.default_ldflags + self.LDFLAGS
+        if self.compiler_cache is not None:
+            self.add_cmake_options(CMAKE_C_COMPILER_LAUNCHER=self.compiler_cache.executable,
+                                   CMAKE_CXX_COMPILER_LAUNCHER=self.compiler_cache.executable)
         self.add_cmake_options(
             CMAKE_C_COMPILER=self.CC,
             CMAKE_CXX_COMPILER=self.CXX,
@@ -3083,6 +3437,7 @@ class MakefileProject(Project):
         value = str(cmd)
         if args:
             value += " " + self.commandline_to_str(args)
+        value = self._with_compiler_launcher(var, value)
         if self.set_commands_on_cmdline:
             self.make_args.set(**{var: value})
         else:
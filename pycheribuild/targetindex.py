@@ -0,0 +1,51 @@
+# -
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import typing
+
+from .indexcache import SourceIndexCache
+from .utils import warning_message
+
+__all__ = ["TargetIndex"]  # no-combine
+
+
+class TargetIndex(SourceIndexCache):
+    """
+    Caches the list of targets (see TargetManager.load_all_targets()) so that cheribuild only needs to import the
+    project modules for the targets that are actually used. The index is stored per cheribuild checkout and is
+    regenerated whenever any of the pycheribuild source files change.
+    """
+    FORMAT_VERSION = 2
+    NAME = "target-index"
+
+    def load(self) -> "typing.Optional[typing.List[typing.List[str]]]":
+        """:return: the saved index or None if it does not exist or is out of date"""
+        data = self._read()
+        return data.get("targets") if data else None
+
+    def save(self, targets: "typing.List[typing.List[str]]") -> None:
+        try:
+            self._write({"targets": targets})
+        except OSError as e:
+            warning_message("Could not update", self.path, "-", e)
@@ -27,15 +27,24 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
+import concurrent.futures
+import itertools
 import os
+import subprocess
 import sys
 import time
+import traceback
 import typing
 from collections import OrderedDict
+from pathlib import Path
 
+from .buildtrace import get_build_trace
+from .compilercache import CompilerCache
 from .config.chericonfig import CheriConfig
 from .config.target_info import CrossCompileTarget
-from .utils import AnsiColour, coloured, fatal_error, status_update, warning_message
+from .jobserver import init_jobserver
+from .processutils import commandline_to_str
+from .utils import AnsiColour, coloured, error_message, fatal_error, status_update, warning_message
 
 if typing.TYPE_CHECKING:  # no-combine
     from .projects.project import SimpleProject  # no-combine
@@ -96,7 +105,7 @@ class Target(object):
     def _create_project(self, config: CheriConfig) -> "SimpleProject":
         return self.project_class(config)
 
-    def _do_run(self, config, msg: str, func: "typing.Callable[[SimpleProject], typing.Any]"):
+    def _do_run(self, config, msg: str, func: "typing.Callable[[SimpleProject], typing.Any]", extra_env=None):
         # instantiate the project and run it
         starttime = time.time()
         project = self.get_or_create_project(self.project_class.get_crosscompile_target(config), config)
@@ -108,6 +117,8 @@ class Target(object):
         new_env = {"PATH": project.config.dollar_path_with_other_tools}
         if project.config.clang_colour_diags:
             new_env["CLANG_FORCE_COLOR_DIAGNOSTICS"] = "always"
+        if extra_env:
+            new_env.update(extra_env)
         with project.set_env(**new_env):
             func(project)
         status_update(msg, "for target '" + self.name + "' in", time.time() - starttime, "seconds")
@@ -120,7 +131,15 @@ class Target(object):
         assert self.__project is not None, "Should have been initialized in check_system_deps()"
         # noinspection PyProtectedMember
         assert not self.__project._setup_called, str(self._project_class) + ".setup() should not have been called yet."
-        self._do_run(config, msg="Built", func=lambda project: project.process())
+        compiler_cache = CompilerCache.from_config(config)
+        with get_build_trace().span(self.name, "target"):
+            if compiler_cache is None:
+                self._do_run(config, msg="Built", func=lambda project: project.process())
+            else:
+                baseline = compiler_cache.begin_target(self.name)
+                self._do_run(config, msg="Built", func=lambda project: project.process(),
+                             extra_env=compiler_cache.env_vars(self.name))
+                compiler_cache.end_target(self.name, baseline)
         self._completed = True
 
     def run_tests(self, config: "CheriConfig"):
@@ -139,6 +158,57 @@ class Target(object):
         self._do_run(config, msg="Ran benchmarks", func=lambda project: project.run_benchmarks())
         self._benchmarks_have_run = True
 
+    @property
+    def is_scheduling_barrier(self) -> bool:
+        # run-* targets need the terminal and disk-image-* targets are only ordered after the other targets by the
+        # heuristics in __lt__ (they don't declare dependencies on everything they include) -> never run them in
+        # parallel with any other target.
+        return self.name.startswith("run") or self.name.startswith("disk-image")
+
+    def execute_in_child_process(self, config: CheriConfig, logfile: Path, make_jobs: int) -> int:
+        """Fork a child process that executes this target with all output redirected to logfile."""
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid != 0:
+            return pid
+        exit_code = 1
+        try:
+            log_fd = os.open(str(logfile), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.dup2(log_fd, sys.stdout.fileno())
+            os.dup2(log_fd, sys.stderr.fileno())
+            os.close(log_fd)
+            # There is no way to answer prompts from a background process -> always use the default answer
+            null_fd = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(null_fd, sys.stdin.fileno())
+            os.close(null_fd)
+            config.make_jobs = make_jobs
+            get_build_trace().clear()  # only report the events of this target to the parent process
+            self.execute(config)
+            exit_code = 0
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                exit_code = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+        except subprocess.CalledProcessError as e:
+            error_message("Command `" + commandline_to_str(e.cmd) + "` failed with non-zero exit code", e.returncode)
+            exit_code = e.returncode if e.returncode > 0 else 1
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                get_build_trace().write(self.build_trace_path(logfile), process_name=self.name)
+            except OSError as e:
+                print("Could not write build trace:", e, file=sys.stderr)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+    @staticmethod
+    def build_trace_path(logfile: Path) -> Path:
+        return logfile.with_name(logfile.stem + ".trace.json")
+
     def reset(self):
         # For unit tests to get a fresh instance
         self._completed = False
@@ -306,9 +376,21 @@ class DeprecatedTargetAlias(SimpleTargetAlias):
 
 
 class TargetManager(object):
+    # Kinds of entries in the target index returned by load_all_targets()
+    INDEX_TARGET = "target"
+    INDEX_ALIAS = "alias"
+    INDEX_DEPRECATED_ALIAS = "deprecated"
+    INDEX_OPTIONS_ONLY = "options-only"
+
     def __init__(self):
         self._all_targets = {}  # type: typing.Dict[str, Target]
         self._targets_for_command_line_options_only = {}  # type: typing.Dict[str, MultiArchTargetAlias]
+        self._options_registered = set()  # type: typing.Set[Target]
+        # Set by enable_lazy_loading(): maps each target name to its kind and the module that has to be imported to
+        # define it. Modules are only imported (and their command line options registered) once a target is used.
+        self._lazy_index = None  # type: typing.Optional[typing.Dict[str, typing.Tuple[str, str]]]
+        self._modules_with_options = set()  # type: typing.Set[str]
+        self._importing_modules = False
 
     def add_target_for_config_options_only(self, target: MultiArchTargetAlias):
         # TODO remove this ugly hack
@@ -326,33 +408,145 @@ class TargetManager(object):
         else:
             self._all_targets[name] = SimpleTargetAlias(name, real_target, self)
 
+    def _setup_config_options(self, tgt: Target) -> None:
+        if tgt not in self._options_registered:
+            self._options_registered.add(tgt)
+            tgt.project_class.setup_config_options()
+
     def register_command_line_options(self):
         # this cannot be done in the Project metaclass as otherwise we get
         # RuntimeError: super(): empty __class__ cell
         # https://stackoverflow.com/questions/13126727/how-is-super-in-python-3-implemented/28605694#28605694
         for tgt in self._all_targets.values():
             if not isinstance(tgt, SimpleTargetAlias):
-                tgt.project_class.setup_config_options()
+                self._setup_config_options(tgt)
         # Ugly hack to keep registering the command line arguments for the fallback option name: for example,
         # cherisd-mips64-hybrid/foo loads the value from cheribsd/foo if it's not found.
         for tgt in self._targets_for_command_line_options_only.values():
-            tgt.project_class.setup_config_options()
+            self._setup_config_options(tgt)
+
+    def _index_entry_kind(self, name: str) -> str:
+        tgt = self._all_targets.get(name)
+        if tgt is None:
+            return self.INDEX_OPTIONS_ONLY
+        elif isinstance(tgt, DeprecatedTargetAlias):
+            return self.INDEX_DEPRECATED_ALIAS
+        elif isinstance(tgt, _TargetAliasBase):
+            return self.INDEX_ALIAS
+        return self.INDEX_TARGET
+
+    def load_all_targets(self) -> "typing.List[typing.List[str]]":
+        """
+        Import all project modules and return the target index: a [name, kind, module] entry for every target, where
+        module is the module that has to be imported to define that target.
+        """
+        import importlib
+        from . import projects
+        from .projects import cross
+        modules = [projects.__name__ + "." + m for m in projects.__all__]
+        modules += [cross.__name__ + "." + m for m in cross.__all__]
+        # Aliases are added by the module that calls add_target_alias(), which may not be the one that defines the
+        # real target, so remember which import added them.
+        alias_modules = dict()  # type: typing.Dict[str, str]
+        self._importing_modules = True
+        try:
+            for module in modules:
+                importlib.import_module(module)
+                for name, tgt in self._all_targets.items():
+                    if isinstance(tgt, SimpleTargetAlias):
+                        alias_modules.setdefault(name, module)
+        finally:
+            self._importing_modules = False
+        result = []
+        all_targets = itertools.chain(self._all_targets.items(), self._targets_for_command_line_options_only.items())
+        for name, tgt in all_targets:
+            # noinspection PyProtectedMember
+            module = alias_modules[name] if isinstance(tgt, SimpleTargetAlias) else tgt._project_class.__module__
+            result.append([name, self._index_entry_kind(name), module])
+        return result
+
+    def enable_lazy_loading(self, index: "typing.List[typing.List[str]]") -> None:
+        """
+        Use a target index created by load_all_targets() to import project modules and register their command line
+        options on demand instead of requiring all of them to be loaded up front.
+        """
+        self._lazy_index = OrderedDict((name, (kind, module)) for name, kind, module in index)
+
+    def _load_lazy_target(self, name: str) -> bool:
+        # Nested lookups while importing a module come from add_target_alias() and must not trigger any loading
+        if self._lazy_index is None or self._importing_modules or name not in self._lazy_index:
+            return False
+        module = self._lazy_index[name][1]
+        if module in self._modules_with_options:
+            return False
+        self._modules_with_options.add(module)
+        import importlib
+        self._importing_modules = True
+        try:
+            importlib.import_module(module)
+        finally:
+            self._importing_modules = False
+        # Register the options for all targets defined by that module: this also covers the fallback options of
+        # MultiArchTargets (e.g. cheribsd-riscv64/foo falls back to cheribsd/foo) as well as the derived targets that
+        # a MultiArchTargetAlias can resolve to.
+        for tgt_name, (kind, tgt_module) in self._lazy_index.items():
+            if tgt_module != module:
+                continue
+            tgt = self._all_targets.get(tgt_name, self._targets_for_command_line_options_only.get(tgt_name))
+            if tgt is None:
+                continue  # the module was already being imported and has not defined this target yet
+            if isinstance(tgt, SimpleTargetAlias):
+                self._load_lazy_target(tgt.real_target_name)
+            else:
+                self._setup_config_options(tgt)
+        return True
+
+    def load_targets_for_options(self, option_names: "typing.Optional[typing.List[str]]") -> bool:
+        """
+        Load the targets that own the given command line/config file option names (e.g. "llvm/build-type"). Names
+        without a slash are treated as a prefix of the target names (used for partial options when tab-completing)
+        and None loads all targets. Returns True if this registered any new options.
+        """
+        if self._lazy_index is None:
+            return False
+        if option_names is None or "" in option_names:
+            num_registered = len(self._options_registered)
+            self.load_all_targets()
+            self._modules_with_options.update(module for _, module in self._lazy_index.values())
+            self.register_command_line_options()
+            return len(self._options_registered) != num_registered
+        targets = []
+        for option in option_names:
+            if "/" in option:
+                targets.append(option.split("/", 1)[0])
+            else:
+                targets.extend(name for name in self._lazy_index if name.startswith(option))
+        result = False
+        for name in targets:
+            if self._load_lazy_target(name):
+                result = True
+        return result
+
+    def _index_names(self, *kinds: str) -> "typing.Iterable[str]":
+        return (name for name, (kind, _) in self._lazy_index.items() if kind in kinds)
 
     @property
-    def target_names(self):
+    def target_names(self) -> "typing.Iterable[str]":
+        if self._lazy_index is not None:
+            return list(self._index_names(self.INDEX_TARGET, self.INDEX_ALIAS, self.INDEX_DEPRECATED_ALIAS))
         return self._all_targets.keys()
 
     @property
-    def non_alias_target_names(self) -> "typing.Generator[str]":
-        for name, value in self._all_targets.items():
-            if not isinstance(value, _TargetAliasBase):
-                yield name
+    def non_alias_target_names(self) -> "typing.Iterable[str]":
+        if self._lazy_index is not None:
+            return self._index_names(self.INDEX_TARGET)
+        return (name for name, value in self._all_targets.items() if not isinstance(value, _TargetAliasBase))
 
     @property
-    def non_deprecated_target_names(self) -> "typing.Generator[str]":
-        for name, value in self._all_targets.items():
-            if not isinstance(value, DeprecatedTargetAlias):
-                yield name
+    def non_deprecated_target_names(self) -> "typing.Iterable[str]":
+        if self._lazy_index is not None:
+            return self._index_names(self.INDEX_TARGET, self.INDEX_ALIAS)
+        return (name for name, value in self._all_targets.items() if not isinstance(value, DeprecatedTargetAlias))
 
     @property
     def targets(self) -> "typing.Iterable[Target]":
@@ -360,6 +554,7 @@ class TargetManager(object):
 
     def get_target_raw(self, name: str) -> Target:
         # return the actual target without resolving MultiArchTargetAlias
+        self._load_lazy_target(name)
         try:
             return self._all_targets[name]
         except KeyError:
@@ -400,22 +595,193 @@ class TargetManager(object):
         sort = self.sort_in_dependency_order(chosen_targets)
         return sort
 
+    @staticmethod
+    def get_scheduling_dependencies(
+            chosen_targets: "typing.List[Target]") -> "typing.Dict[Target, typing.List[Target]]":
+        """
+        Returns a mapping from each of the (already sorted) chosen targets to the chosen targets that must have
+        completed before it can be started. Scheduling barriers (see Target.is_scheduling_barrier) depend on all
+        previous targets and all targets after a barrier depend on that barrier.
+        """
+        result = OrderedDict()  # type: typing.Dict[Target, typing.List[Target]]
+        last_barrier = None  # type: typing.Optional[Target]
+        for i, target in enumerate(chosen_targets):
+            if target.is_scheduling_barrier:
+                deps = chosen_targets[:i]
+                last_barrier = target
+            else:
+                full_deps = target.project_class.cached_full_dependencies()
+                deps = [t for t in chosen_targets[:i] if t in full_deps]
+                if last_barrier is not None and last_barrier not in deps:
+                    deps.append(last_barrier)
+            result[target] = deps
+        return result
+
     def run(self, config: CheriConfig):
         chosen_targets = self.get_all_chosen_targets(config)
 
         for target in chosen_targets:
             target.check_system_deps(config)
+        if config.use_make_jobserver and not config.pretend:
+            # Must be created before any targets are forked so that all processes share the same job slots. Every
+            # concurrently running target uses one implicit job slot that is not part of the jobserver tokens.
+            num_concurrent_targets = max(1, min(config.parallel_targets, len(chosen_targets)))
+            init_jobserver(config.make_jobs, num_concurrent_targets)
+        if config.fetch_jobs > 1 and not config.pretend and not config.print_targets_only:
+            self._fetch_sources(config, chosen_targets)
+        compiler_cache = CompilerCache.from_config(config)
+        if compiler_cache is not None and not config.print_targets_only:
+            compiler_cache.start_server()
         # all dependencies exist -> run the targets
+        try:
+            if config.parallel_targets > 1 and len(chosen_targets) > 1 and not config.pretend:
+                self._run_in_parallel(config, chosen_targets)
+            else:
+                for target in chosen_targets:
+                    if config.print_targets_only:
+                        status_update("Will build target", coloured(AnsiColour.yellow, target.name))
+                        print("    Dependencies for", target.name, "are",
+                              target.project_class.all_dependency_names(config))
+                    else:
+                        target.execute(config)
+        finally:
+            # Also write the trace for failed builds since that is useful to find out where the time went
+            if config.build_trace is not None and not config.pretend:
+                get_build_trace().write(config.build_trace)
+                status_update("Wrote build trace to", config.build_trace)
+        if config.pretend:
+            return
+        scheduling_deps = self.get_scheduling_dependencies(chosen_targets)
+        get_build_trace().print_summary(OrderedDict((t.name, [d.name for d in deps])
+                                                    for t, deps in scheduling_deps.items()))
+        if compiler_cache is not None:
+            compiler_cache.print_statistics(t.name for t in chosen_targets)
+
+    @staticmethod
+    def _fetch_sources(config: CheriConfig, chosen_targets: "typing.List[Target]"):
+        # Run the (slow) git fetch step for all repositories at the same time instead of one after another when
+        # each target is updated. Anything that may need user input (cloning, stashing local changes, rebasing)
+        # still happens later in Project.update() and repositories that could not be fetched are fetched again there.
+        repositories = OrderedDict()  # type: typing.Dict[Path, typing.Tuple[typing.Any, Target]]
         for target in chosen_targets:
-            if config.print_targets_only:
-                status_update("Will build target", coloured(AnsiColour.yellow, target.name))
-                print("    Dependencies for", target.name, "are", target.project_class.all_dependency_names(config))
+            # noinspection PyProtectedMember
+            if target._completed:
+                continue
+            repo_and_dir = target.get_or_create_project(None, config).get_repository_to_fetch()
+            if repo_and_dir is not None and repo_and_dir[1] not in repositories:
+                repositories[repo_and_dir[1]] = (repo_and_dir[0], target)
+        if len(repositories) < 2:
+            return  # Nothing to be gained from fetching in the background
+
+        def fetch(src_dir: Path, repository, target: Target):
+            fetch_start = time.time()
+            try:
+                repository.fetch_noninteractive(target.get_or_create_project(None, config), src_dir=src_dir)
+                return time.time() - fetch_start, None
+            except subprocess.CalledProcessError as e:
+                return time.time() - fetch_start, (e.stderr or b"").decode("utf-8", errors="replace").strip() or str(e)
+
+        num_threads = min(config.fetch_jobs, len(repositories))
+        status_update("Fetching", len(repositories), "git repositories using", num_threads, "threads")
+        starttime = time.time()
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = {executor.submit(fetch, src_dir, repository, target): target
+                       for src_dir, (repository, target) in repositories.items()}
+            for future in concurrent.futures.as_completed(futures):
+                target = futures[future]
+                duration, error = future.result()
+                if error is None:
+                    status_update("Fetched sources for", coloured(AnsiColour.yellow, target.name), "in",
+                                  "{:.1f}".format(duration), "seconds")
+                else:
+                    failed.append(target.name)
+                    warning_message("Could not fetch sources for", target.name, "(will retry during update):", error)
+        status_update("Fetched", len(repositories) - len(failed), "of", len(repositories), "git repositories in",
+                      "{:.1f}".format(time.time() - starttime), "seconds")
+
+    def _run_in_parallel(self, config: CheriConfig, chosen_targets: "typing.List[Target]"):
+        scheduling_deps = self.get_scheduling_dependencies(chosen_targets)
+        log_dir = config.build_root / "cheribuild-logs"
+        os.makedirs(str(log_dir), exist_ok=True)
+        total_jobs = config.make_jobs
+        pending = list(chosen_targets)
+        running = OrderedDict()  # type: typing.Dict[int, typing.Tuple[Target, float, Path]]
+        completed = set()
+        failed = []  # type: typing.List[typing.Tuple[Target, Path]]
+        while pending or running:
+            ready = [] if failed else [t for t in pending if all(d in completed for d in scheduling_deps[t])]
+            barrier = next((t for t in ready if t.is_scheduling_barrier), None)
+            if barrier is not None:
+                if not running:
+                    # Run barriers in the foreground (with the full job budget) since they may need the terminal
+                    pending.remove(barrier)
+                    config.make_jobs = total_jobs
+                    barrier.execute(config)
+                    completed.add(barrier)
+                    continue
+                ready = []  # wait for the currently running targets to finish first
+            if ready:
+                # Jobserver clients ignore this and share the --make-jobs slots, but bmake still needs a -j value
+                num_concurrent = min(config.parallel_targets, len(running) + len(ready))
+                jobs_per_target = max(1, total_jobs // num_concurrent)
+                for target in ready[:config.parallel_targets - len(running)]:
+                    pending.remove(target)
+                    logfile = log_dir / (target.name + ".log")
+                    status_update("Starting target", coloured(AnsiColour.yellow, target.name), "with",
+                                  jobs_per_target, "jobs, output is written to", logfile)
+                    pid = target.execute_in_child_process(config, logfile, jobs_per_target)
+                    running[pid] = (target, time.time(), logfile)
+            if not running:
+                if pending and not failed:
+                    fatal_error("Could not schedule any of the remaining targets:", " ".join(t.name for t in pending))
+                break
+            # Poll instead of using os.wait() so that we don't reap processes started by other threads
+            finished = None
+            while finished is None:
+                for pid in running:
+                    waited_pid, status = os.waitpid(pid, os.WNOHANG)
+                    if waited_pid != 0:
+                        finished = (pid, status)
+                        break
+                else:
+                    time.sleep(0.1)
+            pid, status = finished
+            target, starttime, logfile = running.pop(pid)
+            get_build_trace().load_events(target.build_trace_path(logfile))
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                # noinspection PyProtectedMember
+                target._completed = True
+                completed.add(target)
+                status_update("Built target", coloured(AnsiColour.yellow, target.name), "in",
+                              time.time() - starttime, "seconds")
             else:
-                target.execute(config)
+                failed.append((target, logfile))
+                error_message("Target", target.name, "failed, last lines of", str(logfile) + ":")
+                self._print_log_tail(logfile)
+                if running:
+                    status_update("Not starting any new targets, waiting for",
+                                  " ".join(t.name for t, _, _ in running.values()), "to complete.")
+        config.make_jobs = total_jobs
+        if failed:
+            fatal_error("Failed to build", " ".join(t.name for t, _ in failed) + ". See",
+                        " ".join(str(log) for _, log in failed), "for details.")
+
+    @staticmethod
+    def _print_log_tail(logfile: Path, num_lines=20):
+        try:
+            with logfile.open("r", encoding="utf-8", errors="replace") as f:
+                lines = f.readlines()
+        except IOError as e:
+            warning_message("Could not read", logfile, e)
+            return
+        for line in lines[-num_lines:]:
+            print("    " + line.rstrip("\n"))
 
     def get_all_chosen_targets(self, config) -> "typing.Iterable[Target]":
         # check that all target dependencies are correct:
         if os.getenv("CHERIBUILD_DEBUG"):
+            self.load_targets_for_options(None)
             for t in self._all_targets.values():
                 if isinstance(t, MultiArchTargetAlias):
                     continue
@@ -430,6 +796,7 @@ class TargetManager(object):
         # assert self._all_targets["sdk"] > self._all_targets["sdk-sysroot"]
         explicitly_chosen_targets = []  # type: typing.List[Target]
         for target_name in config.targets:
+            self._load_lazy_target(target_name)
             if target_name not in self._all_targets:
                 # See if it was a target alias without a default
                 if target_name in self._targets_for_command_line_options_only:
@@ -439,7 +806,7 @@ class TargetManager(object):
                 else:
                     import difflib
                     errmsg = coloured(AnsiColour.red, "Target", target_name, "does not exist.")
-                    suggestions = difflib.get_close_matches(target_name, self._all_targets)
+                    suggestions = difflib.get_close_matches(target_name, list(self.target_names))
                 if suggestions:
                     errmsg += " Did you mean " + " or ".join(coloured(AnsiColour.blue, s) for s in suggestions) + "?"
                 else:
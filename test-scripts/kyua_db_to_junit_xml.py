@@ -28,32 +28,134 @@
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
+import contextlib
+import sqlite3
 import tempfile
+import typing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 from run_tests_common import boot_cheribsd, junitparser
 
+# Control characters are not allowed in XML 1.0 documents (and NULL can't even be referenced) -> backslashescape them
+_CONTROL_CHAR_ESCAPES = {i: "\\x" + format(i, "02x") + ";" for i in range(32) if chr(i) not in ("\n", "\t")}
+_XML_ESCAPES = dict(_CONTROL_CHAR_ESCAPES)
+_XML_ESCAPES.update({ord("&"): "&amp;", ord("<"): "&lt;", ord(">"): "&gt;", ord('"'): "&quot;"})
+# Number of test programs that are converted by one worker process at a time
+_PROGRAMS_PER_CHUNK = 64
+_RESULTS_QUERY = """
+SELECT test_programs.relative_path, test_cases.test_case_id, test_cases.name, test_cases.metadata_id,
+       test_results.result_type, test_results.result_reason, test_results.start_time, test_results.end_time
+FROM test_programs
+    JOIN test_cases ON test_cases.test_program_id = test_programs.test_program_id
+    JOIN test_results ON test_results.test_case_id = test_cases.test_case_id
+WHERE test_programs.test_program_id IN ({})
+ORDER BY test_programs.absolute_path, test_cases.name
+"""
 
-def convert_kyua_db_to_junit_xml(db_file: Path, output_file: Path, prefix: str = None):
+
+def _xml_escape(text: str) -> str:
+    return text.translate(_XML_ESCAPES)
+
+
+def _open_kyua_db(db_file: Path) -> sqlite3.Connection:
+    db = sqlite3.connect("file:" + str(db_file.absolute()) + "?mode=ro", uri=True)
+    db.text_factory = lambda b: b.decode("utf-8", errors="backslashreplace")
+    schema_version = db.execute("SELECT MAX(schema_version) FROM metadata").fetchone()[0]
+    if schema_version != 3:
+        raise ValueError("Unsupported kyua database schema version " + str(schema_version) + " in " + str(db_file))
+    return db
+
+
+def _section(title: str, contents: str) -> str:
+    return title + "\n" + "-" * len(title) + "\n\n" + contents + "\n\n"
+
+
+def _file_contents(files: dict, name: str) -> str:
+    contents = files.get(name, "")
+    return contents.decode("utf-8", errors="backslashreplace") if isinstance(contents, bytes) else contents
+
+
+def _testcases_xml(db_file: Path, test_program_ids: typing.List[int]) -> str:
+    """Returns the <testcase> elements for all results of the given test programs (runs in a worker process)"""
+    result = []
+    with contextlib.closing(_open_kyua_db(db_file)) as db:
+        query = _RESULTS_QUERY.format(",".join("?" * len(test_program_ids)))
+        for (relative_path, test_case_id, name, metadata_id, result_type, reason, start_time,
+             end_time) in db.execute(query, test_program_ids):
+            duration = (end_time - start_time) / 1000000
+            result.append('<testcase classname="{}" name="{}" time="{:.3f}">\n'.format(
+                _xml_escape(relative_path.replace("/", ".")), _xml_escape(name), duration))
+            if result_type == "failed":
+                result.append('<failure message="{}"/>\n'.format(_xml_escape(reason or "")))
+            elif result_type == "broken":
+                result.append('<error message="{}"/>\n'.format(_xml_escape(reason or "")))
+            elif result_type == "skipped":
+                result.append("<skipped/>\n")
+            files = dict(db.execute("SELECT test_case_files.file_name, files.contents FROM test_case_files "
+                                    "JOIN files ON files.file_id = test_case_files.file_id "
+                                    "WHERE test_case_files.test_case_id = ?", (test_case_id,)))
+            stdout = _file_contents(files, "__STDOUT__")
+            result.append("<system-out>" + _xml_escape(stdout) + "</system-out>\n")
+            stderr = ""
+            if result_type in ("skipped", "expected_failure"):
+                stderr += _section(result_type.replace("_", " ").capitalize() + " result details", reason or "")
+            metadata = db.execute("SELECT property_name, property_value FROM metadatas WHERE metadata_id = ? "
+                                  "ORDER BY property_name", (metadata_id,))
+            stderr += _section("Test case metadata", "\n".join(k + " = " + (v or "") for k, v in metadata))
+            stderr += _section("Timing information", "Duration: {:.3f}s".format(duration))
+            stderr += _section("Original stderr", _file_contents(files, "__STDERR__"))
+            result.append("<system-err>" + _xml_escape(stderr) + "</system-err>\n")
+            result.append("</testcase>\n")
+    return "".join(result)
+
+
+def convert_kyua_db_to_junit_xml(db_file: Path, output_file: Path, prefix: str = None, jobs: int = 1):
+    """
+    Converts a kyua results database to JUnit XML without needing the kyua binary. The output is written incrementally
+    and the test programs are split between jobs worker processes if jobs > 1.
+    """
     assert output_file.resolve() != db_file.resolve()
-    with output_file.open("w") as output_stream:
-        command = ["kyua", "report-junit", "--results-file=" + str(db_file)]
-        boot_cheribsd.run_host_command(command, stdout=output_stream)
-        # TODO: xml escape the file?
-        if not boot_cheribsd.PRETEND:
-            fixup_kyua_generated_junit_xml(output_file, prefix)
+    boot_cheribsd.info("Converting kyua database ", db_file, " to JUnit XML ", output_file)
+    if boot_cheribsd.PRETEND:
+        return
+    with contextlib.closing(_open_kyua_db(db_file)) as db:
+        program_ids = [row[0] for row in db.execute("SELECT test_program_id FROM test_programs "
+                                                    "ORDER BY absolute_path")]
+        counts = {"tests": 0, "failed": 0, "broken": 0, "skipped": 0}
+        total_time = 0
+        for result_type, count, duration in db.execute("SELECT result_type, COUNT(*), SUM(end_time - start_time) "
+                                                       "FROM test_results GROUP BY result_type"):
+            counts["tests"] += count
+            counts[result_type] = counts.get(result_type, 0) + count
+            total_time += duration
+        properties = ['<property name="cwd" value="{}"/>\n'.format(_xml_escape(row[0]))
+                      for row in db.execute("SELECT cwd FROM contexts")]
+        properties += ['<property name="env.{}" value="{}"/>\n'.format(_xml_escape(k), _xml_escape(v))
+                       for k, v in db.execute("SELECT var_name, var_value FROM env_vars ORDER BY var_name")]
+    chunks = [program_ids[i:i + _PROGRAMS_PER_CHUNK] for i in range(0, len(program_ids), _PROGRAMS_PER_CHUNK)]
+    with output_file.open("w", encoding="utf-8") as output:
+        output.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        output.write('<testsuite{} tests="{}" failures="{}" errors="{}" skipped="{}" time="{:.3f}">\n'.format(
+            "" if prefix is None else ' name="' + _xml_escape(prefix) + '"', counts["tests"], counts["failed"],
+            counts["broken"], counts["skipped"], total_time / 1000000))
+        output.write("<properties>\n" + "".join(properties) + "</properties>\n")
+        if jobs > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                # map() returns the results in order, so the output is the same as for a single job
+                for xml in executor.map(_testcases_xml, [db_file] * len(chunks), chunks):
+                    output.write(xml)
+        else:
+            for chunk in chunks:
+                output.write(_testcases_xml(db_file, chunk))
+        output.write("</testsuite>\n")
+    boot_cheribsd.info("Wrote ", counts["tests"], " test results to ", output_file)
 
 
 def fixup_kyua_generated_junit_xml(xml_file: Path, prefix: str = None):
     boot_cheribsd.info("Updating statistics in JUnit file ", xml_file)
     # Process junit xml file with junitparser to update the number of tests, failures, total time, etc.
-    orig_xml_str = xml_file.read_text("utf-8", errors='backslashreplace')
-    xml_str = orig_xml_str
-    for i in range(32):
-        if chr(i) not in ("\n", "\t"):
-            # Can't reference NULL character -> backslashescape instead
-            # xml_str = xml_str.replace(chr(i), "&#" + str(i) + ";")
-            xml_str = xml_str.replace(chr(i), "\\x" + format(i, '02x') + ";")
+    xml_str = xml_file.read_text("utf-8", errors='backslashreplace').translate(_CONTROL_CHAR_ESCAPES)
     with tempfile.NamedTemporaryFile("wb") as tf:
         # create a temporary file first to avoid clobbering the original one if we fail to parse it
         tf.write(xml_str.encode("ascii", errors="xmlcharrefreplace"))
@@ -80,6 +182,7 @@ if __name__ == "__main__":
                         help="The output file (or - for stdout). Defaults to the db file with suffix .xml")
     parser.add_argument("--update-stats", action="store_true", help="Only update stats instead of parsing a kyua db")
     parser.add_argument("--add-prefix", help="Add a prefix to all testsuites")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes used for the conversion")
     args = parser.parse_args()
     if not args.xml:
         output = Path(args.db).with_suffix(".xml")
@@ -90,4 +193,4 @@ if __name__ == "__main__":
     if args.update_stats:
         fixup_kyua_generated_junit_xml(Path(args.db), args.add_prefix)
     else:
-        convert_kyua_db_to_junit_xml(Path(args.db), output, args.add_prefix)
+        convert_kyua_db_to_junit_xml(Path(args.db), output, args.add_prefix, jobs=args.jobs)
@@ -30,15 +30,17 @@
 # SUCH DAMAGE.
 #
 import argparse
+import collections
 import datetime
 import functools
 import itertools
 import operator
 import os
 import shlex
-import shutil
+import subprocess
 import sys
 import time
+import typing
 from pathlib import Path
 
 from kyua_db_to_junit_xml import convert_kyua_db_to_junit_xml, fixup_kyua_generated_junit_xml
@@ -113,8 +115,6 @@ def run_cheribsd_test(qemu: boot_cheribsd.QemuCheriBSDInstance, args: argparse.N
     if not qemu.check_ssh_connection():
         tests_successful = False
 
-    host_has_kyua = shutil.which("kyua") is not None
-
     # Run the various cheribsdtest binaries
     if args.run_cheribsdtest:
         # Disable trap dumps while running cheribsdtest (handle both old and new sysctl names until dev is merged):
@@ -133,87 +133,29 @@ def run_cheribsd_test(qemu: boot_cheribsd.QemuCheriBSDInstance, args: argparse.N
         qemu.run("sysctl machdep.log_user_cheri_exceptions=1 || sysctl machdep.log_cheri_exceptions=1")
 
     # Run kyua tests
-    try:
-        if args.kyua_tests_files:
+    kyua_tests_files = args.kyua_tests_files
+    if kyua_tests_files:
+        try:
             qemu.checked_run("kyua help", timeout=60)
             # Try to load the pf module for the pfctl test
             qemu.run("kldstat -m pf || kldload pf  || echo 'failed to load pf module'")
-        for i, tests_file in enumerate(args.kyua_tests_files):
-            # TODO: is the results file too big for tmpfs? No should be fine, only a few megabytes
-            qemu.checked_run("rm -f /tmp/results.db")
-            # Allow up to 24 hours to run the full testsuite
-            # Not a checked run since it might return false if some tests fail
-            test_start = datetime.datetime.now()
-            qemu.run("kyua test --results-file=/tmp/results.db -k {}".format(shlex.quote(tests_file)),
-                     ignore_cheri_trap=True, cheri_trap_fatal=False, timeout=24 * 60 * 60)
-            if i == 0:
-                result_name = "test-results.db"
-            else:
-                result_name = "test-results-{}.db".format(i)
-            results_db = Path("/test-results/{}".format(result_name))
-            results_xml = results_db.with_suffix(".xml")
-            assert shlex.quote(str(results_db)) == str(results_db), "Should not contain any special chars"
-            if qemu.smb_failed:
-                boot_cheribsd.info("SMB mount has failed, performing normal scp")
-                qemu.scp_from_guest("/tmp/results.db", Path(args.test_output_dir, results_db.name))
-            else:
-                qemu.checked_run("cp -v /tmp/results.db {}".format(results_db))
-                qemu.checked_run("fsync " + str(results_db))
-            boot_cheribsd.success("Running tests for ", tests_file, " took: ", datetime.datetime.now() - test_start)
-
-            # run: kyua report-junit --results-file=test-results.db | vis -os > ${CPU}-${TEST_NAME}-test-results.xml
-            # Not sure how much we gain by running it on the host instead.
-            # Converting the full test suite to xml can take over an hour (probably a lot faster without the vis -os
-            # pipe)
-            # TODO: should escape the XML file but that's probably faster on the host
-            if host_has_kyua:
-                boot_cheribsd.info("KYUA installed on the host, no need to do slow conversion in QEMU")
-            else:
-                xml_conversion_start = datetime.datetime.now()
-                qemu.checked_run("kyua report-junit --results-file=/tmp/results.db > /tmp/results.xml",
-                                 timeout=200 * 60)
-                if qemu.smb_failed:
-                    boot_cheribsd.info("SMB mount has failed, performing normal scp")
-                    qemu.scp_from_guest("/tmp/results.xml", Path(args.test_output_dir, results_xml.name))
-                else:
-                    qemu.checked_run("cp -v /tmp/results.xml {}".format(results_xml))
-                    qemu.checked_run("fsync " + str(results_xml))
-                boot_cheribsd.success("Creating JUnit XML ", results_xml, " took: ",
-                                      datetime.datetime.now() - xml_conversion_start)
-    except boot_cheribsd.CheriBSDCommandTimeout as e:
-        boot_cheribsd.failure("Timeout running tests: " + str(e), exit=False)
-        qemu.sendintr()
-        qemu.sendintr()
-        # Try to cancel the running command and get back to having a sensible prompt
-        qemu.checked_run("pwd")
-        time.sleep(10)
-        tests_successful = False
-    except boot_cheribsd.CheriBSDCommandFailed as e:
-        boot_cheribsd.failure("Failed to run: " + str(e), exit=False)
-        boot_cheribsd.info("Trying to shut down cleanly")
-        tests_successful = False
+        except boot_cheribsd.CheriBSDCommandFailed as e:
+            boot_cheribsd.failure("Failed to run: " + str(e), exit=False)
+            tests_successful = False
+            kyua_tests_files = []
+    for i, tests_file in enumerate(kyua_tests_files):
+        result_name = "test-results.db" if i == 0 else "test-results-{}.db".format(i)
+        if not run_kyua_tests(qemu, tests_file, [], result_name, args):
+            boot_cheribsd.info("Trying to shut down cleanly")
+            tests_successful = False
+            break
+        # The results database is converted to JUnit XML on the host after the tests have completed since
+        # running "kyua report-junit" in QEMU can take over an hour for the full test suite.
 
     # Update the JUnit stats in the XML files (both kyua and cheribsdtest):
     if args.kyua_tests_files or args.run_cheribsdtest:
-        if not boot_cheribsd.PRETEND:
-            time.sleep(2)  # sleep two seconds to ensure the files exist
-        junit_dir = Path(args.test_output_dir)
-        if host_has_kyua:
-            try:
-                boot_cheribsd.info("Converting kyua databases to JUNitXML in output directory ", junit_dir)
-                for host_kyua_db_path in junit_dir.glob("*.db"):
-                    convert_kyua_db_to_junit_xml(host_kyua_db_path, host_kyua_db_path.with_suffix(".xml"))
-            except Exception as e:
-                boot_cheribsd.failure("Could not convert kyua database in ", junit_dir, ": ", e, exit=False)
-                tests_successful = False
-        boot_cheribsd.info("Updating statistics in JUnit output directory ", junit_dir)
-        for host_xml_path in junit_dir.glob("*.xml"):
-            try:
-                # Despite the name also works for cheribsdtest
-                fixup_kyua_generated_junit_xml(host_xml_path, qemu.xtarget.generic_suffix)
-            except Exception as e:
-                boot_cheribsd.failure("Could not update stats in ", junit_dir, ": ", e, exit=False)
-                tests_successful = False
+        if not convert_test_results(args, qemu.xtarget):
+            tests_successful = False
 
     if args.interact or args.skip_poweroff:
         boot_cheribsd.info("Skipping poweroff step since --interact/--skip-poweroff was passed.")
@@ -238,6 +180,150 @@ def run_cheribsd_test(qemu: boot_cheribsd.QemuCheriBSDInstance, args: argparse.N
     return tests_successful
 
 
+def convert_test_results(args: argparse.Namespace, xtarget: CrossCompileTarget) -> bool:
+    tests_successful = True
+    if not boot_cheribsd.PRETEND:
+        time.sleep(2)  # sleep two seconds to ensure the files exist
+    junit_dir = Path(args.test_output_dir)
+    kyua_xml_files = []
+    try:
+        boot_cheribsd.info("Converting kyua databases to JUnit XML in output directory ", junit_dir)
+        for host_kyua_db_path in junit_dir.glob("*.db"):
+            xml_conversion_start = datetime.datetime.now()
+            kyua_xml_files.append(host_kyua_db_path.with_suffix(".xml"))
+            convert_kyua_db_to_junit_xml(host_kyua_db_path, host_kyua_db_path.with_suffix(".xml"),
+                                         xtarget.generic_suffix, jobs=os.cpu_count() or 1)
+            boot_cheribsd.success("Creating JUnit XML for ", host_kyua_db_path, " took: ",
+                                  datetime.datetime.now() - xml_conversion_start)
+    except Exception as e:
+        boot_cheribsd.failure("Could not convert kyua database in ", junit_dir, ": ", e, exit=False)
+        tests_successful = False
+    boot_cheribsd.info("Updating statistics in JUnit output directory ", junit_dir)
+    for host_xml_path in junit_dir.glob("*.xml"):
+        if host_xml_path in kyua_xml_files:
+            continue  # already has the correct statistics
+        try:
+            fixup_kyua_generated_junit_xml(host_xml_path, xtarget.generic_suffix)
+        except Exception as e:
+            boot_cheribsd.failure("Could not update stats in ", junit_dir, ": ", e, exit=False)
+            tests_successful = False
+    return tests_successful
+
+
+def kyua_test_filters(kyua_list_output: str) -> "typing.List[typing.List[str]]":
+    """
+    Splits the test programs listed by "kyua list" into groups that can run independently on different guests. Test
+    programs are grouped by the first two components of their directory (e.g. lib/libc) since separate kyua
+    invocations for each test program would add too much overhead.
+    """
+    groups = collections.OrderedDict()  # type: typing.Dict[str, None]
+    for line in kyua_list_output.splitlines():
+        program = line.strip().rpartition(":")[0]
+        if program:
+            # Directories with less than two components might overlap with another group (e.g. sys and sys/kern)
+            parts = program.split("/")
+            groups["/".join(parts[:2]) if len(parts) > 2 else program] = None
+    return [[group] for group in groups]
+
+
+def run_kyua_tests(qemu: boot_cheribsd.QemuCheriBSDInstance, tests_file: str, filters: "typing.List[str]",
+                   result_name: str, args: argparse.Namespace) -> bool:
+    """Runs the tests from tests_file matching filters and copies the results database to the output directory"""
+    results_db = Path("/test-results/{}".format(result_name))
+    assert shlex.quote(str(results_db)) == str(results_db), "Should not contain any special chars"
+    try:
+        test_start = datetime.datetime.now()
+        qemu.checked_run("rm -f /tmp/results.db")
+        # Allow up to 24 hours to run the full testsuite
+        # Not a checked run since it might return false if some tests fail
+        qemu.run("kyua test --results-file=/tmp/results.db -k {} {}".format(
+            shlex.quote(tests_file), " ".join(shlex.quote(f) for f in filters)),
+            ignore_cheri_trap=True, cheri_trap_fatal=False, timeout=24 * 60 * 60)
+        if qemu.smb_failed:
+            boot_cheribsd.info("SMB mount has failed, performing normal scp")
+            qemu.scp_from_guest("/tmp/results.db", Path(args.test_output_dir, results_db.name))
+        else:
+            qemu.checked_run("cp -v /tmp/results.db {}".format(results_db))
+            qemu.checked_run("fsync " + str(results_db))
+        boot_cheribsd.success("Running tests for ", tests_file, " ", " ".join(filters), " took: ",
+                              datetime.datetime.now() - test_start)
+        return True
+    except boot_cheribsd.CheriBSDCommandTimeout as e:
+        boot_cheribsd.failure("Timeout running tests: " + str(e), exit=False)
+        qemu.sendintr()
+        qemu.sendintr()
+        # Try to cancel the running command and get back to having a sensible prompt
+        qemu.checked_run("pwd")
+        time.sleep(10)
+        return False
+    except boot_cheribsd.CheriBSDCommandFailed as e:
+        boot_cheribsd.failure("Failed to run: " + str(e), exit=False)
+        return False
+
+
+def run_cheribsd_tests_in_pool(pool: boot_cheribsd.GuestPool, args: argparse.Namespace) -> bool:
+    """
+    Runs the cheribsdtest binaries and the kyua tests on a pool of guests. Every cheribsdtest binary and every group
+    of kyua test programs (see kyua_test_filters()) is a separate work item that runs on the next idle guest.
+    """
+    tests_successful = True
+    first_guest = pool.guests[0]
+    for guest in pool.guests:
+        # Enable userspace CHERI exception logging to aid debugging
+        guest.run("sysctl machdep.log_user_cheri_exceptions=1 || sysctl machdep.log_cheri_exceptions=1")
+        if args.kyua_tests_files:
+            guest.checked_run("kyua help", timeout=60)
+            # Try to load the pf module for the pfctl test
+            guest.run("kldstat -m pf || kldload pf  || echo 'failed to load pf module'")
+    try:
+        first_guest.checked_run("su -m tests -c id")
+    except boot_cheribsd.CheriBSDCommandFailed as e:
+        boot_cheribsd.failure("Failed to run su: ", e, exit=False)
+        tests_successful = False
+    if not first_guest.check_ssh_connection():
+        tests_successful = False
+
+    work_items = []
+    if args.run_cheribsdtest:
+        cheribsdtest_features = ["-dynamic", "-mt"] if not args.minimal_image else []
+        for base in [("cheribsdtest-hybrid", "cheritest"), ("cheribsdtest-purecap", "cheriabitest")]:
+            for features in itertools.chain(*map(lambda r: itertools.combinations(cheribsdtest_features, r),
+                                            range(0, len(cheribsdtest_features)+1))):
+                work_items.append(("cheribsdtest", base[0] + "".join(features), base[1] + "".join(features)))
+    for tests_file in args.kyua_tests_files:
+        filters = [[]]  # all tests in the Kyuafile
+        if not boot_cheribsd.PRETEND:
+            try:
+                listing = first_guest.run_command_via_ssh(["kyua", "list", "-k", tests_file], stdout=subprocess.PIPE)
+                filters = kyua_test_filters(listing.stdout.decode("utf-8", errors="replace")) or filters
+            except subprocess.CalledProcessError as e:
+                boot_cheribsd.failure("Could not list the tests in ", tests_file, ": ", e, exit=False)
+        for test_filter in filters:
+            work_items.append(("kyua", tests_file, test_filter, "test-results-{}.db".format(len(work_items))))
+
+    def run_item(guest: boot_cheribsd.QemuCheriBSDInstance, item: tuple) -> bool:
+        if item[0] == "cheribsdtest":
+            # Disable trap dumps while running cheribsdtest
+            guest.run("sysctl machdep.log_user_cheri_exceptions=0 || sysctl machdep.log_cheri_exceptions=0")
+            try:
+                return run_cheribsdtest(guest, item[1], item[2], args)
+            finally:
+                guest.run("sysctl machdep.log_user_cheri_exceptions=1 || sysctl machdep.log_cheri_exceptions=1")
+        return run_kyua_tests(guest, item[1], item[2], item[3], args)
+
+    results = pool.run(work_items, run_item)
+    for item, result in zip(work_items, results):
+        if not result:
+            boot_cheribsd.failure("At least one test failure in ", " ".join(map(str, item)), exit=False)
+            tests_successful = False
+    if work_items and not convert_test_results(args, first_guest.xtarget):
+        tests_successful = False
+    if tests_successful and any(guest.smb_failed for guest in pool.guests):
+        boot_cheribsd.info("Tests succeeded, but SMB mount failed -> marking tests as failed.")
+        tests_successful = False
+    return tests_successful
+
+
 def cheribsd_setup_args(args: argparse.Namespace):
     if args.run_cheribsdtest is None:
         # Only hybrid and purecap images have cheribsdtest
@@ -290,4 +376,5 @@ def add_args(parser: argparse.ArgumentParser):
 if __name__ == '__main__':
     # we set need_ssh to True here to test that SSH connections work.
     run_tests_main(test_function=run_cheribsd_test, argparse_setup_callback=add_args, should_mount_builddir=False,
-                   argparse_adjust_args_callback=cheribsd_setup_args, need_ssh=True)
+                   argparse_adjust_args_callback=cheribsd_setup_args, need_ssh=True,
+                   pool_test_function=run_cheribsd_tests_in_pool)
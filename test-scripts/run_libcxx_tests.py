@@ -85,7 +85,8 @@ def libcxx_main(barrier: Barrier = None, mp_queue: Queue = None, ssh_port_queue:
             ssh_port_queue.put((args.ssh_port, shard_num))  # check that we don't get a conflict
             run_remote_lit_test.notify_main_process(args, run_remote_lit_test.MultiprocessStages.BOOTING_CHERIBSD,
                                                     mp_queue, barrier)
-        if args.interact and (shard_num is not None or args.internal_num_shards or args.parallel_jobs):
+        if args.interact and (shard_num is not None or args.internal_num_shards or args.parallel_jobs or
+                              args.guest_pool > 1):
             boot_cheribsd.failure("Cannot use --interact with multiple shards")
             sys.exit()
         run_remote_lit_test.adjust_common_cmdline_args(args)
@@ -97,10 +98,14 @@ def libcxx_main(barrier: Barrier = None, mp_queue: Queue = None, ssh_port_queue:
             return run_remote_lit_test.run_remote_lit_tests("libcxx", qemu, args, tempdir, mp_q=mp_queue,
                                                             barrier=barrier)
 
+    def run_libcxx_tests_in_pool(pool: boot_cheribsd.GuestPool, args: argparse.Namespace) -> bool:
+        with tempfile.TemporaryDirectory(prefix="cheribuild-libcxx-tests-") as tempdir:
+            return run_remote_lit_test.run_remote_lit_tests_in_pool("libcxx", pool, args, tempdir)
+
     try:
         run_tests_main(test_function=run_libcxx_tests, need_ssh=True,  # we need ssh running to execute the tests
                        should_mount_builddir=True, argparse_setup_callback=add_cmdline_args,
-                       argparse_adjust_args_callback=set_cmdline_args)
+                       argparse_adjust_args_callback=set_cmdline_args, pool_test_function=run_libcxx_tests_in_pool)
     except Exception as e:
         if mp_queue:
             boot_cheribsd.failure("GOT EXCEPTION in shard ", shard_num, ": ", sys.exc_info(), exit=False)
@@ -379,7 +384,12 @@ def main():
     args, remainder = parser.parse_known_args(list(filter(lambda x: x != "-h" and x != "--help", sys.argv)))
     # If parallel is set spawn N processes and use the lit --num-shards + --run-shard flags to split the work
     # Since a full run takes about 16 hours this should massively reduce the amount of time needed.
-    if args.parallel_jobs and args.parallel_jobs != 1:
+    # With --guest-pool all guests are booted by one process instead and lit distributes the tests between them.
+    if args.guest_pool > 1:
+        if args.parallel_jobs and args.parallel_jobs != 1:
+            boot_cheribsd.failure("Cannot use --guest-pool together with --parallel-jobs", exit=True)
+        libcxx_main()
+    elif args.parallel_jobs and args.parallel_jobs != 1:
         run_parallel(args)
     else:
         libcxx_main()
@@ -133,6 +133,28 @@ def flush_thread(f, qemu: boot_cheribsd.CheriBSDInstance, should_exit_event: thr
     boot_cheribsd.success("QEMU output flushing thread terminated.")
 
 
+def ssh_config_entry(host: str, port: int, args: argparse.Namespace, *, user="root", control_persist="yes") -> str:
+    # TODO: move this to boot_cheribsd.py
+    return """
+Host {host}
+        User {user}
+        HostName localhost
+        Port {port}
+        IdentityFile {ssh_key}
+        # avoid errors due to changed host key:
+        UserKnownHostsFile /dev/null
+        StrictHostKeyChecking no
+        NoHostAuthenticationForLocalhost yes
+        # faster connection by reusing the existing one:
+        ControlPath {home}/.ssh/controlmasters/%r@%h:%p
+        # ConnectTimeout 20
+        # ConnectionAttempts 2
+        ControlMaster auto
+        ControlPersist {control_persist}
+""".format(host=host, user=user, port=port, ssh_key=Path(args.ssh_key).with_suffix(""), home=Path.home(),
+           control_persist=control_persist)
+
+
 def run_remote_lit_tests(testsuite: str, qemu: boot_cheribsd.CheriBSDInstance, args: argparse.Namespace, tempdir: str,
                          mp_q: multiprocessing.Queue = None, barrier: multiprocessing.Barrier = None,
                          llvm_lit_path: str = None, lit_extra_args: list = None) -> bool:
@@ -173,28 +195,9 @@ def run_remote_lit_tests_impl(testsuite: str, qemu: boot_cheribsd.CheriBSDInstan
     port = args.ssh_port
     user = "root"  # TODO: run these tests as non-root!
     test_build_dir = Path(args.build_dir)
-    # TODO: move this to boot_cheribsd.py
-    config_contents = """
-Host cheribsd-test-instance
-        User {user}
-        HostName localhost
-        Port {port}
-        IdentityFile {ssh_key}
-        # avoid errors due to changed host key:
-        UserKnownHostsFile /dev/null
-        StrictHostKeyChecking no
-        NoHostAuthenticationForLocalhost yes
-        # faster connection by reusing the existing one:
-        ControlPath {home}/.ssh/controlmasters/%r@%h:%p
-        # ConnectTimeout 20
-        # ConnectionAttempts 2
-        ControlMaster auto
-""".format(user=user, port=port, ssh_key=Path(args.ssh_key).with_suffix(""), home=Path.home())
-    config_contents += "        ControlPersist {control_persist}\n"
-    # print("Writing ssh config: ", config_contents)
     with Path(tempdir, "config").open("w") as c:
         # Keep socket open for 10 min (600) or indefinitely (yes)
-        c.write(config_contents.format(control_persist="yes"))
+        c.write(ssh_config_entry("cheribsd-test-instance", port, args, user=user, control_persist="yes"))
     Path(Path.home(), ".ssh/controlmasters").mkdir(exist_ok=True)
     boot_cheribsd.run_host_command(["cat", str(Path(tempdir, "config"))])
 
@@ -222,7 +225,7 @@ Host cheribsd-test-instance
         boot_cheribsd.failure(
             "WARNING: Could not connect to ControlMaster SSH connection. Running tests will be slower", exit=False)
         with Path(tempdir, "config").open("w") as c:
-            c.write(config_contents.format(control_persist="no"))
+            c.write(ssh_config_entry("cheribsd-test-instance", port, args, user=user, control_persist="no"))
         check_ssh_connection("Second SSH connection (without controlmaster)")
 
     if args.pretend:
@@ -326,3 +329,81 @@ Host cheribsd-test-instance
         if not qemu.isalive():
             boot_cheribsd.failure("QEMU died while running tests! ", qemu, exit=True)
     return True
+
+
+def run_remote_lit_tests_in_pool(testsuite: str, pool: boot_cheribsd.GuestPool, args: argparse.Namespace,
+                                 tempdir: str, llvm_lit_path: str = None, lit_extra_args: list = None) -> bool:
+    """
+    Run the tests with a single lit process that has one job per guest. Instead of a fixed shard of the testsuite per
+    guest, guest_pool_executor.py runs every test on whichever guest is idle at that point.
+    """
+    try:
+        import psutil  # noqa: F401
+    except ImportError:
+        boot_cheribsd.failure("Cannot run lit without `psutil` python module installed", exit=True)
+    test_build_dir = Path(args.build_dir)
+    ssh_config = Path(tempdir, "config")
+    hosts = ["cheribsd-test-instance-" + str(i) for i in range(len(pool))]
+    with ssh_config.open("w") as c:
+        for host, guest in zip(hosts, pool.guests):
+            c.write(ssh_config_entry(host, guest.ssh_port, args))
+    Path(Path.home(), ".ssh/controlmasters").mkdir(exist_ok=True)
+    extra_ssh_args = commandline_to_str(("-n", "-4", "-F", str(ssh_config)))
+    extra_scp_args = commandline_to_str(("-F", str(ssh_config)))
+    guest_commands = []
+    for i, host in enumerate(hosts):
+        boot_cheribsd.run_host_command(["ssh", "-F", str(ssh_config), host, "--", "echo", "connection successful"],
+                                       cwd=str(test_build_dir))
+        executor_args = [args.ssh_executor_script, "--host", host, "--extra-ssh-args=" + extra_ssh_args]
+        if args.use_shared_mount_for_tests:
+            shared_tmpdir = test_build_dir / ("local-tmp-guest-" + str(i))
+            shared_tmpdir.mkdir(exist_ok=True)
+            executor_args.append("--shared-mount-local-path=" + str(shared_tmpdir))
+            executor_args.append("--shared-mount-remote-path=/build/" + shared_tmpdir.name)
+        else:
+            executor_args.append("--extra-scp-args=" + extra_scp_args)
+        guest_commands.append(executor_args)
+    pool_socket = Path(tempdir, "guest-pool.sock")
+    executor = commandline_to_str([sys.executable, str(Path(__file__).parent / "guest_pool_executor.py"),
+                                   str(pool_socket)])
+    boot_cheribsd.success("Running", testsuite, "tests on", len(pool), "guests with executor", executor)
+    if llvm_lit_path is None:
+        llvm_lit_path = str(test_build_dir / "bin/llvm-lit")
+    # Every guest still only runs one test at a time since CheriBSD might wedge otherwise
+    lit_cmd = [sys.executable, llvm_lit_path, "-j" + str(len(pool)), "-vv", "-Dexecutor=" + executor, "test"]
+    if lit_extra_args:
+        lit_cmd.extend(lit_extra_args)
+    if args.lit_debug_output:
+        lit_cmd.append("--debug")
+    lit_cmd.append("--timeout=120")  # 2 minutes max per test (in case there is an infinite loop)
+    if args.xunit_output:
+        lit_cmd.extend(["--xunit-xml-output", str(Path(args.xunit_output).absolute())])
+    should_exit_event = threading.Event()
+    flush_threads = []
+    for guest in pool.guests:
+        guest.flush_interval = 15
+        t = threading.Thread(target=flush_thread, args=(guest.logfile, guest, should_exit_event))
+        t.daemon = True
+        t.start()
+        flush_threads.append(t)
+    try:
+        boot_cheribsd.success("Starting llvm-lit: cd ", test_build_dir, " && ", " ".join(lit_cmd))
+        with pool.serve_leases(pool_socket, lambda index: guest_commands[index]):
+            boot_cheribsd.run_host_command(lit_cmd, cwd=str(test_build_dir))
+    except subprocess.CalledProcessError as e:
+        boot_cheribsd.failure("SOME TESTS FAILED: ", e, exit=False)
+        # Should only ever return 1 (otherwise something else went wrong!)
+        if e.returncode == 1:
+            return False
+        raise
+    finally:
+        for host in hosts:
+            try:
+                boot_cheribsd.run_host_command(["ssh", "-F", str(ssh_config), host, "-O", "exit"],
+                                               cwd=str(test_build_dir))
+            except subprocess.CalledProcessError:
+                boot_cheribsd.failure("Could not close SSH controlmaster connection for ", host, exit=False)
+        should_exit_event.set()
+        for t in flush_threads:
+            t.join(timeout=30)
+    return True
@@ -61,7 +61,8 @@ def run_tests_main(test_function: Callable[[boot_cheribsd.QemuCheriBSDInstance,
                    should_mount_installdir=False, build_dir_in_target="/build",
                    test_setup_function: Callable[[boot_cheribsd.QemuCheriBSDInstance, argparse.Namespace], None] = None,
                    argparse_setup_callback: Callable[[argparse.ArgumentParser], None] = None,
-                   argparse_adjust_args_callback: Callable[[argparse.Namespace], None] = None):
+                   argparse_adjust_args_callback: Callable[[argparse.Namespace], None] = None,
+                   pool_test_function: Callable[[boot_cheribsd.GuestPool, argparse.Namespace], bool] = None):
     def default_add_cmdline_args(parser: argparse.ArgumentParser):
         parser.add_argument("--build-dir", required=should_mount_builddir)
         parser.add_argument("--source-dir", required=should_mount_srcdir)
@@ -125,4 +126,4 @@ def run_tests_main(test_function: Callable[[boot_cheribsd.QemuCheriBSDInstance,
     assert sys.path[1] == str(Path(__file__).parent.parent.absolute()), sys.path
     boot_cheribsd.main(test_function=test_function, test_setup_function=default_setup_tests,
                        argparse_setup_callback=default_add_cmdline_args,
-                       argparse_adjust_args_callback=default_setup_args)
+                       argparse_adjust_args_callback=default_setup_args, pool_test_function=pool_test_function)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Replays a CheriBSD console transcript (e.g. a file written by --qemu-logfile during a kyua run) through the pexpect
+# searcher that was previously used by CheriBSDSpawnMixin.expect() and the windowed ConsoleSearcher and prints the
+# time taken by each to find the final prompt while also looking for kernel panics and CHERI traps.
+# Usage: tests/benchmark_console_matcher.py [transcript.log] [--repeat N]
+import argparse
+import re
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(1, str(Path(__file__).parent.parent / "3rdparty/pexpect"))
+import pexpect  # noqa: E402
+from pycheribuild.boot_cheribsd import (CheriBSDInstance, FATAL_ERROR_MESSAGES, PANIC, PANIC_KDB,  # noqa: E402
+                                        PANIC_PAGE_FAULT, PEXPECT_PROMPT_RE, STOPPED)
+from pycheribuild.config.compilation_targets import CompilationTargets  # noqa: E402
+
+FINAL_PROMPT = "TESTS COMPLETED"
+PATTERNS = [re.compile(FINAL_PROMPT), "TESTS UNSTABLE", "TESTS FAILED", PEXPECT_PROMPT_RE + "DONE"] + \
+    FATAL_ERROR_MESSAGES + [PANIC, STOPPED, PANIC_KDB, PANIC_PAGE_FAULT]
+
+
+def _spawn(transcript: Path) -> CheriBSDInstance:
+    return CheriBSDInstance(CompilationTargets.CHERIBSD_RISCV_PURECAP, "cat", [str(transcript)], encoding="utf-8",
+                            echo=False, timeout=600)
+
+
+def run_pexpect_searcher(transcript: Path):
+    child = _spawn(transcript)
+    index = pexpect.spawn.expect(child, PATTERNS)
+    return index, len(child.before)
+
+
+def run_console_searcher(transcript: Path):
+    child = _spawn(transcript)
+    index = child._expect_console(PATTERNS)
+    return index, len(child.before)
+
+
+def _generate_transcript(path: Path, size: int):
+    with path.open("w") as f:
+        f.write("---<<BOOT>>---\nCopyright (c) 1992-2020 The FreeBSD Project.\n")
+        i = 0
+        while f.tell() < size:
+            i += 1
+            f.write("cheribsd_test_{0}:test_case_{0}  ->  passed  [0.{1:03d}s]\n".format(i, i % 1000))
+            if i % 50 == 0:
+                f.write("lib/libc/gen/test_{0}:test  ->  failed: /usr/src/lib/libc/tests/gen/test_{0}.c:42: "
+                        "Expected 0, got -1\n".format(i))
+        f.write("Results file id is usr_tests.20201018-120000-000000\n" + FINAL_PROMPT + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("transcript", nargs="?",
+                        help="Console transcript to replay (default: generate a synthetic 2 MiB kyua transcript)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as td:
+        if args.transcript:
+            transcript = Path(args.transcript)
+        else:
+            transcript = Path(td, "synthetic.log")
+            _generate_transcript(transcript, 2 * 1024 * 1024)
+        print("Replaying", transcript, "(" + str(transcript.stat().st_size // 1024), "KiB)")
+        results = []
+        for name, func in (("pexpect", run_pexpect_searcher), ("windowed", run_console_searcher)):
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                result = func(transcript)
+                duration = time.perf_counter() - start
+                best = duration if best is None else min(best, duration)
+            results.append(result)
+            print("{:>10}: {:.3f}s (matched pattern {} after {} characters)".format(name, best, *result))
+        assert results[0] == results[1], results
+
+
+if __name__ == "__main__":
+    main()
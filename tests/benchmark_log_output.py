@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Replays a captured build log (e.g. a CheriBSD buildworld log) through the old line-by-line output loop and the
+# chunked stream_process_output() pipeline used by Project.run_with_logfile() and prints the time taken by each.
+# Usage: tests/benchmark_log_output.py [build.log] [--repeat N]
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from pycheribuild.processutils import stream_process_output  # noqa: E402
+
+
+class FakeTerminal(object):
+    """Mimics Project._line_not_important_stdout_filter() but writes to /dev/null instead of stdout"""
+
+    def __init__(self):
+        self.output = open(os.devnull, "wb")
+        self.last_line_can_be_overwritten = False
+        self.callbacks = 0
+
+    def not_important_filter(self, line: bytes):
+        self.callbacks += 1
+        if self.last_line_can_be_overwritten:
+            self.output.write(b"\x1b[2K\r")
+        self.output.write(line[:-1])
+        self.output.write(b" ")
+        self.output.flush()
+        self.last_line_can_be_overwritten = True
+
+    def stderr_line(self, line: bytes):
+        self.callbacks += 1
+        if self.last_line_can_be_overwritten:
+            self.output.write(b"\n")
+            self.last_line_can_be_overwritten = False
+        self.output.write(line)
+        self.output.flush()
+
+
+def _start_replay(log: Path):
+    # Print the log on stdout and a small part of it on stderr to exercise both pipes
+    script = "cat \"$1\"; head -n 100 \"$1\" >&2"
+    return subprocess.Popen(["sh", "-c", script, "sh", str(log)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def run_legacy(log: Path, logfile, terminal: FakeTerminal):
+    proc = _start_replay(log)
+    lock = threading.Lock()
+
+    def handle_stderr():
+        for err_line in proc.stderr:
+            with lock:
+                terminal.stderr_line(err_line)
+                logfile.write(err_line)
+
+    stderr_thread = threading.Thread(target=handle_stderr)
+    stderr_thread.start()
+    for line in proc.stdout:
+        with lock:
+            logfile.write(line)
+            terminal.not_important_filter(line)
+    proc.wait()
+    stderr_thread.join()
+
+
+def run_streaming(log: Path, logfile, terminal: FakeTerminal):
+    proc = _start_replay(log)
+    stream_process_output(proc.stdout, proc.stderr, logfile, stdout_callback=terminal.not_important_filter,
+                          stderr_callback=terminal.stderr_line, latest_stdout_line_only=True)
+    proc.wait()
+
+
+def _generate_log(path: Path, lines: int):
+    with path.open("wb") as f:
+        for i in range(lines):
+            if i % 500 == 0:
+                f.write(b"===> lib/libfoo" + str(i).encode() + b" (all)\n")
+            f.write(b"/cheri/output/sdk/bin/clang -target mips64c128-unknown-freebsd13 -O2 -pipe -fPIC -c "
+                    b"/cheri/cheribsd/lib/libfoo/file" + str(i).encode() + b".c -o file.pico\n")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log", nargs="?", help="Build log to replay (default: generate a synthetic 500k line log)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as td:
+        if args.log:
+            log = Path(args.log)
+        else:
+            log = Path(td, "synthetic.log")
+            _generate_log(log, 500000)
+        print("Replaying", log, "(" + str(log.stat().st_size // 1024), "KiB)")
+        for name, func in (("line-by-line", run_legacy), ("streaming", run_streaming)):
+            best = None
+            for _ in range(args.repeat):
+                terminal = FakeTerminal()
+                with Path(td, name + ".log").open("wb") as logfile:
+                    start = time.perf_counter()
+                    func(log, logfile, terminal)
+                    duration = time.perf_counter() - start
+                best = duration if best is None else min(best, duration)
+                assert Path(td, name + ".log").stat().st_size == log.stat().st_size + \
+                    len(b"".join(log.open("rb").readlines()[:100]))
+            print("{:>14}: {:.3f}s ({} terminal updates)".format(name, best, terminal.callbacks))
+
+
+if __name__ == "__main__":
+    main()
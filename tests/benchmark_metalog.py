@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# Measures the time taken to parse a METALOG file (e.g. the one from a CheriBSD installworld) with MtreeFile.
+# If no file is given, a synthetic METALOG with --num-files entries is generated.
+# Usage: tests/benchmark_metalog.py [METALOG] [--num-files N] [--repeat N]
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from pycheribuild.mtree import MtreeFile  # noqa: E402
+from tests.test_metalog import _write_large_metalog  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("metalog", nargs="?", type=Path)
+    parser.add_argument("--num-files", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as td:
+        metalog = args.metalog
+        if metalog is None:
+            metalog = Path(td, "METALOG")
+            _write_large_metalog(metalog, args.num_files)
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            mtree = MtreeFile(metalog)
+            duration = time.perf_counter() - start
+            print("Parsed", len(mtree._mtree), "entries from", metalog, "in", round(duration, 3), "seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+-- A small synthetic kyua results database (schema version 3) used by test_kyua_db_to_junit_xml.py
+CREATE TABLE metadata (schema_version INTEGER PRIMARY KEY CHECK (schema_version >= 1),
+                       timestamp TIMESTAMP NOT NULL CHECK (timestamp >= 0));
+CREATE TABLE contexts (cwd TEXT NOT NULL);
+CREATE TABLE env_vars (var_name TEXT PRIMARY KEY, var_value TEXT NOT NULL);
+CREATE TABLE metadatas (metadata_id INTEGER NOT NULL, property_name TEXT NOT NULL, property_value TEXT,
+                        PRIMARY KEY (metadata_id, property_name));
+CREATE TABLE test_programs (test_program_id INTEGER PRIMARY KEY AUTOINCREMENT, absolute_path TEXT NOT NULL,
+                            root TEXT NOT NULL, relative_path TEXT NOT NULL, test_suite_name TEXT NOT NULL,
+                            metadata_id INTEGER REFERENCES metadatas, interface TEXT NOT NULL);
+CREATE TABLE test_cases (test_case_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                         test_program_id INTEGER REFERENCES test_programs, name TEXT NOT NULL,
+                         metadata_id INTEGER REFERENCES metadatas);
+CREATE TABLE test_results (test_case_id INTEGER PRIMARY KEY REFERENCES test_cases, result_type TEXT NOT NULL,
+                           result_reason TEXT, start_time TIMESTAMP NOT NULL, end_time TIMESTAMP NOT NULL);
+CREATE TABLE files (file_id INTEGER PRIMARY KEY, contents BLOB NOT NULL);
+CREATE TABLE test_case_files (test_case_id INTEGER NOT NULL REFERENCES test_cases, file_name TEXT NOT NULL,
+                              file_id INTEGER NOT NULL REFERENCES files, PRIMARY KEY (test_case_id, file_name));
+
+INSERT INTO metadata VALUES (3, 1600000000000000);
+INSERT INTO contexts VALUES ('/usr/tests');
+INSERT INTO env_vars VALUES ('HOME', '/root');
+INSERT INTO env_vars VALUES ('PATH', '/sbin:/bin:/usr/sbin:/usr/bin');
+
+INSERT INTO metadatas VALUES (1, 'timeout', '300');
+INSERT INTO metadatas VALUES (1, 'description', 'Checks <foo> & "bar"');
+INSERT INTO metadatas VALUES (2, 'timeout', '60');
+
+INSERT INTO test_programs VALUES (1, '/usr/tests/bin/sh/builtins_test', '/usr/tests', 'bin/sh/builtins_test',
+                                  'FreeBSD', 2, 'atf');
+INSERT INTO test_programs VALUES (2, '/usr/tests/lib/libc/string_test', '/usr/tests', 'lib/libc/string_test',
+                                  'FreeBSD', 2, 'atf');
+
+INSERT INTO test_cases VALUES (1, 1, 'echo', 1);
+INSERT INTO test_cases VALUES (2, 1, 'cd', 2);
+INSERT INTO test_cases VALUES (3, 2, 'strlen', 2);
+INSERT INTO test_cases VALUES (4, 2, 'strcpy', 2);
+INSERT INTO test_cases VALUES (5, 2, 'memcpy', 2);
+
+INSERT INTO test_results VALUES (1, 'passed', NULL, 1000000, 1500000);
+INSERT INTO test_results VALUES (2, 'failed', 'cd returned 1 < 0', 2000000, 4000000);
+INSERT INTO test_results VALUES (3, 'broken', 'Test case timed out', 0, 300000000);
+INSERT INTO test_results VALUES (4, 'skipped', 'Requires root', 5000000, 5000000);
+INSERT INTO test_results VALUES (5, 'expected_failure', 'Known bug', 6000000, 6250000);
+
+INSERT INTO files VALUES (1, 'hello world' || char(10));
+INSERT INTO files VALUES (2, 'control' || char(1) || 'character');
+INSERT INTO test_case_files VALUES (1, '__STDOUT__', 1);
+INSERT INTO test_case_files VALUES (2, '__STDERR__', 2);
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tarfile
+import time
+from pathlib import Path
+
+import pytest
+
+from pycheribuild.archive import detect_archive_compression, extract_archive, ReproducibleTarWriter
+from .setup_mock_chericonfig import setup_mock_chericonfig
+
+
+def _create_tree(root: Path):
+    (root / "bin").mkdir(parents=True)
+    (root / "bin/tool").write_text("tool")
+    os.chmod(str(root / "bin/tool"), 0o755)
+    os.symlink("tool", str(root / "bin/tool-alias"))
+    os.link(str(root / "bin/tool"), str(root / "bin/tool-hardlink"))
+    (root / "share/doc").mkdir(parents=True)
+    (root / "share/doc/README").write_text("readme")
+
+
+@pytest.mark.parametrize("compression", ["zstd", "xz", "gzip"])
+def test_reproducible_archive(tmp_path, compression):
+    if not shutil.which(compression):
+        pytest.skip(compression + " is not installed")
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    _create_tree(tmp_path / "tree")
+    first = tmp_path / "first.tar"
+    with ReproducibleTarWriter(first, compression=compression, threads=2) as writer:
+        writer.add_tree(tmp_path / "tree")
+    assert detect_archive_compression(first) == compression
+    # Neither timestamps nor the number of threads should affect the archive contents
+    os.utime(str(tmp_path / "tree/share/doc/README"), (time.time() - 3600, time.time() - 3600))
+    second = tmp_path / "second.tar"
+    with ReproducibleTarWriter(second, compression=compression, threads=4) as writer:
+        writer.add_tree(tmp_path / "tree")
+    assert first.read_bytes() == second.read_bytes()
+
+    output = tmp_path / "output"
+    output.mkdir()
+    extract_archive(second, output, extra_args=["--strip-components", "1"], config=config)
+    assert (output / "bin/tool").read_text() == "tool"
+    assert os.access(str(output / "bin/tool"), os.X_OK)
+    assert os.readlink(str(output / "bin/tool-alias")) == "tool"
+    assert os.stat(str(output / "bin/tool-hardlink")).st_ino == os.stat(str(output / "bin/tool")).st_ino
+    assert (output / "share/doc/README").read_text() == "readme"
+
+
+def test_copy_while_archiving(tmp_path):
+    (tmp_path / "file.txt").write_text("contents")
+    archive = tmp_path / "archive.tar.gz"
+    with ReproducibleTarWriter(archive) as writer:
+        writer.add_file("sysroot/usr/lib/file.txt", tmp_path / "file.txt", mode=0o444,
+                        copy_to=tmp_path / "copy.txt")
+    assert (tmp_path / "copy.txt").read_text() == "contents"
+    assert os.stat(str(tmp_path / "copy.txt")).st_mode & 0o777 == 0o444
+    assert not (tmp_path / "archive.tar.gz.tmp").exists()
+    with tarfile.open(str(archive)) as tar:
+        assert tar.getnames() == ["sysroot", "sysroot/usr", "sysroot/usr/lib", "sysroot/usr/lib/file.txt"]
+        assert all(m.uid == 0 and m.mtime == 0 and m.uname == "" for m in tar.getmembers())
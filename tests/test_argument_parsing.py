@@ -20,9 +20,10 @@ from pycheribuild.projects.cross.qt5 import BuildQtBase
 # noinspection PyProtectedMember
 from pycheribuild.projects.disk_image import _BuildDiskImageBase, BuildCheriBSDDiskImage
 # Override the default config loader:
-from pycheribuild.projects.project import SimpleProject
+from pycheribuild.projects.project import Project, SimpleProject
 from pycheribuild.projects.run_qemu import LaunchCheriBSD
 from pycheribuild.targets import MultiArchTargetAlias, Target, target_manager
+import pycheribuild.utils
 
 _loader = JsonAndCommandLineConfigLoader()
 SimpleProject._config_loader = _loader
@@ -829,3 +830,32 @@ def test_relative_paths_in_config():
         assert config.build_root == Path(td, "subdir/build")
         assert config.source_root == Path(td, "some-other-dir")
         assert config.output_root == Path(td, "output")
+
+
+def test_unknown_option_names():
+    _parse_arguments([])
+    # Only options that have not been registered yet are passed to register_deferred_options()
+    # noinspection PyProtectedMember
+    assert _loader._unknown_option_names(["--pretend", "-p", "--llvm-native/build-type=Debug", "--not-loaded/foo=1",
+                                          "-x", "target", "--sysroot/"]) == ["not-loaded/foo", "x", "sysroot/"]
+
+
+def test_artifact_cache_key_includes_configure_args(monkeypatch):
+    # LLVM only adds LLVM_ENABLE_PROJECTS in configure(), so the key must be computed after configure() ran.
+    monkeypatch.setattr(Project, "configure", lambda self, **kwargs: None)  # don't run CMake
+    monkeypatch.setattr(Project, "_clean_git_revision", lambda self, source_dir: "abcdef")
+    monkeypatch.setattr(Project, "cached_full_dependencies", lambda self: [])
+
+    def key_after_configure(*args):
+        config = _parse_arguments(list(args))
+        monkeypatch.setattr(pycheribuild.utils, "GlobalConfig", config)
+        project = _get_target_instance("llvm-native", config, Project)
+        project.setup()
+        key_before_configure = project.artifact_cache_key()
+        project.configure()
+        assert project.artifact_cache_key() != key_before_configure
+        return project.artifact_cache_key()
+
+    default_key = key_after_configure()
+    assert key_after_configure() == default_key
+    assert key_after_configure("--llvm-native/include-projects=llvm,clang") != default_key
@@ -0,0 +1,269 @@
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import time
+from pathlib import Path
+
+_cheribuild_root = Path(__file__).parent.parent
+sys.path.insert(1, str(_cheribuild_root / "3rdparty/pexpect"))
+sys.path.insert(1, str(_cheribuild_root / "3rdparty/ptyprocess"))
+from pycheribuild import boot_cheribsd  # noqa: E402
+
+
+def test_boot_snapshot_key(tmp_path):
+    kernel = tmp_path / "kernel"
+    kernel.write_bytes(b"kernel")
+    disk_image = tmp_path / "disk.img"
+    disk_image.write_bytes(b"disk")
+    qemu_args = ["/does/not/exist/qemu-system-riscv64cheri", "-M", "virt"]
+
+    def key(args=None, *, kernel_image=kernel):
+        return boot_cheribsd.boot_snapshot_key(args or qemu_args, kernel_image=kernel_image, disk_image=disk_image)
+
+    initial = key()
+    assert initial == key() and len(initial) == 32
+    assert key(qemu_args + ["-smp", "2"]) != initial
+    # The key depends on the path, size and modification time of the kernel and disk image (not the contents)
+    other_kernel = tmp_path / "kernel2"
+    other_kernel.write_bytes(b"kernel")
+    os.utime(str(other_kernel), ns=(kernel.stat().st_atime_ns, kernel.stat().st_mtime_ns))
+    assert key(kernel_image=other_kernel) != initial
+    st = disk_image.stat()
+    disk_image.write_bytes(b"DISK")
+    os.utime(str(disk_image), ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert key() == initial  # same size and mtime
+    os.utime(str(disk_image), ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    assert key() != initial
+    disk_image.write_bytes(b"larger disk")
+    os.utime(str(disk_image), ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert key() != initial
+
+
+class _FakeQemu(object):
+    def __init__(self, qemu_args, restore_succeeds):
+        self.qemu_args = qemu_args
+        self.restore_succeeds = restore_succeeds
+        self.commands = []
+        self.terminated = False
+
+    def sendline(self, line):
+        pass
+
+    def expect_exact_ignore_panic(self, patterns, timeout):
+        return 0 if self.restore_succeeds else 1
+
+    def run(self, cmd):
+        self.commands.append(cmd)
+
+    def terminate(self, force=False):
+        self.terminated = True
+
+
+def test_boot_from_snapshot(tmp_path, monkeypatch):
+    disk_image = tmp_path / "disk.img"
+    disk_image.write_bytes(b"disk")
+    snapshot_dir = tmp_path / "snapshots"
+    started = []
+    saved = []
+    state = {"restore_succeeds": True, "save_succeeds": True}
+
+    def run_host_command(cmd, **kwargs):
+        assert cmd[1] == "create" and cmd[-2] == str(disk_image.absolute())
+        Path(cmd[-1]).write_bytes(b"overlay")
+
+    def start_qemu(qemu_args, logfile_mode="w"):
+        started.append(qemu_args)
+        return _FakeQemu(qemu_args, state["restore_succeeds"])
+
+    def save_boot_snapshot(child):
+        saved.append(child)
+        return state["save_succeeds"]
+
+    monkeypatch.setattr(boot_cheribsd, "run_host_command", run_host_command)
+    monkeypatch.setattr(boot_cheribsd, "_qemu_img_binary", lambda qemu: "qemu-img")
+    monkeypatch.setattr(boot_cheribsd, "boot_and_login", lambda child, **kwargs: None)
+    monkeypatch.setattr(boot_cheribsd, "_save_boot_snapshot", save_boot_snapshot)
+
+    def boot(key):
+        return boot_cheribsd._boot_from_snapshot(
+            snapshot_dir, key, disk_image=disk_image, get_qemu_args=lambda image, fmt="raw": ["qemu", str(image)],
+            start_qemu=start_qemu, network_iface=None, keep_disk_image_copy=True)
+
+    # The first boot is a cold boot that saves the snapshot, which is then restored
+    child = boot("key1")
+    assert child is not None and len(saved) == 1
+    assert [args[1] for args in started] == [str(snapshot_dir / "key1.qcow2.tmp"), child.qemu_args[1]]
+    assert (snapshot_dir / "key1.qcow2").exists() and not (snapshot_dir / "key1.qcow2.tmp").exists()
+    assert child.qemu_args[-2:] == ["-loadvm", boot_cheribsd.BOOT_SNAPSHOT_TAG]
+    # Every run uses a private copy of the snapshot
+    assert Path(child.qemu_args[1]).read_bytes() == b"overlay" and child.qemu_args[1] != str(disk_image)
+    assert child.commands[0].startswith("date -u ")
+    # Later boots restore the existing snapshot without booting
+    started.clear()
+    child = boot("key1")
+    assert child is not None and len(saved) == 1 and len(started) == 1
+    # A snapshot that cannot be restored is deleted
+    state["restore_succeeds"] = False
+    assert boot("key1") is None
+    assert not (snapshot_dir / "key1.qcow2").exists()
+    # If saving fails, the configuration is marked as unsupported and snapshots are no longer attempted for it
+    state["save_succeeds"] = False
+    started.clear()
+    assert boot("key2") is None
+    assert (snapshot_dir / "key2.unsupported").exists() and not (snapshot_dir / "key2.qcow2.tmp").exists()
+    assert boot("key2") is None
+    assert len(started) == 1
+
+
+class _FakeGuest(object):
+    def __init__(self, index: int):
+        self.index = index
+        self.terminated = False
+
+    def isalive(self):
+        return not self.terminated
+
+    def terminate(self, force=False):
+        self.terminated = True
+
+
+def test_guest_pool_boot():
+    def boot_guest(index: int):
+        if index == 1:
+            boot_cheribsd.failure("boot failed", exit=True)  # raises SystemExit in the boot thread
+        return _FakeGuest(index)
+
+    pool = boot_cheribsd.GuestPool.boot(3, boot_guest)
+    # Guests that failed to boot are not part of the pool
+    assert len(pool) == 2
+    assert [g.index for g in pool.guests] == [0, 2]
+    pool.shutdown()
+    assert all(g.terminated for g in pool.guests)
+
+
+def test_guest_pool_run():
+    pool = boot_cheribsd.GuestPool([_FakeGuest(i) for i in range(3)])
+    ran_on = {}
+
+    def run_item(guest: _FakeGuest, item: int):
+        if item == 0:
+            time.sleep(0.5)  # one slow item, the other guests should run all the remaining ones
+        if item == 5 and guest.index == 1:
+            guest.terminate()  # guest died while running the item -> retried on another guest
+            raise RuntimeError("guest died")
+        ran_on[item] = guest.index
+        return item * 2
+
+    assert pool.run(list(range(10)), run_item) == [i * 2 for i in range(10)]
+    assert sorted(ran_on) == list(range(10))
+    assert ran_on[5] != 1
+    assert [item for item, guest in ran_on.items() if guest == ran_on[0]] == [0]
+    # No guests left to run the items
+    pool.guests[0].terminate()
+    pool.guests[2].terminate()
+    assert pool.run([1, 2], run_item) == [None, None]
+
+
+def test_guest_pool_leases(tmp_path):
+    pool = boot_cheribsd.GuestPool([_FakeGuest(i) for i in range(2)])
+    executor = str(_cheribuild_root / "test-scripts/guest_pool_executor.py")
+    socket_path = tmp_path / "pool.sock"
+    log = tmp_path / "log"
+    # Every "test" logs the guest that it ran on
+    script = "echo start $0 >> {0} && sleep 0.2 && echo end $0 >> {0}".format(log)
+    with pool.serve_leases(socket_path, lambda index: ["sh", "-c", script, "guest" + str(index)]):
+        processes = [subprocess.Popen([sys.executable, executor, str(socket_path)]) for _ in range(6)]
+        assert [p.wait() for p in processes] == [0] * 6
+        lines = log.read_text().splitlines()
+        # A killed executor still returns the guest to the pool
+        killed = subprocess.Popen([sys.executable, executor, str(socket_path)])
+        killed.kill()
+        killed.wait()
+        assert subprocess.call([sys.executable, executor, str(socket_path)]) == 0
+    assert not socket_path.exists()
+    assert len(lines) == 12
+    # Both guests were used, but each guest only ran one test at a time
+    running = {}
+    for line in lines:
+        event, guest = line.split()
+        running[guest] = running.get(guest, 0) + (1 if event == "start" else -1)
+        assert running[guest] in (0, 1)
+    assert sorted(running) == ["guest0", "guest1"]
+
+
+def _add_file(tar: tarfile.TarFile, name: str, size: int):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    tar.addfile(info, io.BytesIO(name.encode("utf-8")[:1] * size))
+
+
+def test_split_tar_stream(tmp_path):
+    archive = tmp_path / "tests.tar.xz"
+    with tarfile.open(str(archive), "w:xz") as tar:
+        for i in range(10):
+            _add_file(tar, "bin/test" + str(i), 1000 * (i + 1))
+        link = tarfile.TarInfo("bin/test-link")
+        link.type = tarfile.LNKTYPE
+        link.linkname = "bin/test3"
+        tar.addfile(link)
+    # Every stream extracts into its own directory so that we can check how the members were split
+    output = tmp_path / "output"
+    output.mkdir()
+    extract_command = ["sh", "-c", "d=$(mktemp -d \"$0/stream.XXXXXX\") && tar xf - -C \"$d\"", str(output)]
+    boot_cheribsd.GuestFileTransfer._copy_archive_in_parallel(archive, extract_command, 3)
+    streams = sorted(output.iterdir())
+    assert len(streams) == 3
+    files = {str(p.relative_to(stream)): stream for stream in streams for p in stream.glob("bin/*")}
+    assert sorted(files) == sorted(["bin/test" + str(i) for i in range(10)] + ["bin/test-link"])
+    assert all(len(list(stream.glob("bin/*"))) >= 3 for stream in streams)  # the streams are roughly balanced
+    # Hard links are extracted by the same tar process as their target
+    assert files["bin/test-link"] == files["bin/test3"]
+    assert (files["bin/test3"] / "bin/test-link").stat().st_ino == (files["bin/test3"] / "bin/test3").stat().st_ino
+    assert (files["bin/test9"] / "bin/test9").stat().st_size == 10000
+
+
+class _LocalGuest(object):
+    """Runs the "guest" commands on the host"""
+    transfer_record_file = None
+
+    def ssh_command(self, command, use_controlmaster=False):
+        return ["sh", "-c"] + command
+
+    def run_command_via_ssh(self, command, stdout=None, use_controlmaster=False):
+        return subprocess.run(self.ssh_command(command), stdout=stdout, check=True)
+
+
+def test_skip_recorded_transfers(tmp_path, capsys):
+    archive = tmp_path / "tests.tar.xz"
+    with tarfile.open(str(archive), "w:xz") as tar:
+        _add_file(tar, "test/file", 10)
+    library = tmp_path / "libpreload.so"
+    library.write_bytes(b"library")
+    guest = _LocalGuest()
+    guest.transfer_record_file = boot_cheribsd.guest_transfer_record_file(tmp_path / "disk.img")
+    target_dir = tmp_path / "guest"
+
+    def transfer():
+        result = boot_cheribsd.GuestFileTransfer(guest)
+        result.copy_archive(archive, str(target_dir))
+        result.copy_file(library, str(target_dir / "preload/libpreload.so"))
+        return capsys.readouterr().err
+
+    output = transfer()
+    assert "Not copying" not in output
+    assert (target_dir / "test/file").read_bytes() == b"t" * 10
+    assert (target_dir / "preload/libpreload.so").read_bytes() == b"library"
+    # The records are stored on the host (the disk image is modified by the guest) and skip the transfers if the
+    # files still exist in the guest.
+    assert guest.transfer_record_file.name == "disk.img.cheribuild-transfers.json"
+    output = transfer()
+    assert "already been extracted" in output and "is up-to-date" in output
+    (target_dir / "test/file").unlink()
+    output = transfer()
+    assert "already been extracted" not in output and "is up-to-date" in output
+    assert (target_dir / "test/file").exists()
+    # Without a record file (e.g. when using a copy of the disk image) everything is copied
+    guest.transfer_record_file = None
+    assert "Not copying" not in transfer()
@@ -0,0 +1,110 @@
+import errno
+import io
+import os
+import tarfile
+import time
+from pathlib import Path
+
+from pycheribuild.buildcache import BuildArtifactCache, InstallTreeSnapshot
+
+
+def _write(path: Path, contents: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(contents)
+
+
+def test_snapshot_and_restore(tmp_path):
+    install_root = tmp_path / "install"
+    _write(install_root / "bin/unrelated", "other project")
+    snapshot = InstallTreeSnapshot([install_root])
+    _write(install_root / "bin/tool", "tool")
+    _write(install_root / "share/data/file.txt", "data")
+    os.symlink("tool", str(install_root / "bin/tool-alias"))
+    changed = snapshot.changed_files()
+    assert changed == [["bin/tool", "bin/tool-alias", "share", "share/data", "share/data/file.txt"]]
+
+    cache = BuildArtifactCache(tmp_path / "cache", 1024 * 1024)
+    assert cache.lookup("abcdef") is None
+    cache.store("abcdef", [install_root], changed, {"target": "tool"})
+    assert cache.lookup("abcdef") is not None
+    # Restoring into an empty directory should only create the files installed by the project
+    new_root = tmp_path / "new-install"
+    assert cache.restore("abcdef", [new_root])
+    assert (new_root / "bin/tool").read_text() == "tool"
+    assert (new_root / "share/data/file.txt").read_text() == "data"
+    assert os.readlink(str(new_root / "bin/tool-alias")) == "tool"
+    assert not (new_root / "bin/unrelated").exists()
+    assert not cache.restore("000000", [new_root])
+
+
+def test_lru_eviction(tmp_path):
+    install_root = tmp_path / "install"
+    cache = BuildArtifactCache(tmp_path / "cache", 1024 * 1024)
+    for i in range(3):
+        _write(install_root / ("file" + str(i)), "x" * 100000)
+        cache.store("key" + str(i), [install_root], [["file" + str(i)]], {"target": "t" + str(i)})
+        # Ensure distinct modification times for the LRU ordering
+        past = time.time() - 100 + i
+        os.utime(str(cache.lookup("key" + str(i)).path / BuildArtifactCache.metadata_name), (past, past))
+    # Using key0 makes it the most recently used entry
+    assert cache.restore("key0", [tmp_path / "restored"])
+    assert [e.key for e in cache.entries()] == ["key0", "key2", "key1"]
+    removed = cache.evict(max_size=250000)
+    assert [e.key for e in removed] == ["key1"]
+    assert [e.key for e in cache.entries()] == ["key0", "key2"]
+
+
+def test_restore_rejects_unsafe_members(tmp_path):
+    install_root = tmp_path / "install"
+    _write(install_root / "file", "file")
+    cache = BuildArtifactCache(tmp_path / "cache", 1024 * 1024)
+    cache.store("key", [install_root], [["file"]], {"target": "t"})
+    archive = cache.lookup("key").path / "root0.tar"
+    outside = tmp_path / "outside"
+    outside.mkdir()
+
+    def restore_with_member(name: str, kind=tarfile.REGTYPE, linkname=""):
+        with tarfile.open(str(archive), "w") as tar:
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            info.linkname = linkname
+            tar.addfile(info, io.BytesIO(b""))
+        return cache.restore("key", [tmp_path / "restored"])
+
+    assert not restore_with_member("../outside/evil")
+    assert not restore_with_member(str(outside / "evil"))
+    assert not restore_with_member("link", tarfile.SYMTYPE, "../../outside")
+    assert not restore_with_member("hardlink", tarfile.LNKTYPE, "../outside/evil")
+    assert not restore_with_member("dev", tarfile.CHRTYPE)
+    assert list(outside.iterdir()) == []
+    # Existing symlinks in the install root must not be followed either
+    (tmp_path / "restored").mkdir()
+    os.symlink(str(outside), str(tmp_path / "restored/dir"))
+    assert not restore_with_member("dir/evil")
+    assert list(outside.iterdir()) == []
+    # Absolute symlinks (e.g. in a rootfs) are fine
+    assert restore_with_member("lib/libc.so", tarfile.SYMTYPE, "/lib/libc.so.7")
+    assert os.readlink(str(tmp_path / "restored/lib/libc.so")) == "/lib/libc.so.7"
+
+
+def test_concurrent_store(tmp_path, monkeypatch):
+    install_root = tmp_path / "install"
+    _write(install_root / "file", "first")
+    cache = BuildArtifactCache(tmp_path / "cache", 1024 * 1024)
+    cache.store("key", [install_root], [["file"]], {"target": "t"})
+    # Another writer already added the same key -> keep the existing entry
+    _write(install_root / "file", "second")
+    cache.store("key", [install_root], [["file"]], {"target": "t"})
+    assert cache.restore("key", [tmp_path / "restored"])
+    assert (tmp_path / "restored/file").read_text() == "first"
+
+    # Losing the race in the rename must not fail the build
+    def rename_after_other_writer(src: str, dst: str):
+        os.makedirs(os.path.join(dst, "other-writer"))
+        raise OSError(errno.ENOTEMPTY, os.strerror(errno.ENOTEMPTY), dst)
+
+    monkeypatch.setattr(os, "rename", rename_after_other_writer)
+    cache.store("other", [install_root], [["file"]], {"target": "t"})
+    assert (tmp_path / "cache/ot/other/other-writer").is_dir()
+    assert [e.key for e in cache.entries()] == ["key"]  # the incomplete entry of the other writer has no metadata
+    assert not list((tmp_path / "cache").glob(".tmp-*"))
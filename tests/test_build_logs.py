@@ -0,0 +1,63 @@
+import json
+import lzma
+
+import pytest
+
+from pycheribuild.buildlogs import BuildLogWriter, print_build_log_errors, rotate_build_logs
+
+
+def test_compressed_log_index(tmp_path, capsys):
+    logfile = tmp_path / "build.log"
+    with BuildLogWriter(logfile, compression="xz") as writer:
+        writer.write(b"cc -c foo.c\nfoo.c:1:2: warning: unused variable\n")
+        writer.write(b"cc -c bar.c\nbar.c:3:4: error: unknown type name\nmake: *** [bar.o] Error 1\n")
+    # Appending adds a new xz stream and continues the line numbers and offsets
+    with BuildLogWriter(logfile, compression="xz", append=True) as writer:
+        writer.write(b"baz.c:5:6: error: expected ';'\n")
+    contents = lzma.decompress((tmp_path / "build.log.xz").read_bytes())
+    assert contents.count(b"\n") == 6
+    index = json.loads((tmp_path / "build.log.errors.json").read_text())
+    assert index["counts"] == {"error": 3, "warning": 1}
+    assert [(e["kind"], e["line"]) for e in index["entries"]] == [("warning", 2), ("error", 4), ("error", 5),
+                                                                  ("error", 6)]
+    for entry in index["entries"]:
+        assert contents[entry["offset"]:].startswith(entry["text"].encode("utf-8"))
+    assert print_build_log_errors(tmp_path) == 3
+    output = capsys.readouterr().out
+    assert "line 4 (offset" in output and "unused variable" not in output
+
+
+def test_rotate_logs(tmp_path):
+    logfile = tmp_path / "build.log"
+    for i in range(4):
+        rotate_build_logs(logfile, keep=3)
+        with BuildLogWriter(logfile) as writer:
+            writer.write(str(i).encode("utf-8"))
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "build.1.log", "build.1.log.errors.json", "build.2.log", "build.2.log.errors.json", "build.log",
+        "build.log.errors.json"]
+    assert (tmp_path / "build.log").read_text() == "3"
+    assert (tmp_path / "build.2.log").read_text() == "1"
+
+
+def test_compression_error(tmp_path):
+    class FailingCompressor(object):
+        def compress(self, data: bytes) -> bytes:
+            raise OSError("compression failed")
+
+    writer = BuildLogWriter(tmp_path / "build.log", compression="xz")
+    writer._compressor = FailingCompressor()
+    writer.write(b"first\n")
+    # The writer must not block once the compression thread has failed (the queue only holds 64 entries)
+    with pytest.raises(OSError, match="compression failed"):
+        for _ in range(1000):
+            writer.write(b"line\n")
+    writer.close()  # The error has already been reported
+    assert writer._thread is not None and not writer._thread.is_alive()
+
+    writer = BuildLogWriter(tmp_path / "build2.log", compression="xz")
+    writer._compressor = FailingCompressor()
+    writer.write(b"only line\n")
+    with pytest.raises(OSError, match="compression failed"):
+        writer.close()
+    assert (tmp_path / "build2.log.errors.json").exists()
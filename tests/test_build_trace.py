@@ -0,0 +1,43 @@
+import json
+import subprocess
+import sys
+from collections import OrderedDict
+
+from pycheribuild.buildtrace import BuildTrace
+
+
+def _add_target(trace: BuildTrace, name: str, start: float, duration: float, **phases):
+    trace.add_event(dict(name=name, cat="target", ph="X", ts=int(start * 1000000), dur=int(duration * 1000000),
+                         pid=1, tid=1, args=dict(user_cpu_seconds=duration, system_cpu_seconds=0.0)))
+    for phase, phase_duration in phases.items():
+        trace.add_event(dict(name=phase, cat="phase", ph="X", ts=int(start * 1000000),
+                             dur=int(phase_duration * 1000000), pid=1, tid=1, args=dict(target=name)))
+
+
+def test_span_records_child_usage(tmp_path):
+    trace = BuildTrace()
+    with trace.span("compile", "phase", target="foo"):
+        subprocess.check_call([sys.executable, "-c", "sum(range(1000000))"])
+    event, = trace.events
+    assert event["name"] == "compile" and event["ph"] == "X" and event["args"]["target"] == "foo"
+    assert event["dur"] > 0
+    assert event["args"]["user_cpu_seconds"] + event["args"]["system_cpu_seconds"] > 0
+    trace.write(tmp_path / "trace.json")
+    written = json.loads((tmp_path / "trace.json").read_text())
+    assert written["traceEvents"][0]["ph"] == "M"
+    assert written["traceEvents"][1:] == trace.events
+
+
+def test_critical_path(capsys):
+    trace = BuildTrace()
+    _add_target(trace, "llvm", 0, 100, update=1, compile=90, install=9)
+    _add_target(trace, "qemu", 100, 50)
+    _add_target(trace, "cheribsd", 150, 30)
+    _add_target(trace, "disk-image", 180, 5)
+    deps = OrderedDict([("llvm", []), ("qemu", []), ("cheribsd", ["llvm"]), ("disk-image", ["qemu", "cheribsd"])])
+    assert trace.critical_path(deps) == ["llvm", "cheribsd", "disk-image"]
+    trace.print_summary(deps)
+    output = capsys.readouterr().out
+    assert "wall time 185.0s, critical path 135.0s" in output
+    assert "update 1.0s, compile 90.0s, install 9.0s" in output
+    assert "Critical path: llvm (100.0s) -> cheribsd (30.0s) -> disk-image (5.0s)" in output
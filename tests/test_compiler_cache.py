@@ -0,0 +1,62 @@
+from pathlib import Path
+
+from pycheribuild.compilercache import CompilerCache, CompilerCacheStats
+from .setup_mock_chericonfig import setup_mock_chericonfig
+
+
+def test_ccache_statistics(tmp_path, capsys):
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    cache = CompilerCache("ccache", Path("/usr/bin/ccache"), cache_dir=tmp_path / "cache", max_size="1G",
+                          base_dir=tmp_path, stats_dir=tmp_path / "stats", config=config)
+    for target, log in (("foo", "# /src/a.c\ndirect_cache_hit\nlocal_storage_hit\n# /src/b.c\ncache_miss\n"
+                                "local_storage_miss\n# \ncalled_for_link\n# /src/c.c\npreprocessed_cache_hit\n"),
+                        ("bar", "# /src/d.c\ncache_miss\n")):
+        assert cache.begin_target(target) is None
+        env = cache.env_vars(target)
+        assert env["CCACHE_DIR"] == str(tmp_path / "cache") and env["CCACHE_MAXSIZE"] == "1G"
+        Path(env["CCACHE_STATSLOG"]).write_text(log)
+        cache.end_target(target, None)
+    # Targets without any compilations are not included
+    cache.begin_target("baz")
+    cache.end_target("baz", None)
+    assert not cache.statistics_file("baz").exists()
+
+    cache.print_statistics(["foo", "bar", "baz"])
+    output = capsys.readouterr().out
+    assert str(CompilerCacheStats(2, 1, 1)) == "2 hits, 1 misses (66.7% hit rate), 1 uncacheable"
+    assert "foo " + str(CompilerCacheStats(2, 1, 1)) in output
+    assert "bar " + str(CompilerCacheStats(0, 1, 0)) in output
+    assert "total " + str(CompilerCacheStats(2, 2, 1)) in output
+    assert "baz" not in output
+
+    # Building a target again discards the old statistics
+    cache.begin_target("foo")
+    assert not cache.statistics_file("foo").exists()
+
+
+def test_sccache_server(tmp_path):
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    log = tmp_path / "sccache.log"
+    sccache = tmp_path / "sccache"
+    # The fake sccache fails to start the server if it is already running (like the real one)
+    sccache.write_text("#!/bin/sh\necho \"$1 $SCCACHE_DIR $SCCACHE_CACHE_SIZE $SCCACHE_SERVER_PORT\" >> \"{0}\"\n"
+                       "test $(wc -l < \"{0}\") -eq 1\n".format(log))
+    sccache.chmod(0o755)
+
+    def create_cache(cache_dir: Path, max_size: str) -> CompilerCache:
+        return CompilerCache("sccache", sccache, cache_dir=cache_dir, max_size=max_size, base_dir=tmp_path,
+                             stats_dir=tmp_path / "stats", config=config)
+
+    cache = create_cache(tmp_path / "cache", "1G")
+    # cheribuild uses its own server (never the default one on port 4226) for every cache directory and size
+    port = cache.sccache_server_port
+    assert 10000 <= port < 30000
+    assert cache.env_vars("foo")["SCCACHE_SERVER_PORT"] == str(port)
+    assert create_cache(tmp_path / "cache", "1G").sccache_server_port == port
+    assert create_cache(tmp_path / "cache", "2G").sccache_server_port != port
+    assert create_cache(tmp_path / "cache2", "1G").sccache_server_port != port
+    # Starting the server again (e.g. from another cheribuild process) must not fail or stop the running server
+    cache.start_server()
+    cache.start_server()
+    expected = "--start-server " + str(tmp_path / "cache") + " 1G " + str(port)
+    assert log.read_text().splitlines() == [expected, expected]
@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from pycheribuild.completionindex import _complete, CompletionIndex
+
+CHERIBUILD = Path(__file__).parent.parent / "cheribuild.py"
+INDEX = {
+    "targets": ["llvm-native", "cheribsd-riscv64-purecap", "qemu"],
+    "aliases": ["llvm"],
+    "options": [
+        [["--pretend", "-p"], 0, None, -1],
+        [["--llvm/build-type"], None, ["Debug", "Release"], -1],
+        [["--qemu/use-asan"], 0, None, 0],
+        [["--qemu/no-use-asan"], 0, None, 0],
+        [["-t"], 0, None, -1],
+        ],
+    "excludes": ["-t"],
+    }
+
+
+def test_complete():
+    assert _complete(INDEX, ["cheribuild.py"], "ll") == ["llvm", "llvm-native"]
+    assert _complete(INDEX, ["cheribuild.py", "-p"], "--p") == ["--pretend"]
+    assert _complete(INDEX, ["cheribuild.py"], "-") == [
+        "--pretend", "-p", "--llvm/build-type", "--qemu/use-asan", "--qemu/no-use-asan"]
+    # Only one of the mutually exclusive options can be given
+    assert _complete(INDEX, ["cheribuild.py", "--qemu/use-asan"], "--qemu/") == ["--qemu/use-asan"]
+    # Option values
+    assert _complete(INDEX, ["cheribuild.py", "--llvm/build-type"], "") == ["Debug", "Release"]
+    assert _complete(INDEX, ["cheribuild.py"], "--llvm/build-type=R") == ["--llvm/build-type=Release"]
+    assert _complete(INDEX, ["cheribuild.py", "--llvm/build-type", "Debug"], "q") == ["qemu"]
+    # Anything after -- is handled by the real parser
+    assert _complete(INDEX, ["cheribuild.py", "--"], "") is None
+
+
+def test_complete_from_index(tmp_path):
+    output = tmp_path / "completions"
+    comp_line = "cheribuild.py cheribsd-riscv64-pure"
+    env = dict(os.environ, HOME=str(tmp_path), XDG_CACHE_HOME=str(tmp_path / "cache"), _ARGCOMPLETE="1",
+               _ARGCOMPLETE_IFS="\n", _ARGCOMPLETE_STDOUT_FILENAME=str(output),
+               COMP_LINE=comp_line, COMP_POINT=str(len(comp_line)))
+    subprocess.check_call([sys.executable, str(CHERIBUILD)], env=env, cwd=str(tmp_path))
+    assert output.read_text() == "cheribsd-riscv64-purecap "
+    assert len(list((tmp_path / "cache/cheribuild").glob("completion-index-*.json"))) == 1
+
+
+def test_index_invalidation(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    source_dir = tmp_path / "pycheribuild"
+    source_dir.mkdir()
+    (source_dir / "foo.py").write_text("foo\n")
+    index = CompletionIndex(source_dir)
+    assert index.path.parent == tmp_path / "cache/cheribuild" and index.path.name.startswith("completion-index-")
+    assert index.load() is None
+    index._write(INDEX)
+    assert CompletionIndex(source_dir).load()["targets"] == INDEX["targets"]
+    # The index is keyed on the size and modification time of the source files
+    (source_dir / "foo.py").write_text("foo\nbar\n")
+    assert CompletionIndex(source_dir).load() is None
+    CompletionIndex(source_dir)._write(INDEX)
+    assert CompletionIndex(source_dir).load() is not None
+    (source_dir / "bar.py").write_text("")
+    assert CompletionIndex(source_dir).load() is None
@@ -0,0 +1,30 @@
+import os
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+# noinspection PyProtectedMember
+from pycheribuild.projects.disk_image import _scan_directory_tree  # noqa: E402
+
+
+def test_scan_directory_tree(tmp_path):
+    root = tmp_path / "rootfs"
+    for path in ("bin/sh", "etc/rc.conf", "usr/lib/libc.so.7", "usr/share/misc/termcap", "COPYRIGHT"):
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_text(path)
+    os.symlink("libc.so.7", str(root / "usr/lib/libc.so"))
+    # Like os.walk(), symlinks to directories are neither followed nor included
+    os.symlink("usr/lib", str(root / "lib"))
+    (root / "var/empty").mkdir(parents=True)
+    result = _scan_directory_tree(str(root))
+    assert [relpath for relpath, _ in result] == ["COPYRIGHT", "bin/sh", "etc/rc.conf", "usr/lib/libc.so",
+                                                  "usr/lib/libc.so.7", "usr/share/misc/termcap"]
+    assert all(entry.path == str(root / relpath) for relpath, entry in result)
+    assert [relpath for relpath, entry in result if entry.is_symlink()] == ["usr/lib/libc.so"]
+
+
+def test_scan_missing_directory_tree(tmp_path):
+    # A missing (or unreadable) root is ignored just like by os.walk()
+    assert _scan_directory_tree(str(tmp_path / "does-not-exist")) == []
+    (tmp_path / "file").write_text("")
+    assert _scan_directory_tree(str(tmp_path / "file")) == []
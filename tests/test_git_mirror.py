@@ -0,0 +1,62 @@
+import subprocess
+from pathlib import Path
+
+from pycheribuild.gitmirror import git_mirror_path, update_git_mirror
+from pycheribuild.processutils import run_command
+from pycheribuild.projects.project import GitRepository
+from .setup_mock_chericonfig import setup_mock_chericonfig
+
+
+class _FakeProject(object):
+    """The subset of Project that is used by GitRepository.ensure_cloned()"""
+    needs_full_history = False
+
+    def __init__(self, config):
+        self.config = config
+
+    def run_cmd(self, *args, **kwargs):
+        return run_command(*args, config=self.config, **kwargs)
+
+
+def _git(*args, cwd: Path) -> str:
+    return subprocess.check_output(["git", "-c", "user.name=test", "-c", "user.email=test@example.com"] + list(args),
+                                   cwd=str(cwd)).decode("utf-8").strip()
+
+
+def test_git_mirror(tmp_path, capsys):
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    origin = tmp_path / "origin"
+    origin.mkdir()
+    _git("init", "-q", cwd=origin)
+    (origin / "file.txt").write_text("hello")
+    _git("add", "file.txt", cwd=origin)
+    _git("commit", "-q", "-m", "initial", cwd=origin)
+    url = str(origin)
+
+    mirror_dir = tmp_path / "mirrors"
+    mirror = update_git_mirror(mirror_dir, url, config=config)
+    assert mirror == git_mirror_path(mirror_dir, url)
+    assert mirror.name.startswith("origin-") and mirror.name.endswith(".git")
+    assert _git("rev-parse", "HEAD", cwd=mirror) == _git("rev-parse", "HEAD", cwd=origin)
+
+    # The mirror is only fetched once per run
+    _git("commit", "-q", "--allow-empty", "-m", "second", cwd=origin)
+    update_git_mirror(mirror_dir, url, config=config)
+    assert _git("rev-parse", "HEAD", cwd=mirror) != _git("rev-parse", "HEAD", cwd=origin)
+
+    # Clones use the objects from the mirror (and only reference it if --git-mirror-dissociate is not set)
+    config.skip_clone = False
+    config.git_mirror_dir = mirror_dir
+    config.git_mirror_dissociate = True
+    clone = tmp_path / "clone"
+    GitRepository(url).ensure_cloned(_FakeProject(config), src_dir=clone, base_project_source_dir=clone)
+    assert "--reference " + str(mirror) + " --dissociate" in capsys.readouterr().out
+    assert (clone / "file.txt").read_text() == "hello"
+    assert not (clone / ".git/objects/info/alternates").exists()
+    assert _git("rev-parse", "HEAD", cwd=clone) == _git("rev-parse", "HEAD", cwd=origin)
+
+    config.git_mirror_dissociate = False
+    clone = tmp_path / "clone-referencing-mirror"
+    GitRepository(url).ensure_cloned(_FakeProject(config), src_dir=clone, base_project_source_dir=clone)
+    alternates = (clone / ".git/objects/info/alternates").read_text().strip()
+    assert Path(alternates).resolve() == (mirror / "objects").resolve()
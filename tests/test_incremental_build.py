@@ -0,0 +1,91 @@
+import subprocess
+from pathlib import Path
+
+from pycheribuild.incrementalbuild import freebsd_rebuild_plan, FreeBSDRebuildPlan, IncrementalBuildState
+from .setup_mock_chericonfig import setup_mock_chericonfig
+
+
+def _git(*args, cwd: Path) -> str:
+    return subprocess.check_output(["git", "-c", "user.name=test", "-c", "user.email=test@example.com"] + list(args),
+                                   cwd=str(cwd)).decode("utf-8").strip()
+
+
+def _write(root: Path, path: str, contents: str):
+    (root / path).parent.mkdir(parents=True, exist_ok=True)
+    (root / path).write_text(contents)
+
+
+def _create_source_tree(root: Path):
+    root.mkdir()
+    _git("init", "-q", cwd=root)
+    _write(root, "Makefile", "SUBDIR=lib bin\n")
+    _write(root, "README.md", "readme\n")
+    _write(root, "include/stdio.h", "\n")
+    _write(root, "lib/libfoo/Makefile", "LIB=\tfoo\nSRCS=foo.c\n")
+    _write(root, "lib/libfoo/foo.c", "\n")
+    _write(root, "lib/libbar/Makefile", "LIB=bar\nLIBADD=\tfoo\n")
+    _write(root, "lib/libbar/bar.c", "\n")
+    _write(root, "bin/prog/Makefile", "PROG=prog\nLIBADD+=\tbar \\\n\tutil\n")
+    _write(root, "bin/prog/prog.c", "\n")
+    _write(root, "bin/other/Makefile", "PROG=other\nLIBADD=m\n")
+    _write(root, "bin/other/other.c", "\n")
+    _write(root, "usr.bin/baz/Makefile", ".PATH: ${SRCTOP}/contrib/baz\nPROG=baz\n")
+    _write(root, "contrib/baz/baz.c", "\n")
+    _write(root, "sys/kern/kern_foo.c", "\n")
+    _write(root, "sys/sys/param.h", "\n")
+    _git("add", ".", cwd=root)
+    _git("commit", "-q", "-m", "initial", cwd=root)
+
+
+def test_freebsd_rebuild_plan(tmp_path):
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    src = tmp_path / "src"
+    _create_source_tree(src)
+
+    def plan(*files):
+        return freebsd_rebuild_plan(src, list(files), config=config)
+
+    assert plan() == FreeBSDRebuildPlan([], False)
+    assert plan("README.md") == FreeBSDRebuildPlan([], False)
+    assert plan("bin/other/other.c") == FreeBSDRebuildPlan(["bin/other"], False)
+    assert plan("sys/kern/kern_foo.c", "bin/other/other.c") == FreeBSDRebuildPlan(["bin/other"], True)
+    assert plan("contrib/baz/baz.c") == FreeBSDRebuildPlan(["usr.bin/baz"], False)
+    # Libraries are built first (in LIBADD dependency order) and all (transitive) consumers are rebuilt
+    assert plan("lib/libfoo/foo.c") == FreeBSDRebuildPlan(["lib/libfoo", "lib/libbar", "bin/prog"], False)
+    assert plan("lib/libbar/bar.c", "lib/libfoo/foo.c") == FreeBSDRebuildPlan(
+        ["lib/libfoo", "lib/libbar", "bin/prog"], False)
+    # Headers and the build system require a full rebuild
+    assert plan("include/stdio.h") is None
+    assert plan("sys/sys/param.h") is None
+    # Headers outside sys/sys are also installed for userspace
+    assert plan("sys/net/if.h") is None
+    assert plan("sys/dev/foo/foo.h") is None
+    assert plan("sys/riscv/include/param.h") is None
+    assert plan("sys/kern/kern_foo.c") == FreeBSDRebuildPlan([], True)
+    assert plan("Makefile") is None
+    assert plan("bin/new/new.c") is None
+    assert freebsd_rebuild_plan(src, ["lib/libfoo/foo.c"], config=config, max_subdirs=2) is None
+
+
+def test_incremental_build_state(tmp_path):
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    src = tmp_path / "src"
+    _create_source_tree(src)
+    state = IncrementalBuildState(tmp_path / "build/state.json", src, config=config)
+    assert state.changed_files("-j4") is None
+    # A build started with a local modification
+    _write(src, "bin/prog/prog.c", "modified\n")
+    state.save(state.snapshot("-j4"))
+    assert state.changed_files("-j4") == []
+    assert state.changed_files("-j8") is None  # different options -> full rebuild
+    # Committed changes, new files and edits/reverts of previously modified files are detected
+    _write(src, "bin/other/other.c", "changed\n")
+    _git("commit", "-q", "-m", "second", "bin/other/other.c", cwd=src)
+    _write(src, "bin/other/new.c", "\n")
+    assert state.changed_files("-j4") == ["bin/other/new.c", "bin/other/other.c"]
+    _git("checkout", "-q", "bin/prog/prog.c", cwd=src)
+    assert state.changed_files("-j4") == ["bin/other/new.c", "bin/other/other.c", "bin/prog/prog.c"]
+    state.save(state.snapshot("-j4"))
+    assert state.changed_files("-j4") == []
+    state.invalidate()
+    assert state.changed_files("-j4") is None
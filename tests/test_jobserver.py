@@ -0,0 +1,71 @@
+import os
+
+import pycheribuild.jobserver
+import pycheribuild.projects.project
+from pycheribuild.jobserver import JobServer
+from pycheribuild.projects.project import MakeCommandKind, MakeOptions
+
+
+def _acquire_all_tokens(jobserver: JobServer) -> bytes:
+    os.set_blocking(jobserver.read_fd, False)
+    try:
+        return os.read(jobserver.read_fd, 1024)
+    except BlockingIOError:
+        return b""
+    finally:
+        os.set_blocking(jobserver.read_fd, True)
+
+
+def test_token_accounting():
+    jobserver = JobServer(4)
+    try:
+        # Every client has one implicit job slot -> only 3 tokens for 4 jobs
+        assert _acquire_all_tokens(jobserver) == b"+++"
+        assert _acquire_all_tokens(jobserver) == b""
+        # Returned tokens can be acquired by other clients (opening the FIFO by name shares the same pipe)
+        os.write(jobserver.write_fd, b"++")
+        with open(str(jobserver.fifo_path), "rb", buffering=0) as fifo:
+            assert fifo.read(1) == b"+"
+        assert _acquire_all_tokens(jobserver) == b"+"
+    finally:
+        jobserver.close()
+    assert not jobserver.fifo_path.exists()
+    # A single job does not need any tokens
+    jobserver = JobServer(1)
+    try:
+        assert _acquire_all_tokens(jobserver) == b""
+    finally:
+        jobserver.close()
+    # Every concurrently built target has its own implicit job slot
+    jobserver = JobServer(4, num_clients=3)
+    try:
+        assert _acquire_all_tokens(jobserver) == b"+"
+    finally:
+        jobserver.close()
+    jobserver = JobServer(2, num_clients=3)
+    try:
+        assert _acquire_all_tokens(jobserver) == b""
+    finally:
+        jobserver.close()
+
+
+def test_jobserver_env(monkeypatch):
+    jobserver = JobServer(8)
+    try:
+        monkeypatch.setattr(pycheribuild.projects.project, "get_jobserver", lambda: jobserver)
+        versions = {"make": (4, 3), "gmake": (4, 4), "ninja": (1, 11), "ninja-new": (1, 13)}
+        monkeypatch.setattr(pycheribuild.jobserver, "_get_tool_version", lambda cmd: versions[cmd])
+        fds = str(jobserver.read_fd) + "," + str(jobserver.write_fd)
+        fifo = "fifo:" + str(jobserver.fifo_path)
+        assert MakeOptions(MakeCommandKind.GnuMake, None).jobserver_env("make") == {
+            "MAKEFLAGS": "-j8 --jobserver-auth=" + fds}
+        assert MakeOptions(MakeCommandKind.GnuMake, None).jobserver_env("gmake") == {
+            "MAKEFLAGS": "-j8 --jobserver-auth=" + fifo}
+        assert MakeOptions(MakeCommandKind.Ninja, None).jobserver_env("ninja") is None
+        assert MakeOptions(MakeCommandKind.Ninja, None).jobserver_env("ninja-new") == {
+            "MAKEFLAGS": "-j8 --jobserver-auth=" + fifo}
+        # bmake is not a jobserver client and uses a -j flag instead
+        assert MakeOptions(MakeCommandKind.BsdMake, None).jobserver_env("bmake") is None
+        assert MakeOptions(MakeCommandKind.CustomMakeTool, None).jobserver_env("foo") is None
+    finally:
+        jobserver.close()
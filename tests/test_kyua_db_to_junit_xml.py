@@ -0,0 +1,75 @@
+import sqlite3
+import sys
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "test-scripts"))
+import kyua_db_to_junit_xml  # noqa: E402
+from kyua_db_to_junit_xml import convert_kyua_db_to_junit_xml, fixup_kyua_generated_junit_xml  # noqa: E402
+
+
+def _create_kyua_db(path: Path) -> Path:
+    db = sqlite3.connect(str(path))
+    try:
+        db.executescript((Path(__file__).parent / "kyua_results_v3.sql").read_text(encoding="utf-8"))
+        db.commit()
+    finally:
+        db.close()
+    return path
+
+
+def test_convert_kyua_db(tmp_path):
+    db = _create_kyua_db(tmp_path / "results.db")
+    output = tmp_path / "results.xml"
+    convert_kyua_db_to_junit_xml(db, output, prefix="cheribsd-test")
+    suite = ET.parse(str(output)).getroot()
+    assert suite.tag == "testsuite"
+    assert suite.attrib == {"name": "cheribsd-test", "tests": "5", "failures": "1", "errors": "1", "skipped": "1",
+                            "time": "302.750"}
+    properties = {p.get("name"): p.get("value") for p in suite.find("properties")}
+    assert properties == {"cwd": "/usr/tests", "env.HOME": "/root", "env.PATH": "/sbin:/bin:/usr/sbin:/usr/bin"}
+    cases = {(c.get("classname"), c.get("name")): c for c in suite.iter("testcase")}
+    assert list(cases) == [("bin.sh.builtins_test", "cd"), ("bin.sh.builtins_test", "echo"),
+                           ("lib.libc.string_test", "memcpy"), ("lib.libc.string_test", "strcpy"),
+                           ("lib.libc.string_test", "strlen")]
+    echo = cases[("bin.sh.builtins_test", "echo")]
+    assert echo.get("time") == "0.500" and len(echo) == 2
+    assert echo.find("system-out").text == "hello world\n"
+    assert "description = Checks <foo> & \"bar\"\ntimeout = 300" in echo.find("system-err").text
+    cd = cases[("bin.sh.builtins_test", "cd")]
+    assert cd.find("failure").get("message") == "cd returned 1 < 0"
+    # Control characters can't be included in XML 1.0 and are escaped instead
+    assert "control\\x01;character" in cd.find("system-err").text
+    assert cases[("lib.libc.string_test", "strlen")].find("error").get("message") == "Test case timed out"
+    assert cases[("lib.libc.string_test", "strcpy")].find("skipped") is not None
+    memcpy = cases[("lib.libc.string_test", "memcpy")]
+    assert memcpy.find("failure") is None and memcpy.find("error") is None
+    assert "Expected failure result details\n-------------------------------\n\nKnown bug" in \
+        memcpy.find("system-err").text
+    # Without a prefix the testsuite has no name
+    convert_kyua_db_to_junit_xml(db, output)
+    assert "name" not in ET.parse(str(output)).getroot().attrib
+
+
+def test_convert_kyua_db_in_parallel(tmp_path, monkeypatch):
+    db = _create_kyua_db(tmp_path / "results.db")
+    convert_kyua_db_to_junit_xml(db, tmp_path / "serial.xml", prefix="test")
+    monkeypatch.setattr(kyua_db_to_junit_xml, "_PROGRAMS_PER_CHUNK", 1)
+    convert_kyua_db_to_junit_xml(db, tmp_path / "parallel.xml", prefix="test", jobs=2)
+    assert (tmp_path / "parallel.xml").read_text() == (tmp_path / "serial.xml").read_text()
+
+
+def test_fixup_prefix(tmp_path):
+    xml_file = tmp_path / "results.xml"
+    xml_file.write_text('<?xml version="1.0" encoding="utf-8"?>\n<testsuites>'
+                        '<testsuite name="libc"><testcase classname="a" name="b"><failure/></testcase></testsuite>'
+                        '<testsuite><testcase classname="c" name="d"/></testsuite></testsuites>\n')
+    fixup_kyua_generated_junit_xml(xml_file, prefix="cheribsd")
+    root = ET.parse(str(xml_file)).getroot()
+    assert [s.get("name") for s in root.iter("testsuite")] == ["cheribsd-libc", "cheribsd"]
+    assert root.find("testsuite").get("failures") == "1"
+    # A single testsuite (as written by convert_kyua_db_to_junit_xml() without a prefix)
+    xml_file.write_text('<?xml version="1.0" encoding="utf-8"?>\n<testsuite><testcase classname="a" name="b"/>'
+                        '</testsuite>\n')
+    fixup_kyua_generated_junit_xml(xml_file, prefix="cheribsd")
+    assert ET.parse(str(xml_file)).getroot().get("name") == "cheribsd"
@@ -3,6 +3,7 @@ import pytest
 import sys
 import io
 import tempfile
+import tracemalloc
 
 try:
     import typing
@@ -11,7 +12,7 @@ except ImportError:
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).parent.parent))
-from pycheribuild.mtree import MtreeFile  # noqa: E402
+from pycheribuild.mtree import MtreeEntry, MtreeFile  # noqa: E402
 
 HAVE_LCHMOD = True
 if "_TEST_SKIP_METALOG" in os.environ:
@@ -269,3 +270,79 @@ def test_symlink_infer_mode(temp_symlink):
 # END
 """.format(target=temp_symlink[2], testfile=str(temp_symlink[1]), symlink_perms=symlink_perms)
     assert expected == _get_as_str(mtree)
+
+
+def test_set_and_unset():
+    file = """#mtree 2.0
+/set type=file uname=root gname=wheel mode=0644
+. type=dir mode=0755
+./bin type=dir mode=0755
+./bin/sh mode=0555 contents=./bin/sh
+/unset mode
+/set uname=www
+./var/www contents=./index.html
+# END
+"""
+    mtree = MtreeFile(io.StringIO(file))
+    assert """#mtree 2.0
+. type=dir uname=root gname=wheel mode=0755
+./bin type=dir uname=root gname=wheel mode=0755
+./bin/sh type=file uname=root gname=wheel mode=0555 contents=./bin/sh
+./var/www type=file uname=www gname=wheel contents=./index.html
+# END
+""" == _get_as_str(mtree)
+    assert mtree._mtree["./bin"].is_dir() and mtree._mtree["./bin/sh"].is_file()
+
+
+def _write_large_metalog(path: Path, num_files: int):
+    with path.open("w") as f:
+        f.write("#mtree 2.0\n/set uname=root gname=wheel\n")
+        for i in range(num_files):
+            if i % 100 == 0:
+                f.write("./usr/lib/dir{} type=dir mode=0755 tags=package=runtime\n".format(i // 100))
+            f.write("./usr/lib/dir{}/file{} type=file mode=0644 size={} tags=package=runtime time={}.5\n".format(
+                i // 100, i, i % 4096, 1600000000 + i))
+
+
+def test_parse_large_metalog(tmp_path):
+    # A full CheriBSD METALOG has more than 100k entries, so check that parsing them is compact.
+    # The parsing speed is measured by tests/benchmark_metalog.py instead.
+    metalog = tmp_path / "METALOG"
+    _write_large_metalog(metalog, 200000)
+    mtree = MtreeFile(metalog)
+    assert len(mtree._mtree) == 202000
+    assert str(mtree._mtree["./usr/lib/dir3/file300"]) == \
+        "./usr/lib/dir3/file300 uname=root gname=wheel type=file mode=0644 size=300"
+    del mtree
+    # tracemalloc slows down parsing a lot, so only measure the memory usage for a smaller file (this used to be
+    # around 950 bytes per entry and is now less than 500).
+    _write_large_metalog(metalog, 20000)
+    tracemalloc.start()
+    try:
+        mtree = MtreeFile(metalog)
+        memory_per_entry = tracemalloc.get_traced_memory()[0] / len(mtree._mtree)
+    finally:
+        tracemalloc.stop()
+    assert memory_per_entry < 600, "Parsing the METALOG used " + str(memory_per_entry) + " bytes per entry"
+
+
+def test_keyword_cache_skips_ignored_keywords():
+    keyword_cache = dict()
+    for i in range(100):
+        attrs = MtreeEntry._parse_keywords(["type=file", "time={}.0".format(i), "size=" + str(i)], None,
+                                           keyword_cache)
+        assert attrs == [("type", "file"), ("size", str(i))]
+    # The time= values are not cached (every entry has a different one)
+    assert "type=file" in keyword_cache
+    assert not any(k.startswith("time=") for k in keyword_cache)
+
+
+def test_mtree_path_normalization():
+    assert MtreeFile._ensure_mtree_path_fmt(".") == "."
+    assert MtreeFile._ensure_mtree_path_fmt("usr/bin/cc") == "./usr/bin/cc"
+    assert MtreeFile._ensure_mtree_path_fmt("./usr//lib/./libc.so") == "./usr/lib/libc.so"
+    assert MtreeFile._ensure_mtree_path_fmt("usr/lib/../bin/cc") == "./usr/bin/cc"
+    assert MtreeFile._ensure_mtree_path_fmt(".ssh/authorized_keys") == "./.ssh/authorized_keys"
+    mtree = MtreeFile()
+    mtree.add_dir("usr//share/", print_status=False)
+    assert "./usr/share" in mtree._mtree and "./usr" in mtree._mtree
@@ -0,0 +1,54 @@
+from pycheribuild.ninjalog import NinjaBuildSummary, parse_ninja_log, update_ninja_build_history
+
+FIRST_BUILD = """# ninja log v5
+0\t1500\t0\tlib/Support/CMakeFiles/LLVMSupport.dir/APInt.cpp.o\taaaa
+10\t2000\t0\tlib/Support/CMakeFiles/LLVMSupport.dir/APFloat.cpp.o\tbbbb
+2000\t2600\t0\tlib/libLLVMSupport.a\tcccc
+2600\t5600\t0\tbin/llc\tdddd
+2600\t5600\t0\tbin/llc.debug\tdddd
+"""
+# A second (incremental) ninja invocation appends entries with times relative to its own start
+SECOND_BUILD = """5\t400\t0\tlib/Support/CMakeFiles/LLVMSupport.dir/APInt.cpp.o\teeee
+400\t900\t0\tlib/libLLVMSupport.a\tffff
+0\t100\t0\tinclude/config.h\tgggg
+"""
+
+
+def test_parse_ninja_log(tmp_path):
+    log = tmp_path / ".ninja_log"
+    log.write_text(FIRST_BUILD)
+    edges = parse_ninja_log(log)
+    assert len(edges) == 4
+    assert edges[-1].outputs == ["bin/llc", "bin/llc.debug"]
+    summary = NinjaBuildSummary(edges)
+    assert summary.num_edges == 4
+    assert summary.serial_seconds == 1.5 + 1.99 + 0.6 + 3.0
+    assert summary.wall_seconds == 5.6
+    assert summary.link_seconds == 3.6
+    assert summary.slowest_edges(2) == [("bin/llc", 3.0),
+                                        ("lib/Support/CMakeFiles/LLVMSupport.dir/APFloat.cpp.o", 1.99)]
+    # Object files are grouped by CMake target, other outputs by directory
+    assert [(name, num_edges) for name, _, num_edges in summary.slowest_groups(3)] == [
+        ("LLVMSupport", 2), ("bin", 1), ("lib", 1)]
+
+    # Only the entries appended after offset are returned (two separate ninja invocations in this case)
+    offset = log.stat().st_size
+    with log.open("a") as f:
+        f.write(SECOND_BUILD)
+    edges = parse_ninja_log(log, offset)
+    assert [e.command_hash for e in edges] == ["eeee", "ffff", "gggg"]
+    assert NinjaBuildSummary(edges).wall_seconds == 0.895 + 0.1
+    # If ninja recompacted the log only the last invocation is used
+    log.write_text("# ninja log v5\n" + SECOND_BUILD)
+    assert [e.command_hash for e in parse_ninja_log(log, offset)] == ["gggg"]
+
+
+def test_ninja_build_history(tmp_path):
+    history = tmp_path / "llvm-native.ninja-history.jsonl"
+    assert update_ninja_build_history(history, dict(edges=1000, serial_seconds=100.0)) is None
+    assert update_ninja_build_history(history, dict(edges=3, serial_seconds=1.0)) is None
+    # Only builds of a similar size are compared
+    assert update_ninja_build_history(history, dict(edges=990, serial_seconds=120.0))["serial_seconds"] == 100.0
+    for i in range(5):
+        update_ninja_build_history(history, dict(edges=i, serial_seconds=0.0), max_entries=3)
+    assert len(history.read_text().splitlines()) == 3
@@ -0,0 +1,86 @@
+import os
+from pathlib import Path
+
+import pycheribuild.processutils
+from pycheribuild.processutils import _ProbeCache, get_version_output
+from .setup_mock_chericonfig import setup_mock_chericonfig
+
+
+def _write_program(path: Path, version: str):
+    # Every invocation appends a line to the log file so that we can check whether the probe was run again
+    path.write_text("#!/bin/sh\necho run >> \"{}.log\"\necho \"$@\" {}\n".format(path, version))
+    path.chmod(0o755)
+
+
+def _num_runs(path: Path) -> int:
+    log = Path(str(path) + ".log")
+    return len(log.read_text().splitlines()) if log.exists() else 0
+
+
+def test_probe_cache_invalidation(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    program = tmp_path / "prog"
+    _write_program(program, "1.0")
+    cache = _ProbeCache()
+    assert cache.path == tmp_path / "cache/cheribuild/probe-cache.json"
+    assert cache.get(program, "foo") is None
+    cache.set(program, "foo", {"bar": [1, 2]})
+    # Binaries that don't exist are never cached
+    cache.set(tmp_path / "missing", "foo", "bar")
+    assert cache.get(tmp_path / "missing", "foo") is None
+    cache.save()
+    assert cache.path.exists()
+    # Another cheribuild invocation reads the value from the file (also when called via a symlink)
+    (tmp_path / "link").symlink_to(program)
+    assert _ProbeCache().get(tmp_path / "link", "foo") == {"bar": [1, 2]}
+    # Changing the modification time invalidates the entry
+    stat = program.stat()
+    os.utime(str(program), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert _ProbeCache().get(program, "foo") is None
+    cache = _ProbeCache()
+    cache.set(program, "foo", "new")
+    cache.save()
+    assert _ProbeCache().get(program, "foo") == "new"
+    # As does changing the size with the same modification time
+    stat = program.stat()
+    _write_program(program, "1.0.1")
+    os.utime(str(program), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert _ProbeCache().get(program, "foo") is None
+    # Corrupt or outdated cache files are ignored
+    cache.path.write_text("{")
+    assert _ProbeCache().get(program, "foo") is None
+    cache.path.write_text('{"version": 0, "entries": {}}')
+    assert _ProbeCache().get(program, "foo") is None
+
+
+def test_version_output_round_trip(tmp_path, monkeypatch):
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(pycheribuild.processutils, "_probe_cache", _ProbeCache())
+    program = tmp_path / "prog"
+    _write_program(program, "version 1.2.3\xe9")
+
+    def version_output(*args):
+        get_version_output.cache_clear()  # bypass the in-process lru_cache
+        return get_version_output(program, command_args=args or None, config=config)
+
+    # The test mode bypasses the persistent cache
+    assert config.TEST_MODE
+    assert version_output() == "--version version 1.2.3\xe9\n".encode("utf-8")
+    assert version_output() == "--version version 1.2.3\xe9\n".encode("utf-8")
+    assert _num_runs(program) == 2
+    assert pycheribuild.processutils._probe_cache.get(program, "version_output") is None
+
+    monkeypatch.setattr(config, "TEST_MODE", False)
+    assert version_output() == "--version version 1.2.3\xe9\n".encode("utf-8")
+    assert version_output("-v") == "-v version 1.2.3\xe9\n".encode("utf-8")
+    assert _num_runs(program) == 4
+    pycheribuild.processutils._probe_cache.save()
+    # A new invocation returns the same bytes without running the program again
+    monkeypatch.setattr(pycheribuild.processutils, "_probe_cache", _ProbeCache())
+    assert version_output() == "--version version 1.2.3\xe9\n".encode("utf-8")
+    assert version_output("-v") == "-v version 1.2.3\xe9\n".encode("utf-8")
+    assert _num_runs(program) == 4
+    assert version_output("-V") == "-V version 1.2.3\xe9\n".encode("utf-8")
+    assert _num_runs(program) == 5
+    get_version_output.cache_clear()
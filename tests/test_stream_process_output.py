@@ -0,0 +1,30 @@
+import io
+import subprocess
+
+from pycheribuild.processutils import stream_process_output
+
+
+def _run(script: str, **kwargs):
+    proc = subprocess.Popen(["sh", "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    logfile = io.BytesIO()
+    stdout_lines = []
+    stderr_lines = []
+    stream_process_output(proc.stdout, proc.stderr, logfile, stdout_callback=stdout_lines.append,
+                          stderr_callback=stderr_lines.append, **kwargs)
+    assert proc.wait() == 0
+    return logfile.getvalue(), stdout_lines, stderr_lines
+
+
+def test_all_lines_logged():
+    log, stdout_lines, stderr_lines = _run("echo a; echo b >&2; printf 'c\\nno-newline'")
+    assert sorted(log.splitlines()) == [b"a", b"b", b"c", b"no-newline"]
+    assert stdout_lines == [b"a\n", b"c\n", b"no-newline\n"]
+    assert stderr_lines == [b"b\n"]
+
+
+def test_latest_line_only():
+    log, stdout_lines, _ = _run("seq 1 10000", latest_stdout_line_only=True, update_interval=60)
+    assert log == b"".join(str(i).encode("utf-8") + b"\n" for i in range(1, 10001))
+    # The first and final line must always be shown, but not all of the lines in between
+    assert 2 <= len(stdout_lines) < 100
+    assert stdout_lines[-1] == b"10000\n"
@@ -0,0 +1,100 @@
+import os
+import subprocess
+import typing
+from pathlib import Path
+
+import pytest
+
+from pycheribuild.config.compilation_targets import CompilationTargets
+from pycheribuild.projects.project import DefaultInstallDir, ExternallyManagedSourceRepository, Project
+from .setup_mock_chericonfig import setup_mock_chericonfig, MockConfig
+
+
+# noinspection PyTypeChecker
+class MockProject(Project):
+    do_not_add_to_targets = True
+    project_name = "FAKE"
+    target = "FAKE"
+    _xtarget = CompilationTargets.NATIVE
+    _should_not_be_instantiated = False
+    default_install_dir = DefaultInstallDir.CUSTOM_INSTALL_DIR
+    repository = ExternallyManagedSourceRepository()
+
+    def __init__(self, config: MockConfig):
+        self._initial_source_dir = config.source_root / "sources/fake"
+        self._install_dir = config.source_root / "install/fake"
+        self.build_dir = config.source_root / "build/fake-build"
+        super().__init__(config)
+
+
+def _create_fake_strip(path: Path, log: Path):
+    # Logs its arguments (one line per invocation), replaces the contents of every file with a 4-byte ELF header and
+    # fails if one of the files is called "fail".
+    path.write_text("#!/bin/sh\n"
+                    "echo \"$@\" >> \"" + str(log) + "\"\n"
+                    "for f in \"$@\"; do\n"
+                    "  case \"$f\" in */fail) exit 1;; esac\n"
+                    "  printf '\\177ELF' > \"$f\"\n"
+                    "done\n")
+    path.chmod(0o755)
+
+
+def _write(path: Path, contents: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(contents)
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch) -> MockProject:
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    MockProject.setup_config_options()
+    project = MockProject(config)
+    strip = tmp_path / "fake-strip"
+    _create_fake_strip(strip, tmp_path / "strip.log")
+    monkeypatch.setattr(type(project.target_info), "strip_tool", property(lambda self: strip))
+    return project
+
+
+def _invocations(tmp_path: Path) -> "typing.List[typing.List[str]]":
+    log = tmp_path / "strip.log"
+    return [line.split() for line in log.read_text().splitlines()] if log.exists() else []
+
+
+def test_strip_elf_files_batched(tmp_path, project):
+    root = tmp_path / "root"
+    elf_files = []
+    for i in range(600):
+        elf_files.append(root / "bin" / ("prog" + str(i)))
+        _write(elf_files[-1], b"\x7fELF" + b"x" * i)
+    _write(root / "lib/crt1.o", b"\x7fELF object file")
+    _write(root / "share/script.sh", b"#!/bin/sh\n")
+    os.symlink("prog1", str(root / "bin/prog-link"))
+    (root / "emptydir").mkdir()
+    others = [root / "lib/crt1.o", root / "share/script.sh", root / "bin/prog-link", root / "emptydir"]
+
+    saved = project.strip_elf_files_batched(others + elf_files)
+    # Every ELF file was shrunk to the 4-byte header
+    assert saved == sum(range(600))
+    assert all(f.read_bytes() == b"\x7fELF" for f in elf_files)
+    invocations = _invocations(tmp_path)
+    # Two threads (--make-jobs=2), but at most 256 files per strip process
+    assert sorted(len(args) for args in invocations) == [88, 256, 256]
+    assert sorted(arg for args in invocations for arg in args) == sorted(str(f) for f in elf_files)
+    # Symlinks, non-ELF files, directories and object files are not stripped
+    assert (root / "lib/crt1.o").read_bytes() == b"\x7fELF object file"
+    assert (root / "share/script.sh").read_bytes() == b"#!/bin/sh\n"
+    assert os.readlink(str(root / "bin/prog-link")) == "prog1"
+
+
+def test_strip_elf_files_batched_no_candidates(tmp_path, project):
+    _write(tmp_path / "root/foo.o", b"\x7fELF")
+    assert project.strip_elf_files_batched([tmp_path / "root/foo.o", tmp_path / "root/missing"]) == 0
+    assert _invocations(tmp_path) == []
+
+
+def test_strip_elf_files_batched_failure(tmp_path, project):
+    files = [tmp_path / "root/ok", tmp_path / "root/fail"]
+    for f in files:
+        _write(f, b"\x7fELF12345")
+    with pytest.raises(subprocess.CalledProcessError):
+        project.strip_elf_files_batched(files)
@@ -0,0 +1,38 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+CHERIBUILD = Path(__file__).parent.parent / "cheribuild.py"
+
+
+def _run_cheribuild(tmp_path: Path, *args: str) -> str:
+    env = dict(os.environ, HOME=str(tmp_path), XDG_CACHE_HOME=str(tmp_path / "cache"))
+    return subprocess.check_output([sys.executable, str(CHERIBUILD), "--skip-update"] + list(args), env=env,
+                                   stderr=subprocess.DEVNULL, cwd=str(tmp_path)).decode("utf-8")
+
+
+def test_target_index(tmp_path):
+    # The first run imports all project modules and writes the index, the second one only reads the index
+    full_output = _run_cheribuild(tmp_path, "--list-targets")
+    index_files = list((tmp_path / "cache/cheribuild").glob("target-index-*.json"))
+    assert len(index_files) == 1
+    assert _run_cheribuild(tmp_path, "--list-targets") == full_output
+    assert "\n  cheribsd-riscv64-purecap\n" in full_output
+    targets = json.loads(index_files[0].read_text())["targets"]
+    assert ["cheribsd-riscv64-purecap", "target", "pycheribuild.projects.cross.cheribsd"] in targets
+    assert ["binutils", "alias", "pycheribuild.projects.sdk"] in targets
+    assert [entry[1] for entry in targets if entry[0] == "cheribsd-purecap"] == ["deprecated"]
+
+
+def test_lazily_loaded_options(tmp_path):
+    _run_cheribuild(tmp_path, "--list-targets")
+    # Options for targets that have not been loaded yet are registered when they are used on the command line or in
+    # the config file (including the fallback option for the MultiArchTargetAlias).
+    assert _run_cheribuild(tmp_path, "--llvm/build-type", "Debug", "--get-config-option",
+                           "llvm-native/build-type").splitlines()[-1] == "BuildType.DEBUG"
+    config = tmp_path / "config.json"
+    config.write_text('{"cheribsd": {"build-options": ["-DFOO"]}}')
+    assert _run_cheribuild(tmp_path, "--config-file", str(config), "--get-config-option",
+                           "cheribsd-riscv64-purecap/build-options").splitlines()[-1] == "['-DFOO']"
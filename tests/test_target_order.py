@@ -276,3 +276,29 @@ def test_skip_toolchain_deps(target_name, include_recursive_deps, include_toolch
     # TODO: should we do the same for all-<target>?
     assert _sort_targets([target_name], add_dependencies=include_recursive_deps, add_toolchain=include_toolchain,
                          build_morello_from_source=morello_from_source) == expected_deps
+
+
+def _scheduling_deps(targets: "typing.List[str]", add_dependencies=False) -> "typing.Dict[str, typing.List[str]]":
+    _sort_targets(targets, add_dependencies=add_dependencies)
+    chosen = target_manager.get_all_targets(
+        [target_manager.get_target(t, None, global_config, caller="_scheduling_deps") for t in targets],
+        global_config)
+    return {t.name: [d.name for d in deps] for t, deps in target_manager.get_scheduling_dependencies(chosen).items()}
+
+
+def test_parallel_scheduling_deps():
+    deps = _scheduling_deps(["sdk-mips64-hybrid"])
+    # The toolchain targets are independent and can be built concurrently
+    assert deps["llvm-native"] == []
+    assert deps["qemu"] == []
+    assert deps["gdb-native"] == []
+    assert deps["freestanding-sdk"] == ["llvm-native", "qemu", "gdb-native"]
+    assert deps["cheribsd-mips64-hybrid"] == ["llvm-native"]
+    assert "cheribsd-mips64-hybrid" in deps["sdk-mips64-hybrid"]
+    # run and disk-image targets must wait for all previous targets
+    deps = _scheduling_deps(["run-mips64-hybrid", "disk-image-mips64-hybrid", "gdb-mips64-hybrid",
+                             "cheribsd-mips64-hybrid"])
+    assert deps["cheribsd-mips64-hybrid"] == []
+    assert deps["gdb-mips64-hybrid"] == ["cheribsd-mips64-hybrid"]
+    assert deps["disk-image-mips64-hybrid"] == ["cheribsd-mips64-hybrid", "gdb-mips64-hybrid"]
+    assert deps["run-mips64-hybrid"] == ["cheribsd-mips64-hybrid", "gdb-mips64-hybrid", "disk-image-mips64-hybrid"]